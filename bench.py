@@ -0,0 +1,642 @@
+#
+#   Benchmarks for kasm
+#
+#   python bench.py [benchmark...]
+#
+
+import sys
+import os
+import time
+import tempfile
+import gc
+import subprocess
+
+import kasm
+import kasmc
+import image
+import kim1
+import fileinput
+import sourcecache
+import symbols
+import tok
+import eval
+
+
+#
+#   Write a synthetic source of about 'nLines' lines: mostly comments,
+#   equates and short instruction sequences, so that 100k lines still
+#   fits in 64K
+#
+def genSource( filename, nLines ):
+    out = open( filename, 'w' )
+    out.write( "ptr = $10\n" )
+    out.write( "zp = $20\n" )
+    out.write( "        org     $0800\n" )
+
+    n = 0
+    lines = 3
+    while lines < nLines:
+        out.write( str.format( "; ---- block {0}\n", n ) )
+        out.write( ";\n" )
+        out.write( str.format( ";   block {0} does something important\n", n ) )
+        out.write( "\n" )
+        out.write( str.format( "k{0}      =       {1} + 1\n", n, n & 0xff ) )
+        out.write( str.format( "j{0}      =       k{0} * 2\n", n ) )
+        out.write( str.format( "m{0}      =       table + {1}\n", n, n & 0x7f ) )
+        out.write( str.format( "f{0}:     lda     #k{0} & $7f        ; get it\n", n ) )
+        out.write( "        sta     zp,x\n" )
+        out.write( str.format( "p{0}      =       ptr + 1\n", n ) )
+        out.write( str.format( "        bne     f{0}\n", n ) )
+        out.write( "        beq     .skip\n" )
+        out.write( ".skip:  rts\n" )
+        out.write( "\n" )
+        out.write( str.format( "; ---- end of block {0}\n", n ) )
+        out.write( "\n" )
+        lines += 16
+        n += 1
+
+    out.write( "table:  db      1, 2, 3, 4\n" )
+    out.close()
+
+
+def timed( fn ):
+    start = time.time()
+    fn()
+    return time.time() - start
+
+
+def tempSource( nLines ):
+    fd, filename = tempfile.mkstemp( suffix='.asm' )
+    os.close( fd )
+    genSource( filename, nLines )
+    return filename
+
+
+#
+#   Time per phase.  "reparse" is how phase 1 used to work (read and
+#   tokenize every line again), "replay" walks the records from phase 0.
+#
+def benchPhases( nLines=100000 ):
+    filename = tempSource( nLines )
+    asm = kasm.Assembler()
+
+    def start():
+        asm.reset()
+        asm.m_input = fileinput.FileInput( filename )
+
+    def reparse():
+        input = fileinput.FileInput( filename )
+        asm.m_loc = 0
+        asm.clearMemory()
+        while True:
+            line = input.nextLine()
+            if not line:
+                break
+            rec = kasm.LineRecord( input.file(), input.line(), line )
+            asm.parseLine( rec )
+            asm.assembleRecord( rec, 1 )
+
+    def replay():
+        asm.m_loc = 0
+        asm.clearMemory()
+        asm.replaySource( 1 )
+
+    gc.disable()
+    start()
+    phase0 = timed( asm.readSource )
+    before = timed( reparse )
+    after = timed( replay )
+    gc.enable()
+
+    print str.format( "phases: {0} lines", nLines )
+    print str.format( "    phase 0              {0:8.3f}s", phase0 )
+    print str.format( "    phase 1 (reparse)    {0:8.3f}s   total {1:8.3f}s", before, phase0 + before )
+    print str.format( "    phase 1 (replay)     {0:8.3f}s   total {1:8.3f}s", after, phase0 + after )
+
+    os.remove( filename )
+
+
+#
+#   Lexer throughput, in lines per second
+#
+def benchLexer( nLines=100000 ):
+    filename = tempSource( nLines )
+    with open( filename ) as file:
+        lines = file.readlines()
+    os.remove( filename )
+
+    def run( fn ):
+        def lex():
+            for line in lines:
+                fn( line )
+        return len( lines ) / timed( lex )
+
+    print str.format( "lexer: {0} lines", len( lines ) )
+    print str.format( "    referenceTokenize    {0:10.0f} lines/sec", run( tok.referenceTokenize ) )
+    print str.format( "    tokenize             {0:10.0f} lines/sec", run( tok.tokenize ) )
+
+
+#
+#   Expression evaluation, against a plain function call
+#
+def benchExpressions( count=200000 ):
+    table = symbols.SymbolTable()
+    table.set( 'zp', 0x20 )
+    table.set( 'abs', 0x1234 )
+    table.set( 'table', 0x4000 )
+
+    def call():
+        pass
+
+    def run( fn ):
+        def loop():
+            for i in xrange( count ):
+                fn()
+        return timed( loop ) / count * 1e9
+
+    print str.format( "expressions: {0} evaluations each", count )
+    print str.format( "    {0:20} {1:8.0f} ns", "function call", run( call ) )
+    for text in [ '123', 'zp', 'abs', 'table+1', '* + 0xffff', '(1 << 8) - 1' ]:
+        expr = eval.Expression( tok.Tokenizer( text ) )
+        print str.format( "    {0:20} {1:8.0f} ns", text, run( lambda: expr.eval( table, 0x0800 ) ) )
+
+
+#
+#   Symbol table: define and look up 50k symbols (half of them local)
+#
+def benchSymbols( count=50000 ):
+    names = []
+    for i in xrange( count / 2 ):
+        names.append( str.format( "func{0}", i ) )
+        names.append( ".loop" )
+
+    table = symbols.SymbolTable()
+
+    def define():
+        table.clear()
+        for i in xrange( count ):
+            table.set( names[i], i )
+
+    def lookup():
+        for i in xrange( count ):
+            table.setScope( names[i] )
+            if table.isDefined( names[i] ):
+                table.get( names[i] )
+
+    qualified = []
+    for i in xrange( count ):
+        table.setScope( names[i] )
+        qualified.append( table.qualify( names[i] ) )
+
+    def find():
+        for name in qualified:
+            table.find( name )
+
+    print str.format( "symbols: {0} symbols", count )
+    print str.format( "    set                  {0:8.0f} ns/symbol", timed( define ) / count * 1e9 )
+    print str.format( "    isDefined + get      {0:8.0f} ns/symbol", timed( lookup ) / count * 1e9 )
+    print str.format( "    find (qualified)     {0:8.0f} ns/symbol", timed( find ) / count * 1e9 )
+
+
+#
+#   Whole assembly, two passes vs. one pass with fixups
+#
+def benchOnePass( nLines=100000 ):
+    filename = tempSource( nLines )
+
+    def run( onePass ):
+        asm = kasm.Assembler( onePass=onePass )
+        t = timed( lambda: asm.assembleFile( filename ) )
+        return t, asm.m_fixupCount
+
+    run( False )        # warm up the expression cache
+
+    print str.format( "one pass: {0} lines", nLines )
+    print str.format( "    two passes           {0:8.3f}s", run( False )[0] )
+    print str.format( "    one pass + fixups    {0:8.3f}s   ({1} fixups)", *run( True ) )
+
+    os.remove( filename )
+
+
+#
+#   A project of 'nMains' programs that all include the same
+#   'nHeaders' headers: no cache, then a cold and a warm source cache
+#
+def benchCache( nMains=8, nHeaders=20, nLines=1000, nSearched=4 ):
+    directory = tempfile.mkdtemp()
+    searchPath = [ os.path.join( directory, str.format( "lib{0}", i ) ) for i in xrange( nSearched + 1 ) ]
+    for searchDirectory in searchPath:
+        os.mkdir( searchDirectory )
+
+    headers = []
+    for h in xrange( nHeaders ):
+        filename = os.path.join( searchPath[-1], str.format( "h{0}.inc", h ) )
+        with open( filename, 'w' ) as out:
+            for n in xrange( nLines / 2 ):
+                out.write( str.format( ";   register {0} of device {1}\n", n, h ) )
+                out.write( str.format( "h{0}_{1}     =       $c000 + {2} * 16 + {1}      ; control\n", h, n, h ) )
+        headers.append( filename )
+
+    mains = []
+    for m in xrange( nMains ):
+        filename = os.path.join( directory, str.format( "main{0}.asm", m ) )
+        with open( filename, 'w' ) as out:
+            for header in headers:
+                out.write( str.format( "        include \"{0}\"\n", os.path.basename( header ) ) )
+            out.write( "        org     $0800\n" )
+            for h in xrange( nHeaders ):
+                out.write( str.format( "        lda     h{0}_{1}\n", h, m ) )
+                out.write( str.format( "        sta     h{0}_{1}\n", h, m + 1 ) )
+            out.write( "        rts\n" )
+        mains.append( filename )
+
+    cacheDirectory = sourcecache.gDirectory
+    sourcecache.gDirectory = os.path.join( directory, 'cache' )
+
+    def build( useCache=True ):
+        asm = kasm.Assembler( useCache=useCache, searchPath=searchPath )
+        for filename in mains:
+            assert asm.assembleFile( filename )
+
+    #   (the headers are read again each time, unless 'keepFiles')
+    def run( useCache, keepFiles=False ):
+        sourcecache.clearStats()
+        fileinput.clearStats()
+        if not keepFiles:
+            fileinput.clear()
+        return timed( lambda: build( useCache ) )
+
+    build()             # warm up the expression cache
+    sourcecache.clear()
+
+    lines = nMains * ( nHeaders * nLines + nHeaders * 3 + 2 )
+    print str.format( "source cache: {0} programs x {1} headers, {2} lines in all, headers on -I path {3} of {4}",
+        nMains, nHeaders, lines, nSearched + 1, nSearched + 1 )
+    print str.format( "    no cache             {0:8.3f}s", run( False ) )
+    print str.format( "    cold cache           {0:8.3f}s   ({1} misses)", run( True ), sourcecache.gMisses )
+    print str.format( "    warm cache           {0:8.3f}s   ({1} hits)", run( True ), sourcecache.gHits )
+    print str.format( "    files already read   {0:8.3f}s   ({1} files unchanged, {2} include paths remembered)",
+        run( True, True ), fileinput.gFileHits, fileinput.gPathHits )
+
+    sourcecache.clear()
+    fileinput.clear()
+    sourcecache.gDirectory = cacheDirectory
+    for root, directories, filenames in os.walk( directory, topdown=False ):
+        for filename in filenames:
+            os.remove( os.path.join( root, filename ) )
+        for name in directories:
+            os.rmdir( os.path.join( root, name ) )
+    os.rmdir( directory )
+
+
+#
+#   -j N: 'nFiles' independent programs of 'nLines' each, on 1 to 8 workers
+#
+def benchJobs( nFiles=16, nLines=5000 ):
+    directory = tempfile.mkdtemp()
+    jobs = []
+    for i in xrange( nFiles ):
+        filename = os.path.join( directory, str.format( "rom{0}.asm", i ) )
+        genSource( filename, nLines )
+        jobs.append( ( filename, kasm.currentOptions() ) )
+
+    print str.format( "jobs: {0} files of {1} lines", nFiles, nLines )
+    for workers in [ 1, 2, 4, 8 ]:
+        t = timed( lambda: kasm.runJobs( jobs, workers ) )
+        print str.format( "    {0} workers            {1:8.3f}s", workers, t )
+
+    for filename in os.listdir( directory ):
+        os.remove( os.path.join( directory, filename ) )
+    os.rmdir( directory )
+
+
+#
+#   --watch: a program of 'nFiles' included modules, assembled in full and
+#   then again after an edit to one module; edits that leave the symbols
+#   where they were only assemble what follows them
+#
+def benchReassemble( nFiles=20, nLines=2000 ):
+    directory = tempfile.mkdtemp()
+    modules = []
+    for i in xrange( nFiles ):
+        filename = os.path.join( directory, str.format( "mod{0}.inc", i ) )
+        lines = []
+        for n in xrange( nLines / 8 ):
+            lines.append( str.format( "; ---- block {0} of module {1}\n", n, i ) )
+            lines.append( ";\n" )
+            lines.append( str.format( "k{0}_{1}   =       {2} + 1\n", i, n, n & 0x7f ) )
+            lines.append( str.format( "f{0}_{1}:  lda     #k{0}_{1}          ; get it\n", i, n ) )
+            lines.append( "        sta     zp,x\n" )
+            lines.append( str.format( "        bne     f{0}_{1}\n", i, n ) )
+            lines.append( ".skip:  rts\n" )
+            lines.append( "\n" )
+        with open( filename, 'w' ) as out:
+            out.write( ''.join( lines ) )
+        modules.append( ( filename, lines ) )
+
+    main = os.path.join( directory, 'main.asm' )
+    with open( main, 'w' ) as out:
+        out.write( "zp = $20\n        org     $0800\n" )
+        for filename, lines in modules:
+            out.write( str.format( "        include \"{0}\"\n", filename ) )
+
+    asm = kasm.Assembler( incremental=True )
+
+    def edit( i, text ):
+        filename, lines = modules[i]
+        with open( filename, 'w' ) as out:
+            out.write( ''.join( lines[:3] ) + str.format( "f{0}_0:  {1}\n", i, text ) + ''.join( lines[4:] ) )
+        return timed( lambda: asm.reassemble( [ filename ] ) )
+
+    print str.format( "reassemble: {0} modules of {1} lines", nFiles, nLines )
+    asm.assembleFile( main )
+    print str.format( "    full assembly        {0:8.1f} ms", timed( lambda: asm.assembleFile( main ) ) * 1000 )
+    for i, text, what in [ ( nFiles - 1, "lda     #2", "last module, same size" ),
+            ( nFiles / 2, "lda     #2", "middle module, same size" ),
+            ( nFiles / 2, "lda     $1234", "middle module, grows" ),
+            ( 0, "lda     #2", "first module, same size" ) ]:
+        t = edit( i, text )
+        print str.format( "    {0:24} {1:8.1f} ms   (read {2} of {3} lines again, phase 1 from line {4})",
+            what, t * 1000, len( asm.m_records ) - asm.m_readFrom, len( asm.m_records ), asm.m_replayFrom )
+
+    for filename in os.listdir( directory ):
+        os.remove( os.path.join( directory, filename ) )
+    os.rmdir( directory )
+
+
+#
+#   Memory image: the size of an image, and Kim-1 output time for
+#   programs of a few sizes
+#
+def benchImage():
+    listImage = [None] * image.SIZE
+    listBytes = sys.getsizeof( listImage )
+    newImage = image.Image()
+    imageBytes = sys.getsizeof( newImage.m_data ) + sys.getsizeof( newImage.m_written )
+
+    print "image:"
+    print str.format( "    [None] * 64K                     {0:8} bytes", listBytes )
+    print str.format( "    Image                            {0:8} bytes", imageBytes )
+
+    fd, filename = tempfile.mkstemp( suffix='.dat' )
+    os.close( fd )
+    for size in [ 0x100, 0x1000, 0x10000 ]:
+        memory = image.Image()
+        for addr in xrange( 0x8000 - size / 2, 0x8000 + size / 2 ):
+            memory.write( addr, addr & 0xff )
+        for length in [ 16, kasm.KIM1_MAX_RECORD ]:
+            t = timed( lambda: kasm.dumpKim1Records( memory, filename, recordLength=length ) )
+            print str.format( "    write {0:5} bytes, {1:2}-byte records  {2:8.3f} ms", size, length, t * 1000 )
+    os.remove( filename )
+
+
+#
+#   A data-heavy source: about 'nBytes' of strings, byte and word tables
+#   and filled blocks
+#
+def benchData( nBytes=0x8000 ):
+    fd, filename = tempfile.mkstemp( suffix='.asm' )
+    out = os.fdopen( fd, 'w' )
+    out.write( "        org     $4000\n" )
+
+    size = 0
+    n = 0
+    while size < nBytes:
+        out.write( str.format( "msg{0}:  db      \"message number {0} is a longer string of text\", 0\n", n ) )
+        out.write( "        db      " + ", ".join( str( ( n + i ) & 0xff ) for i in xrange( 16 ) ) + "\n" )
+        out.write( str.format( "        dw      msg{0}, msg{0} + 1, $1234, $5678, 0, 1, 2, 3\n", n ) )
+        out.write( "        ds      32, $ff\n" )
+        size += 44 + len( str( n ) ) + 16 + 16 + 32
+        n += 1
+    out.close()
+
+    asm = kasm.Assembler()
+    asm.assembleFile( filename )        # warm up the expression cache
+    t = timed( lambda: asm.assembleFile( filename ) )
+
+    print str.format( "data: {0} bytes", size )
+    print str.format( "    assemble             {0:8.3f}s   {1:10.0f} bytes/sec", t, size / t )
+
+    os.remove( filename )
+
+
+#
+#   Overlapping writes: the same lines, each section written over the
+#   last one, and each in a place of its own
+#
+def benchOverlaps( nSections=8000 ):
+    print str.format( "overlaps: {0} sections", nSections )
+    for what, org in [ ( "disjoint", lambda i: 0x1000 + i * 4 ), ( "overlapping", lambda i: 0x1000 ) ]:
+        text = ''.join( str.format( "        org ${0:04X}\n        lda #{1}\n        rts\n", org( i ), i & 0xff )
+            for i in xrange( nSections ) )
+        asm = kasm.Assembler()
+        t = timed( lambda: asm.assembleString( text ) )
+        print str.format( "    {0:20} {1:8.3f}s  {2:6} warnings", what, t, len( asm.m_messages ) )
+
+
+#
+#   Assembly with and without a listing
+#
+def benchListing( nLines=100000 ):
+    filename = tempSource( nLines )
+
+    asm = kasm.Assembler()
+    asm.assembleFile( filename )        # warm up the expression cache
+    assemble = timed( lambda: asm.assembleFile( filename ) )
+    render = timed( asm.renderListing )
+
+    print str.format( "listing: {0} lines", nLines )
+    print str.format( "    assemble             {0:8.3f}s", assemble )
+    print str.format( "    render listing       {0:8.3f}s", render )
+
+    os.remove( filename )
+
+
+#
+#   Reading back a full 64K image's Kim-1 records, and comparing images
+#
+def benchLoad( count=20 ):
+    fd, filename = tempfile.mkstemp( suffix='.dat' )
+    os.close( fd )
+
+    memory = image.Image()
+    memory.writeBlock( 0, bytearray( i * 7 & 0xff for i in xrange( image.SIZE ) ) )
+    kasm.dumpKim1Records( memory, filename )
+    with open( filename, 'rb' ) as file:
+        text = file.read()
+    os.remove( filename )
+
+    def load():
+        for i in xrange( count ):
+            kim1.parseKim1( text )
+
+    loaded = kim1.parseKim1( text )
+    other = loaded.copy()
+    other.write( 0x8000, 1 )
+
+    def compare():
+        for i in xrange( count ):
+            image.differences( loaded, other )
+
+    t = timed( load ) / count
+    print str.format( "load: {0} bytes of records", len( text ) )
+    print str.format( "    parse                {0:8.3f} ms   {1:8.1f} MB/s", t * 1000, len( text ) / t / 1e6 )
+    print str.format( "    compare (1 byte off) {0:8.3f} ms", timed( compare ) / count * 1000 )
+
+
+#
+#   address ==> nearest symbol: the bisect index against a linear scan
+#
+def benchIndex( nSymbols=5000, count=1000000 ):
+    table = symbols.SymbolTable()
+    for i in xrange( nSymbols ):
+        table.define( str.format( "sym{0}", i ), ( i * 13 ) & 0xffff )
+
+    addresses = [ ( i * 7919 ) & 0xffff for i in xrange( count ) ]
+
+    def scan( addr ):
+        best = None
+        for name, sym in table.m_symbols.iteritems():
+            if sym.m_value <= addr and ( best == None or sym.m_value > best[1] ):
+                best = ( name, sym.m_value )
+        return best
+
+    def scanning():
+        for addr in addresses[:1000]:
+            scan( addr )
+
+    index = symbols.AddressIndex( table.m_symbols )
+    def indexed():
+        lookup = index.lookup
+        for addr in addresses:
+            lookup( addr )
+
+    build = timed( lambda: symbols.AddressIndex( table.m_symbols ) )
+    print str.format( "index: {0} symbols", nSymbols )
+    print str.format( "    build index          {0:8.3f} ms", build * 1000 )
+    print str.format( "    linear scan          {0:8.0f} ns/lookup", timed( scanning ) / 1000 * 1e9 )
+    print str.format( "    index                {0:8.0f} ns/lookup", timed( indexed ) / count * 1e9 )
+
+
+#
+#   Many small snippets (as a test harness assembles them): one
+#   interpreter per snippet, against one Assembler used over and over
+#
+def benchSnippets( count=2000, nSpawned=20 ):
+    snippets = []
+    for i in xrange( count ):
+        snippets.append( str.format( "        org ${0:04X}\n"
+            "start:  ldx #{1}\n"
+            ".loop:  lda table,x\n"
+            "        sta $20,x\n"
+            "        dex\n"
+            "        bne .loop\n"
+            "        rts\n"
+            "table:  db 1, 2, 3, {1}\n", 0x200 + i * 16, i & 0xff ) )
+
+    directory = tempfile.mkdtemp()
+    kasmPath = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), 'kasm.py' )
+
+    def spawned():
+        for i in xrange( nSpawned ):
+            filename = os.path.join( directory, str.format( "s{0}.asm", i ) )
+            with open( filename, 'w' ) as out:
+                out.write( snippets[i] )
+            subprocess.check_call( [ sys.executable, kasmPath, filename ] )
+
+    asm = kasm.Assembler()
+    def reused():
+        for text in snippets:
+            asm.assembleString( text )
+
+    perSpawned = timed( spawned ) / nSpawned
+    perReused = timed( reused ) / count
+
+    print str.format( "snippets: {0} snippets", count )
+    print str.format( "    interpreter each     {0:8.3f} ms/snippet", perSpawned * 1000 )
+    print str.format( "    one Assembler        {0:8.3f} ms/snippet", perReused * 1000 )
+
+    for filename in os.listdir( directory ):
+        os.remove( os.path.join( directory, filename ) )
+    os.rmdir( directory )
+
+
+#
+#   Build latency: 'python kasm.py' each time, against a running kasmd
+#   (from 'python kasmc.py', and from a client that's already running)
+#
+def benchDaemon( count=20, nLines=200 ):
+    directory = tempfile.mkdtemp()
+    filename = os.path.join( directory, 'rom.asm' )
+    genSource( filename, nLines )
+    here = os.path.dirname( os.path.abspath( __file__ ) )
+    path = os.path.join( directory, 'kasmd.sock' )
+
+    env = dict( os.environ )
+    env['KASMD_SOCKET'] = path
+    daemon = subprocess.Popen( [ sys.executable, os.path.join( here, 'kasmd.py' ), path ] )
+    while not os.path.exists( path ):
+        time.sleep( 0.01 )
+
+    def command( script ):
+        def run():
+            for i in xrange( count ):
+                subprocess.check_call( [ sys.executable, os.path.join( here, script ), filename ], env=env )
+        return timed( run ) / count
+
+    def calls():
+        for i in xrange( count ):
+            kasmc.call( { 'argv': [ filename ], 'cwd': directory }, path )
+
+    def snippets():
+        for i in xrange( count ):
+            kasmc.call( { 'source': "        org $300\n        lda #1\n        rts\n" }, path )
+
+    try:
+        command( 'kasmc.py' )           # warm up the daemon
+        print str.format( "daemon: {0} lines, {1} builds each", nLines, count )
+        print str.format( "    python kasm.py       {0:8.1f} ms/build", command( 'kasm.py' ) * 1000 )
+        print str.format( "    python kasmc.py      {0:8.1f} ms/build", command( 'kasmc.py' ) * 1000 )
+        print str.format( "    kasmc.call (argv)    {0:8.1f} ms/build", timed( calls ) / count * 1000 )
+        print str.format( "    kasmc.call (source)  {0:8.1f} ms/snippet", timed( snippets ) / count * 1000 )
+    finally:
+        daemon.terminate()
+        daemon.wait()
+        for name in os.listdir( directory ):
+            os.remove( os.path.join( directory, name ) )
+        os.rmdir( directory )
+
+
+gBenchmarks = {
+    'phases': benchPhases,
+    'lexer': benchLexer,
+    'expressions': benchExpressions,
+    'symbols': benchSymbols,
+    'onepass': benchOnePass,
+    'cache': benchCache,
+    'jobs': benchJobs,
+    'image': benchImage,
+    'data': benchData,
+    'overlaps': benchOverlaps,
+    'listing': benchListing,
+    'load': benchLoad,
+    'index': benchIndex,
+    'snippets': benchSnippets,
+    'daemon': benchDaemon,
+    'reassemble': benchReassemble
+    }
+
+
+def main( argv ):
+    names = argv[1:]
+    if not names:
+        names = sorted( gBenchmarks.keys() )
+
+    for name in names:
+        if not name in gBenchmarks:
+            raise Exception( str.format( "Unknown benchmark {0}", name ) )
+        gBenchmarks[name]()
+
+
+if __name__ == '__main__':
+    main( sys.argv )
@@ -1,250 +1,353 @@
 #
 #   Expression evaluator
 #
-#   Constructor: Expression( tokenizer ), parses next expression
+#   Constructor: Expression( tokenizer, scope ), parses next expression
+#   (local symbols in it are qualified with 'scope')
 #
-#   Subsequent calls to 'eval' cough up an integer value, or None
+#   Subsequent calls to 'eval', with a symbols.SymbolTable, cough up an
+#   integer value, or None
 #
+#   Parsing compiles the expression into a single Python function (or
+#   just a number, when there are no symbols to look up), so 'eval' is
+#   about one call per operator.
+#
+
+import collections
+import threading
 
 import symbols
 import tok
 
 
-class Expression:
+#
+#   Raised (and caught by 'eval') when an expression uses a symbol
+#   that isn't defined yet
+#
+class UndefinedSymbol( Exception ):
+    pass
 
-    def __init__( self, tokenizer ):
-        self.initOperators()
-        self.parse( tokenizer )
-        
-    def doPushConst( self ):
-        self.m_stack.append( self.m_postfix[ self.m_index] )
-        self.m_index = self.m_index + 1
 
-    def doPushSym( self ):
-        symbol = self.m_postfix[ self.m_index]
-        self.m_index = self.m_index + 1
+#
+#   Operators; 'v2' is the left operand and 'v1' the right
+#
+def doAdd( v2, v1 ):
+    return v2 + v1
+
+def doAnd( v2, v1 ):
+    return v2 & v1
+
+def doDiv( v2, v1 ):
+    if v1 == 0:
+        raise Exception( "Division by zero" )
+    return v2 / v1
+
+def doEQ( v2, v1 ):
+    if v1 == v2:
+        return 1
+    else:
+        return 0
+
+def doGE( v2, v1 ):
+    if v1 >= v2:
+        return 1
+    else:
+        return 0
+
+def doGT( v2, v1 ):
+    if v1 > v2:
+        return 1
+    else:
+        return 0
+
+def doLE( v2, v1 ):
+    if v1 <= v2:
+        return 1
+    else:
+        return 0
+
+def doLT( v2, v1 ):
+    if v1 < v2:
+        return 1
+    else:
+        return 0
+
+def doMod( v2, v1 ):
+    if v1 == 0:
+        raise Exception( "Modulo by zero" )
+    return v2 % v1
+
+def doMult( v2, v1 ):
+    if v1 == 0:
+        v1 = 1
+    return v2 * v1
+
+def doNE( v2, v1 ):
+    if v1 != v2:
+        return 1
+    else:
+        return 0
+
+def doOr( v2, v1 ):
+    return v2 | v1
+
+def doSHL( v2, v1 ):
+    return v2 << v1
+
+def doSHR( v2, v1 ):
+    return v2 >> v1
+
+def doSub( v2, v1 ):
+    return v2 - v1
+
+def doXor( v2, v1 ):
+    return v2 ^ v1
+
+def doNeg( v ):
+    return - v
+
+def doNot( v ):
+    if v:
+        return 0
+    else:
+        return 1
 
-        if symbols.isDefined( symbol ):
-            self.m_stack.append( symbols.get( symbol ) )
-        else:
-            self.m_undefined = True
-            self.m_stack.append( 1 )
-
-    def doAdd( self ):
-        v1 = self.m_stack.pop()
-        v2 = self.m_stack.pop()
-        self.m_stack.append( v2 + v1 )
-
-    def doAnd( self ):
-        v1 = self.m_stack.pop()
-        v2 = self.m_stack.pop()
-        self.m_stack.append( v2 & v1 )
-
-    def doDiv( self ):
-        if self.m_undefined:
-            self.m_stack.pop()
-        else:
-            v1 = self.m_stack.pop()
-            v2 = self.m_stack.pop()
-            if v1 == 0:
-                raise Exception( "Division by zero" )
-            self.m_stack.append( v2 / v1 )
-
-    def doEQ( self ):
-        v1 = self.m_stack.pop()
-        v2 = self.m_stack.pop()
-        if v1 == v2:
-            self.m_stack.append( 1 )
-        else:
-            self.m_stack.append( 0 )
 
-    def doGE( self ):
-        v1 = self.m_stack.pop()
-        v2 = self.m_stack.pop()
-        if v1 >= v2:
-            self.m_stack.append( 1 )
-        else:
-            self.m_stack.append( 0 )
+#
+#   operators, in increasing precedence
+#   unary operators, terms and parenthesis are handled "by hand"
+#
+gOperators = [
+        { '&': doAnd, '^': doXor, '|': doOr },
+        { '<': doLT, '<=': doLE, '>': doGT, '>=': doGE, '==': doEQ, '!=': doNE },
+        { '<<': doSHL, '>>': doSHR },
+        { '+': doAdd, '-': doSub },
+        { '*': doMult, '/': doDiv, '%': doMod }
+    ]
 
-    def doGT( self ):
-        v1 = self.m_stack.pop()
-        v2 = self.m_stack.pop()
-        if v1 > v2:
-            self.m_stack.append( 1 )
-        else:
-            self.m_stack.append( 0 )
 
-    def doLE( self ):
-        v1 = self.m_stack.pop()
-        v2 = self.m_stack.pop()
-        if v1 <= v2:
-            self.m_stack.append( 1 )
-        else:
-            self.m_stack.append( 0 )
+#
+#   Compiled terms are either a number (a constant) or a function of the
+#   symbol table and the location counter.  Operators on constants are folded, unless they fail, in
+#   which case they fail when evaluated, as they always have.
+#
 
-    def doLT( self ):
-        v1 = self.m_stack.pop()
-        v2 = self.m_stack.pop()
-        if v1 < v2:
-            self.m_stack.append( 1 )
-        else:
-            self.m_stack.append( 0 )
+def isConstant( term ):
+    return not callable( term )
 
-    def doMod( self ):
-        if self.m_undefined:
-            self.m_stack.pop()
-        else:
-            v1 = self.m_stack.pop()
-            v2 = self.m_stack.pop()
-            if v1 == 0:
-                raise Exception( "Modulo by zero" )
-            self.m_stack.append( v2 % v1 )
-
-    def doMult( self ):
-        v1 = self.m_stack.pop()
-        v2 = self.m_stack.pop()
-        if v1 == 0:
-            v1 = 1
-        self.m_stack.append( v2 * v1 )
-
-    def doNE( self ):
-        v1 = self.m_stack.pop()
-        v2 = self.m_stack.pop()
-        if v1 != v2:
-            self.m_stack.append( 1 )
-        else:
-            self.m_stack.append( 0 )
-
-    def doOr( self ):
-        v1 = self.m_stack.pop()
-        v2 = self.m_stack.pop()
-        self.m_stack.append( v2 | v1 )
-
-    def doSHL( self ):
-        v1 = self.m_stack.pop()
-        v2 = self.m_stack.pop()
-        self.m_stack.append( v2 << v1 )
-
-    def doSHR( self ):
-        v1 = self.m_stack.pop()
-        v2 = self.m_stack.pop()
-        self.m_stack.append( v2 >> v1 )
-
-    def doSub( self ):
-        v1 = self.m_stack.pop()
-        v2 = self.m_stack.pop()
-        self.m_stack.append( v2 - v1 )
-
-    def doXor( self ):
-        v1 = self.m_stack.pop()
-        v2 = self.m_stack.pop()
-        self.m_stack.append( v2 ^ v1 )
-
-    def doNeg( self ):
-        self.m_stack[-1] = - self.m_stack[-1]
-
-    def doNot( self ):
-        v = self.m_stack[-1]
-        if v:
-            self.m_stack[-1] = 0
-        else:
-            self.m_stack[-1] = 1
 
-    def eval( self ):
-        self.m_undefined = []
-        self.m_stack = []
-        self.m_index = 0
+#
+#   Local symbols are qualified with the scope they're parsed in
+#
+def compileSymbol( symbol, scope ):
+    symbol = symbols.qualify( symbol, scope )
 
-        while self.m_index < len(self.m_postfix):
-            fn = self.m_postfix[self.m_index]
-            self.m_index += 1
-            fn()
+    def fn( table, loc ):
+        try:
+            return table[symbol].m_value
+        except KeyError:
+            raise UndefinedSymbol( symbol )
 
-        assert len(self.m_stack) == 1
+    return fn
+
+
+#
+#   '*' isn't in the symbol table; it's the location counter the
+#   assembler passes to 'eval'
+#
+def compileLocation():
+
+    def fn( table, loc ):
+        if loc == None:
+            raise UndefinedSymbol( '*' )
+        return loc
+
+    return fn
+
+
+def compileUnary( op, term ):
+    if isConstant( term ):
+        return op( term )
+
+    def fn( table, loc ):
+        return op( term( table, loc ) )
+
+    return fn
+
+
+def compileBinary( op, left, right ):
+    if isConstant( left ):
+
+        if isConstant( right ):
+            try:
+                return op( left, right )
+            except:
+                def fn( table, loc ):
+                    return op( left, right )
 
-        if self.m_undefined:
-            return None
         else:
-            return self.m_stack[0]
+            def fn( table, loc ):
+                return op( left, right( table, loc ) )
+
+    elif isConstant( right ):
+        def fn( table, loc ):
+            return op( left( table, loc ), right )
+
+    else:
+        def fn( table, loc ):
+            return op( left( table, loc ), right( table, loc ) )
 
-    def isUndefined( self ):
-        return len(self.m_undefined) == 0
+    return fn
 
 
+#
+#   Expressions are immutable once parsed, so identical ones can be
+#   shared (see internExpression)
+#
+class Expression:
+
+    def __init__( self, tokenizer, scope=None ):
+        self.parse( tokenizer, scope )
+
     #
-    #   operators, in increasing precedence
-    #   unary operators, terms and parenthesis are handled "by hand"
+    #   table:  symbols.SymbolTable
+    #   loc:    value of '*' (the location counter at the start of the line)
     #
-    def initOperators( self ):
-        self.m_operators = [
-                { '&': self.doAnd, '^': self.doXor, '|': self.doOr },
-                { '<': self.doLT, '<=': self.doLE, '>': self.doGT, '>=': self.doGE, '==': self.doEQ, '!=': self.doNE },
-                { '<<': self.doSHL, '>>': self.doSHR },
-                { '+': self.doAdd, '-': self.doSub },
-                { '*': self.doMult, '/': self.doDiv, '%': self.doMod }
-            ]
+    def eval( self, table, loc=None ):
+        if self.m_constant:
+            return self.m_fn
+
+        try:
+            return self.m_fn( table.m_symbols, loc )
+        except UndefinedSymbol:
+            return None
+
+    def isConstant( self ):
+        return self.m_constant
 
 
-    def parse( self, tokenizer ):
+    def parse( self, tokenizer, scope ):
 
         def parseTerm():
             if tokenizer.curTok() == tok.SYMBOL:
-                self.m_postfix.append( self.doPushSym )
-                self.m_postfix.append( tokenizer.curValue() )
+                term = compileSymbol( tokenizer.curValue(), scope )
                 tokenizer.nextTok()
             elif tokenizer.curTok() == tok.NUMBER:
-                self.m_postfix.append( self.doPushConst)
-                self.m_postfix.append( tokenizer.curValue() )
+                term = tokenizer.curValue()
                 tokenizer.nextTok()
             elif tokenizer.curTok() == tok.STRING:
                 if len(tokenizer.curValue()) != 1:
                     raise Exception( 'String constants must be one character' )
-                self.m_postfix.append( self.doPushConst)
-                self.m_postfix.append( ord(tokenizer.curValue()[0]) )
+                term = ord(tokenizer.curValue()[0])
                 tokenizer.nextTok()
             elif tokenizer.curTok() == '(':
                 tokenizer.advance()
-                parseHelper( len(self.m_operators) - 1)
+                term = parseHelper( len(gOperators) - 1)
                 tokenizer.expect( ')' )
             elif tokenizer.curTok() == '*':
-                self.m_postfix.append( self.doPushSym )
-                self.m_postfix.append( '*' )
+                term = compileLocation()
                 tokenizer.nextTok()
             else:
                 raise Exception( str.format( "unexpected token {0}", tokenizer.curTok() ) )
+            return term
 
         def parseUnary():
             if tokenizer.curTok() == '-':
                 tokenizer.advance()
-                parseTerm()
-                self.m_postfix.append( self.doNeg )
+                return compileUnary( doNeg, parseTerm() )
             elif tokenizer.curTok() == '!':
                 tokenizer.advance()
-                parseTerm()
-                self.m_postfix.append( self.doNot )
+                return compileUnary( doNot, parseTerm() )
             else:
-                parseTerm()
+                return parseTerm()
 
         def parseHelper( level ):
             if level < 0:
-                parseUnary()
+                return parseUnary()
             else:
-                parseHelper( level - 1 )
-                while tokenizer.curTok() in self.m_operators[level]:
+                term = parseHelper( level - 1 )
+                while tokenizer.curTok() in gOperators[level]:
                     op = tokenizer.curTok()
                     tokenizer.advance()
-                    parseHelper( level - 1 )
-                    self.m_postfix.append( self.m_operators[level][op] )
+                    term = compileBinary( gOperators[level][op], term, parseHelper( level - 1 ) )
+                return term
+
+        self.m_fn = parseHelper( len(gOperators) - 1)
+        self.m_constant = isConstant( self.m_fn )
+
+
+#   ----------------------------------------------------------------
+#   Expression cache
+#
+#   The same operand text turns up over and over ('#0', 'zp', 'table+1'),
+#   so parsed expressions are shared.  The key is the tokens (and their
+#   values) from the start of the expression to the next ',' outside
+#   parentheses (see Tokenizer.operand), plus the scope if any of them
+#   is a local symbol; the value is the expression and how many tokens
+#   it used.  (Keying on the rest of the line made each item of a long
+#   'db' or 'dw' list hash the rest of the list.)
+#
+#   The cache is shared by every assembler in the process, so it is
+#   only touched with gCacheLock held (expressions are parsed outside
+#   the lock; two threads parsing the same text just both parse it).
+#   ----------------------------------------------------------------
+
+gCacheLimit = 4096
+gCache = collections.OrderedDict()
+gCacheHits = 0
+gCacheMisses = 0
+gCacheLock = threading.Lock()
+
+
+def clearCache():
+    global gCache, gCacheHits, gCacheMisses
+    with gCacheLock:
+        gCache = collections.OrderedDict()
+        gCacheHits = 0
+        gCacheMisses = 0
+
+
+#
+#   Like Expression( tokenizer, scope ), but may return a shared expression
+#
+def internExpression( tokenizer, scope=None ):
+    global gCacheHits, gCacheMisses
+
+    key = tokenizer.operand()
+    for value in key[1]:
+        if isinstance( value, str ) and value.startswith( '.' ):
+            key = ( key, scope )
+            break
+
+    with gCacheLock:
+        entry = gCache.pop( key, None )
+        if entry != None:
+            gCacheHits += 1
+            gCache[key] = entry
+        else:
+            gCacheMisses += 1
+
+    if entry != None:
+        tokenizer.advance( entry[1] )
+        return entry[0]
+
+    start = tokenizer.position()
+    expr = Expression( tokenizer, scope )
+
+    with gCacheLock:
+        gCache[key] = ( expr, tokenizer.position() - start )
+        if len( gCache ) > gCacheLimit:
+            gCache.popitem( last=False )
 
-        self.m_postfix = []
-        parseHelper( len(self.m_operators) - 1)
+    return expr
 
 
 def test():
+    table = symbols.SymbolTable()
+
     def testExpr( expr ):
         t = tok.Tokenizer( expr )
         e = Expression( t )
-        print expr, " ==> ", e.eval()
+        print expr, " ==> ", e.eval( table )
 
     testExpr( "42" )
     testExpr( "3 + 4" )
@@ -262,15 +365,93 @@ def test():
     testExpr( "! 1" )
     testExpr( "! 0" )
 
-    symbols.set( "foo", 42 )
+    table.set( "foo", 42 )
     testExpr( "foo" )
     testExpr( "foo + foo * 100 * foo" )
 
-    symbols.set( "bar", 0x10000 )
+    table.set( "bar", 0x10000 )
     testExpr( "bar - 1" )
 
     testExpr( "notYetDefined" )
 
+    def compiled( expr ):
+        return Expression( tok.Tokenizer( expr ) )
+
+    e = compiled( "4 * (1 + 2) * 100" )
+    assert e.isConstant() and e.eval( table ) == 1200
+
+    e = compiled( "foo + 1" )
+    assert not e.isConstant() and e.eval( table ) == 43
+    assert e.eval( symbols.SymbolTable() ) == None
+
+    assert compiled( "notYetDefined + foo" ).eval( table ) == None
+
+    #   locals are qualified with the scope they're parsed in
+    table.set( "bar.x", 7 )
+    assert Expression( tok.Tokenizer( ".x + 1" ), "bar" ).eval( table ) == 8
+
+    #   folding doesn't move errors from eval to parse
+    e = compiled( "1 / 0" )
+    try:
+        e.eval( table )
+        assert False
+    except Exception, ex:
+        assert str( ex ) == "Division by zero"
+
+    #   an undefined symbol ahead of a division by zero wins
+    assert compiled( "notYetDefined + 1 / 0" ).eval( table ) == None
+
+    e = compiled( "* + 0xffff" )
+    assert e.eval( table ) == None and e.eval( table, 0x204 ) == 0x10203
+
+    testCache( table )
+
+
+def testCache( table ):
+    global gCacheLimit
+
+    def interned( expr, scope=None ):
+        t = tok.Tokenizer( expr )
+        e = internExpression( t, scope )
+        return e, t
+
+    clearCache()
+    e1, t1 = interned( "foo + 1, x" )
+    e2, t2 = interned( "foo + $1, x" )
+    assert e1 is e2
+    assert t1.curTok() == ',' and t2.curTok() == ','
+    assert gCacheHits == 1 and gCacheMisses == 1
+
+    e3, t3 = interned( "foo + 2, x" )
+    assert e3 is not e1 and e3.eval( table ) == 44
+
+    #   the same local in another scope is another expression
+    e4, t4 = interned( ".x", "bar" )
+    assert interned( ".x", "bar" )[0] is e4 and interned( ".x", "foo" )[0] is not e4
+
+    #   least recently used goes first
+    limit = gCacheLimit
+    gCacheLimit = 2
+    interned( "foo + 1, x" )
+    interned( "1" )
+    assert interned( "foo + 1, x" )[0] is e1
+    assert interned( "foo + 2, x" )[0] is not e3
+    gCacheLimit = limit
+
+    #   each item of a list is keyed on its own tokens
+    items = ", ".join( str.format( "foo + {0}", i ) for i in range( 100 ) )
+    t = tok.Tokenizer( items )
+    for i in range( 100 ):
+        e = internExpression( t )
+        assert e.eval( table ) == 42 + i
+        if i < 99:
+            t.expect( ',' )
+    assert t.atEnd()
+    assert tok.Tokenizer( "foo + 99" ).operand() in gCache
+    assert interned( "foo + 99" )[0] is e
+    assert interned( "foo, x)" )[1].curTok() == ',' and interned( "(foo), y" )[1].curTok() == ','
+    clearCache()
+
 
 if __name__ == '__main__':
     test()
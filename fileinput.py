@@ -1,50 +1,220 @@
+import os
+import collections
+import threading
+
+
+#   ----------------------------------------------------------------
+#   Finding and reading files
+#
+#   An included file is looked for next to the file that includes it,
+#   then in each directory of the search path (-I), then relative to
+#   where kasm is run.  Where a name was found is remembered for the
+#   life of the process (a remembered file that's gone is looked for
+#   again; one that's new earlier in the search isn't noticed), along
+#   with the current directory it was found from, since the names are
+#   relative to it and kasmd moves to each request's.
+#
+#   The lines of the last gFileLimit files read are kept (by absolute
+#   path), with their tokens, so a file included again (later in the
+#   assembly, or by a later one) is only read again if it has changed:
+#   if its device and inode, modification time or size aren't what
+#   they were.  The lists are never changed once they're made, so
+#   they're shared.
+#   ----------------------------------------------------------------
+
+gPaths = {}                             # ( current directory, including directory, name, search path ) ==> filename
+gFiles = collections.OrderedDict()      # absolute filename ==> ( stamp, lines, lexer, lexed ), least recently used first
+gFileLimit = 256
+gLock = threading.Lock()                # for gPaths, gFiles and the counts
+gPathHits = 0
+gPathMisses = 0
+gFileHits = 0
+gFileMisses = 0
+
+
+def clearStats():
+    global gPathHits, gPathMisses, gFileHits, gFileMisses
+    gPathHits = 0
+    gPathMisses = 0
+    gFileHits = 0
+    gFileMisses = 0
+
+
+def clear():
+    with gLock:
+        gPaths.clear()
+        gFiles.clear()
+
+
+#
+#   The file that 'name', in an include in 'includer', means; None if
+#   there isn't one.  Only the lookups made with 'counted' go into
+#   gPathHits and gPathMisses (an assembly counts the ones reading its
+#   source makes, not the later ones that ask what it read).
+#
+def resolve( name, includer=None, searchPath=(), counted=True ):
+    global gPathHits, gPathMisses
+
+    directory = ''
+    if includer != None:
+        directory = os.path.dirname( includer )
+    memo = ( os.getcwd(), directory, name, searchPath )
+
+    with gLock:
+        filename = gPaths.get( memo )
+    if filename != None and os.path.isfile( filename ):
+        if counted:
+            with gLock:
+                gPathHits += 1
+        return filename
+
+    if counted:
+        with gLock:
+            gPathMisses += 1
+
+    if os.path.isabs( name ):
+        candidates = [ name ]
+    else:
+        candidates = [ os.path.join( directory, name ) ]
+        candidates.extend( os.path.join( searchDirectory, name ) for searchDirectory in searchPath )
+        candidates.append( name )
+
+    for filename in candidates:
+        if os.path.isfile( filename ):
+            with gLock:
+                gPaths[memo] = filename
+            return filename
+
+    return None
+
+
+#
+#   filename ==> ( its lines, their tokens from 'lexer' (None without a lexer) )
+#
+def readLines( filename, lexer=None ):
+    global gFileHits, gFileMisses
+
+    try:
+        stat = os.stat( filename )
+    except:
+        raise Exception( str.format( "Can't open {0}", filename ) )
+    stamp = ( stat.st_dev, stat.st_ino, stat.st_mtime, stat.st_size )
+
+    path = os.path.abspath( filename )
+    with gLock:
+        entry = gFiles.pop( path, None )
+        if entry != None and entry[0] == stamp:
+            gFiles[path] = entry
+            gFileHits += 1
+        else:
+            entry = None
+            gFileMisses += 1
+
+    if entry == None:
+        try:
+            with open( filename ) as file:
+                lines = file.readlines()
+        except:
+            raise Exception( str.format( "Can't open {0}", filename ) )
+        entry = ( stamp, lines, lexer, None )
+        if lexer != None:
+            entry = ( stamp, lines, lexer, lexer( lines ) )
+        remember( path, entry )
+
+    elif lexer != None and entry[2] != lexer:
+        entry = ( stamp, entry[1], lexer, lexer( entry[1] ) )
+        remember( path, entry )
+
+    if lexer == None:
+        return entry[1], None
+    return entry[1], entry[3]
+
+
+def remember( path, entry ):
+    with gLock:
+        gFiles[path] = entry
+        while len( gFiles ) > gFileLimit:
+            gFiles.popitem( last=False )
+
 
 class FileInput:
 
-    def __init__( self, filename=None ):
+    #
+    #   'lexer', if given, maps a file's lines to their tokenized form
+    #   (see sourcecache.lexFile); 'lexed' then returns the tokens of the
+    #   line that 'nextLine' just returned.  'searchPath' is where
+    #   'include' looks after the including file's directory.
+    #
+    def __init__( self, filename=None, lexer=None, searchPath=() ):
         self.m_filenames = []
         self.m_lines = []
+        self.m_lexed = []
         self.m_lineIndices = []
+        self.m_lexer = lexer
+        self.m_searchPath = tuple( searchPath )
 
         if filename:
             self.push( filename )
 
     def push( self, filename ):
-        try:
-            lines = []
-            with open( filename ) as file:
-                for line in file:
-                    lines.append( line )
+        lines, lexed = readLines( filename, self.m_lexer )
+        self.pushLines( filename, lines, lexed )
 
-            self.m_filenames.append( filename )
-            self.m_lines.append( lines )
-            self.m_lineIndices.append( 0 )
+    #
+    #   Push the file an include of 'name' in the current file means
+    #
+    def include( self, name ):
+        includer = None
+        if len( self.m_filenames ) > 0:
+            includer = self.m_filenames[-1]
+
+        filename = resolve( name, includer, self.m_searchPath )
+        if filename == None:
+            raise Exception( str.format( "Can't open {0}", name ) )
+        self.push( filename )
+
+    #
+    #   Read 'lines' as the contents of 'filename' (they aren't run
+    #   through the lexer; 'lexed' is their tokens, if they're known)
+    #
+    def pushLines( self, filename, lines, lexed=None ):
+        self.m_filenames.append( filename )
+        self.m_lines.append( lines )
+        self.m_lexed.append( lexed )
+        self.m_lineIndices.append( 0 )
 
-        except:
-            raise Exception( str.format( "Can't open {0}", filename ) )
-            
 
     def nextLine( self ):
         if len( self.m_lineIndices ) == 0:
             return None
 
-        if self.m_lineIndices[-1] >= len( self.m_lines[-1] ):
+        lines = self.m_lines[-1]
+        lineIndex = self.m_lineIndices[-1]
+
+        if lineIndex >= len( lines ):
             self.pop()
             return self.nextLine()
 
-        lineIndex = self.m_lineIndices[-1]
         self.m_lineIndices[-1] = lineIndex + 1
 
-        return self.m_lines[-1][lineIndex]
+        return lines[lineIndex]
 
 
     def pop( self ):
         if len( self.m_lineIndices ) > 0:
             self.m_filenames.pop()
             self.m_lines.pop()
+            self.m_lexed.pop()
             self.m_lineIndices.pop()
 
 
+    def lexed( self ):
+        if len( self.m_lexed ) > 0 and self.m_lexed[-1] != None:
+            return self.m_lexed[-1][self.m_lineIndices[-1] - 1]
+        else:
+            return None
+
+
     def file( self ):
         if len( self.m_filenames ) > 0:
             return self.m_filenames[-1]
@@ -59,7 +229,94 @@ class FileInput:
             return 1
 
 
+    def depth( self ):
+        return len( self.m_filenames )
+
+
+    #
+    #   Where the line 'nextLine' just returned is, as [ ( filename, lines
+    #   before it )... ], outermost file first; 'resume' pushes the files
+    #   again and starts reading there
+    #
+    def position( self ):
+        result = zip( self.m_filenames, self.m_lineIndices )
+        if len( result ) > 0:
+            filename, lineIndex = result[-1]
+            result[-1] = ( filename, lineIndex - 1 )
+        return result
+
+
+    def resume( self, position ):
+        for filename, lineIndex in position:
+            self.push( filename )
+            self.m_lineIndices[-1] = lineIndex
+
+
+#
+#   Includes are found next to the including file, then on the search
+#   path; a file that hasn't changed is read once
+#
+def testIncludes():
+    import tempfile
+    import time
+
+    directory = tempfile.mkdtemp()
+    sub = os.path.join( directory, 'sub' )
+    lib = os.path.join( directory, 'lib' )
+    os.mkdir( sub )
+    os.mkdir( lib )
+
+    def write( filename, text ):
+        with open( filename, 'w' ) as file:
+            file.write( text )
+
+    main = os.path.join( sub, 'main.asm' )
+    write( main, "main\n" )
+    write( os.path.join( sub, 'a.inc' ), "sub a\n" )
+    write( os.path.join( lib, 'a.inc' ), "lib a\n" )
+    write( os.path.join( lib, 'b.inc' ), "lib b\n" )
+
+    clear()
+    clearStats()
+    try:
+        assert resolve( 'a.inc', main, ( lib, ) ) == os.path.join( sub, 'a.inc' )
+        assert resolve( 'b.inc', main, ( lib, ) ) == os.path.join( lib, 'b.inc' )
+        assert resolve( 'b.inc', main ) == None
+        assert resolve( 'b.inc', main, ( lib, ) ) == os.path.join( lib, 'b.inc' )
+        assert gPathHits == 1 and gPathMisses == 3
+
+        lexer = lambda lines: [ line.upper() for line in lines ]
+        for i in range( 2 ):
+            filer = FileInput( main, lexer, ( lib, ) )
+            filer.include( 'b.inc' )
+            assert filer.nextLine() == "lib b\n" and filer.lexed() == "LIB B\n"
+            assert filer.nextLine() == "main\n" and filer.file() == main
+        assert gFileHits == 2 and gFileMisses == 2
+
+        #   a change is noticed, and a file that's gone is looked for again
+        write( os.path.join( lib, 'b.inc' ), "lib b, again\n" )
+        os.utime( os.path.join( lib, 'b.inc' ), ( 0, time.time() + 10 ) )
+        os.remove( os.path.join( sub, 'a.inc' ) )
+        filer = FileInput( main, lexer, ( lib, ) )
+        filer.include( 'b.inc' )
+        filer.include( 'a.inc' )
+        assert filer.nextLine() == "lib a\n"
+        assert filer.nextLine() == "lib b, again\n"
+        assert gFileHits == 3 and gFileMisses == 4
+
+    finally:
+        clear()
+        clearStats()
+        for root in [ sub, lib ]:
+            for name in os.listdir( root ):
+                os.remove( os.path.join( root, name ) )
+            os.rmdir( root )
+        os.rmdir( directory )
+
+
 def test():
+    testIncludes()
+
     filer = FileInput()
     filer.push( 'fileinput.py' )
     filer.push( 'kasm.py' )
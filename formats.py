@@ -0,0 +1,180 @@
+#
+#   Output formats
+#
+#   Each writer takes an image.Image and a filename.  They all walk the
+#   image's written spans, so none of them looks at empty memory.
+#
+
+import os
+import mmap
+import binascii
+
+import image
+
+
+#
+#   Split the written spans into pieces of at most 'size' bytes
+#
+def chunks( spans, size ):
+    for start, end in spans:
+        while start < end:
+            yield start, min( start + size, end )
+            start += size
+
+
+#
+#   Lowest and highest+1 written addresses, or None
+#
+def extent( spans ):
+    if len( spans ) == 0:
+        return None
+    return spans[0][0], spans[-1][1]
+
+
+#   ----------------------------------------------------------------
+#   Intel HEX: ':' count, address, type, data, checksum
+#   ----------------------------------------------------------------
+
+def intelHexRecord( address, recordType, data ):
+    header = bytearray( [ len( data ), ( address >> 8 ) & 0xff, address & 0xff, recordType ] )
+    checksum = ( - ( sum( header ) + sum( data ) ) ) & 0xff
+    return str.format( ':{0}{1}{2:02X}\n',
+        binascii.hexlify( header ).upper(),
+        binascii.hexlify( data ).upper(),
+        checksum )
+
+
+def writeIntelHex( image, filename ):
+    with open( filename, 'wb' ) as file:
+        for start, end in chunks( image.spans(), 16 ):
+            file.write( intelHexRecord( start, 0, image.m_data[start:end] ) )
+        file.write( intelHexRecord( 0, 1, bytearray() ) )
+
+
+#   ----------------------------------------------------------------
+#   Motorola S-records (S19): S1 data records, then an S9
+#   ----------------------------------------------------------------
+
+def sRecord( recordType, address, data ):
+    header = bytearray( [ len( data ) + 3, ( address >> 8 ) & 0xff, address & 0xff ] )
+    checksum = ~( sum( header ) + sum( data ) ) & 0xff
+    return str.format( 'S{0}{1}{2}{3:02X}\n',
+        recordType,
+        binascii.hexlify( header ).upper(),
+        binascii.hexlify( data ).upper(),
+        checksum )
+
+
+def writeSRecords( image, filename ):
+    with open( filename, 'wb' ) as file:
+        for start, end in chunks( image.spans(), 16 ):
+            file.write( sRecord( 1, start, image.m_data[start:end] ) )
+        file.write( sRecord( 9, 0, bytearray() ) )
+
+
+#   ----------------------------------------------------------------
+#   Raw binary: from the lowest written byte to the highest, with
+#   unwritten bytes in between as zeros.  The file is sized first and
+#   filled through a mapping.
+#   ----------------------------------------------------------------
+
+def writeRange( file, image, start, end ):
+    offset = file.tell()
+    file.truncate( offset + end - start )
+    if end > start:
+        mapped = mmap.mmap( file.fileno(), 0 )
+        try:
+            mapped[offset:offset + end - start] = str( image.m_data[start:end] )
+        finally:
+            mapped.close()
+    file.seek( 0, os.SEEK_END )
+
+
+def writeBinary( image, filename ):
+    with open( filename, 'w+b' ) as file:
+        bounds = extent( image.spans() )
+        if bounds != None:
+            writeRange( file, image, bounds[0], bounds[1] )
+
+
+#   ----------------------------------------------------------------
+#   Commodore 64 .prg: load address, then the bytes (as for 'bin')
+#   ----------------------------------------------------------------
+
+def writePrg( image, filename ):
+    bounds = extent( image.spans() )
+    if bounds == None:
+        raise Exception( "Nothing to write" )
+
+    with open( filename, 'w+b' ) as file:
+        file.write( str( bytearray( [ bounds[0] & 0xff, bounds[0] >> 8 ] ) ) )
+        writeRange( file, image, bounds[0], bounds[1] )
+
+
+#   ----------------------------------------------------------------
+#   Atari .xex: $FFFF, then a segment (first and last address, then
+#   the bytes) for each written span
+#   ----------------------------------------------------------------
+
+def writeXex( image, filename ):
+    spans = image.spans()
+    if len( spans ) == 0:
+        raise Exception( "Nothing to write" )
+
+    with open( filename, 'wb' ) as file:
+        file.write( '\xff\xff' )
+        for start, end in spans:
+            last = end - 1
+            file.write( str( bytearray( [ start & 0xff, start >> 8, last & 0xff, last >> 8 ] ) ) )
+            file.write( str( image.m_data[start:end] ) )
+
+
+def test():
+    import tempfile
+
+    memory = image.Image()
+    memory.writeBlock( 0x1000, 'ABC' )
+    memory.writeBlock( 0x1010, bytearray( range( 20 ) ) )
+
+    fd, filename = tempfile.mkstemp()
+    os.close( fd )
+
+    def written():
+        with open( filename, 'rb' ) as file:
+            return file.read()
+
+    try:
+        writeIntelHex( memory, filename )
+        assert written().split( '\n' ) == [
+            ':0310000041424327',
+            ':10101000000102030405060708090A0B0C0D0E0F58',
+            ':041020001011121386',
+            ':00000001FF',
+            '' ]
+
+        writeSRecords( memory, filename )
+        assert written().split( '\n' ) == [
+            'S106100041424323',
+            'S1131010000102030405060708090A0B0C0D0E0F54',
+            'S10710201011121382',
+            'S9030000FC',
+            '' ]
+
+        writeBinary( memory, filename )
+        assert written() == 'ABC' + '\0' * 13 + str( bytearray( range( 20 ) ) )
+
+        writePrg( memory, filename )
+        assert written() == '\x00\x10ABC' + '\0' * 13 + str( bytearray( range( 20 ) ) )
+
+        writeXex( memory, filename )
+        assert written() == ( '\xff\xff' + '\x00\x10\x02\x10ABC'
+            + '\x10\x10\x23\x10' + str( bytearray( range( 20 ) ) ) )
+
+        writeBinary( image.Image(), filename )
+        assert written() == ''
+    finally:
+        os.remove( filename )
+
+
+if __name__ == '__main__':
+    test()
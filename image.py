@@ -0,0 +1,154 @@
+#
+#   64K memory image
+#
+#   The bytes are kept in one bytearray, and a second bytearray marks
+#   which of them have been written (unwritten bytes read as None, and
+#   are zero in m_data).  Finding the written parts of the image is a
+#   'find' on the marks, so walking a small program doesn't cost a scan
+#   of the whole address space in Python.
+#
+
+SIZE = 0x10000
+
+
+class Image( object ):
+
+    __slots__ = ( 'm_data', 'm_written' )
+
+    def __init__( self ):
+        self.m_data = bytearray( SIZE )
+        self.m_written = bytearray( SIZE )
+
+    def write( self, addr, byte ):
+        self.m_data[addr] = byte
+        self.m_written[addr] = 1
+
+    def writeBlock( self, addr, data ):
+        end = addr + len( data )
+        self.m_data[addr:end] = data
+        self.m_written[addr:end] = '\x01' * len( data )
+
+    def isWritten( self, addr ):
+        return self.m_written[addr] != 0
+
+    #
+    #   image[addr] ==> byte, or None if it hasn't been written
+    #   image[start:end] ==> [byte or None...]
+    #
+    def __getitem__( self, index ):
+        if isinstance( index, slice ):
+            return [ self[i] for i in xrange( *index.indices( SIZE ) ) ]
+
+        if self.m_written[index]:
+            return self.m_data[index]
+        else:
+            return None
+
+    def __eq__( self, other ):
+        return self.m_data == other.m_data and self.m_written == other.m_written
+
+    def __ne__( self, other ):
+        return not self == other
+
+    def copy( self ):
+        result = Image()
+        result.m_data[:] = self.m_data
+        result.m_written[:] = self.m_written
+        return result
+
+    #
+    #   Runs of written bytes, in address order, as [ ( start, end )... ]
+    #
+    def spans( self ):
+        result = []
+        written = self.m_written
+        start = written.find( '\x01' )
+        while start >= 0:
+            end = written.find( '\x00', start )
+            if end < 0:
+                end = SIZE
+            result.append( ( start, end ) )
+            start = written.find( '\x01', end )
+        return result
+
+    #
+    #   Start addresses of the 'size'-aligned windows that hold at least
+    #   one written byte
+    #
+    def windows( self, size ):
+        result = []
+        following = 0
+        for start, end in self.spans():
+            window = max( start - start % size, following )
+            while window < end:
+                result.append( window )
+                window += size
+            following = window
+        return result
+
+
+#
+#   Where two images differ (in a byte, or in whether it was written),
+#   as [ ( start, end )... ].  Equal blocks are skipped a block at a
+#   time; only blocks that differ are looked at byte by byte.
+#
+BLOCK = 256
+
+def differences( a, b ):
+    result = []
+    if a == b:
+        return result
+
+    start = None
+    for block in xrange( 0, SIZE, BLOCK ):
+        end = block + BLOCK
+        if a.m_data[block:end] == b.m_data[block:end] and a.m_written[block:end] == b.m_written[block:end]:
+            if start != None:
+                result.append( ( start, block ) )
+                start = None
+            continue
+
+        for i in xrange( block, end ):
+            same = a.m_data[i] == b.m_data[i] and a.m_written[i] == b.m_written[i]
+            if same and start != None:
+                result.append( ( start, i ) )
+                start = None
+            elif not same and start == None:
+                start = i
+
+    if start != None:
+        result.append( ( start, SIZE ) )
+    return result
+
+
+def test():
+    image = Image()
+    assert image.spans() == [] and image.windows( 16 ) == []
+
+    image.write( 0x10, 0xaa )
+    image.write( 0x11, 0xbb )
+    image.write( 0x1f, 0xcc )
+    image.write( 0x20, 0x00 )
+    image.write( 0xffff, 0x01 )
+
+    assert image[0x10] == 0xaa and image[0x12] == None and image[0x20] == 0
+    assert image[0x0f:0x13] == [ None, 0xaa, 0xbb, None ]
+    assert image.spans() == [ ( 0x10, 0x12 ), ( 0x1f, 0x21 ), ( 0xffff, 0x10000 ) ]
+    assert image.windows( 16 ) == [ 0x10, 0x20, 0xfff0 ]
+    assert image.windows( 32 ) == [ 0x00, 0x20, 0xffe0 ]
+
+    image.writeBlock( 0x30, 'ab' )
+    assert image[0x2f:0x33] == [ None, 0x61, 0x62, None ]
+
+    copy = image.copy()
+    assert copy == image and differences( copy, image ) == []
+    copy.write( 0x12, 0 )
+    copy.write( 0x10, 0xab )
+    copy.writeBlock( 0xfe, 'xyz' )
+    copy.write( 0xffff, 0x02 )
+    assert copy != image
+    assert differences( copy, image ) == [ ( 0x10, 0x11 ), ( 0x12, 0x13 ), ( 0xfe, 0x101 ), ( 0xffff, 0x10000 ) ]
+
+
+if __name__ == '__main__':
+    test()
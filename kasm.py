@@ -5,18 +5,29 @@
 #
 
 import sys
+import os
+import gc
+import tempfile
 
 import tok
 import eval
 import fileinput
+import formats
+import image
+import kim1
+import sourcecache
 import symbols
 import traceback
 import re
-
-
-gListingFile = None
-gInput = None
-gPriorFile = None
+import multiprocessing
+import StringIO
+import mmap
+import binascii
+import bisect
+import threading
+import time
+import contextlib
+import shutil
 
 
 #
@@ -120,120 +131,110 @@ gOps = {
 }
 
 
-gLoc = 0
-
-
 #   ----------------------------------------------------------------
 #   Pseudo ops
+#
+#   Each pseudo op has a 'parse' function, run once when the line is
+#   read in phase 0, that turns the rest of the line into an argument
+#   for the 'handler' (an Assembler method), which is run in every
+#   phase.  'scope' is the scope local symbols in the line belong to.
 #   ----------------------------------------------------------------
 
-def fn_org( tokenizer, phaseNumber ):
-    global gLoc
-    org = eval.Expression( tokenizer ).eval()
-    if org == None:
-        raise Exception( "Undefined expression" )
-    gLoc = org
+def parse_expr( tokenizer, scope ):
+    return eval.internExpression( tokenizer, scope )
+
 
+#
+#   db / dw argument lists ==> [ string-number-or-Expression ... ]
+#
+#   (a number on its own is kept as a number; tables of them are common,
+#   and there's nothing to gain from parsing or caching them)
+#
+def parse_data( tokenizer, scope ):
+    items = []
 
-def fn_db( tokenizer, phaseNumber ):
     while not tokenizer.atEnd():
 
         if tokenizer.curTok() == tok.STRING:
-
-            s = tokenizer.curValue()
-            for c in s:
-                depositByte( ord( c ) )
-
+            items.append( tokenizer.curValue() )
+            tokenizer.advance()
+        elif tokenizer.curTok() == tok.NUMBER and ( tokenizer.peek( 1 ) == ',' or tokenizer.peek( 1 ) == None ):
+            items.append( tokenizer.curValue() )
             tokenizer.advance()
-
         else:
-
-            expr = eval.Expression( tokenizer )
-
-            value = expr.eval()
-            if phaseNumber > 0:
-                if value > 0xff or value < -128:
-                    raise Exception( "value too large for a byte" )
-                depositByte( value )
-
-            else:
-                depositByte( 0 )
+            items.append( eval.internExpression( tokenizer, scope ) )
 
         if tokenizer.curTok() != ',':
             break
         else:
             tokenizer.advance()
 
+    return items
 
-def fn_dw( tokenizer, phaseNumber ):
-
-    while not tokenizer.atEnd():
-
-        if tokenizer.curTok() == tok.STRING:
-
-            s = tokenizer.curValue()
-            for c in s:
-                depositWord( ord( c ) )
-
-            tokenizer.advance()
-
-        else:
-
-            expr = eval.Expression( tokenizer )
 
-            value = expr.eval()
-            if phaseNumber > 0:
-                depositWord( value )
+def checkByte( value ):
+    if value > 0xff or value < -128:
+        raise Exception( "value too large for a byte" )
 
-            else:
-                depositWord( 0 )
 
-        if tokenizer.curTok() != ',':
-            break
-        else:
-            tokenizer.advance()
+#
+#   ds count[, fill] ==> ( count, fill-or-None )
+#
+def parse_ds( tokenizer, scope ):
+    count = eval.internExpression( tokenizer, scope )
+    fill = None
 
+    if tokenizer.curTok() == ',':
+        tokenizer.advance()
+        fill = eval.internExpression( tokenizer, scope )
 
-def fn_ds( tokenizer, phaseNumber ):
-    global gLoc
-    
-    value = eval.Expression( tokenizer ).eval()
-    if value == None:
-        raise Exception( "Undefined expression" )
-    gLoc += value
+    return count, fill
 
 
-def fn_include( tokenizer, phaseNumber ):
+def parse_include( tokenizer, scope ):
 
     if tokenizer.curTok() == tok.STRING or tokenizer.curTok() == tok.SYMBOL:
-        gInput.push( tokenizer.curValue() )
+        filename = tokenizer.curValue()
         tokenizer.advance()
+        return filename
     else:
         raise Exception( "Expected filename" )
 
 
-gPsuedoOps = {
-    'org':      fn_org,
-    'db':       fn_db,
-    'dw':       fn_dw,
-    'ds':       fn_ds,
-    'include':  fn_include
-}
+#
+#   incbin "file"[, offset[, length]]
+#
+#   The file is mapped (once per assembly; both phases share it) and the
+#   range is copied straight into the image.  Only the first few bytes
+#   are listed.
+#
+def parse_incbin( tokenizer, scope ):
+    filename = parse_include( tokenizer, scope )
+    offset = None
+    length = None
+
+    if tokenizer.curTok() == ',':
+        tokenizer.advance()
+        offset = eval.internExpression( tokenizer, scope )
 
+        if tokenizer.curTok() == ',':
+            tokenizer.advance()
+            length = eval.internExpression( tokenizer, scope )
+
+    return filename, offset, length
 
 
 #
 #   parseAddressingMode ==> addrMode, expressionObject
 #
-
-def parseAddressingMode( tokenizer ):
+def parseAddressingMode( tokenizer, scope ):
 
     if tokenizer.atEnd():
         return IMPLIED, None
 
     if tokenizer.curTok() == '#':
         tokenizer.advance()
-        expr = eval.Expression( tokenizer )
+        expr = eval.internExpression( tokenizer, scope )
         return IMMED, expr
 
     #
@@ -244,7 +245,7 @@ def parseAddressingMode( tokenizer ):
     #
     if tokenizer.curTok() == '(':
         tokenizer.advance()
-        expr = eval.Expression( tokenizer )
+        expr = eval.internExpression( tokenizer, scope )
 
         #   (expr,x)
         if tokenizer.curTok() == ',':
@@ -280,7 +281,7 @@ def parseAddressingMode( tokenizer ):
     #   n,y
     #
 
-    expr = eval.Expression( tokenizer )
+    expr = eval.internExpression( tokenizer, scope )
 
     if tokenizer.curTok() == ',':
         tokenizer.advance()
@@ -298,433 +299,2626 @@ def parseAddressingMode( tokenizer ):
     return UNDECIDED, expr
 
 
+def relativeOffset( value, addr ):
+    fromLoc = addr + 1
+    delta = value - fromLoc
+
+    if delta < -128 or delta > 127:
+        raise Exception( str.format( "relative reference out of range ({0} bytes)", delta ) )
+    return delta
+
+
+#   ABS forms, and the shorter forms they'd be if the operand were < 0x100
+gZeroPageForm = {
+    ABS: ZP,
+    ABSX: ZPX,
+    ABSY: ZPY
+    }
+
+
+#   indexed forms only save a cycle for stores and read-modify-write (--optimize)
+gIndexedWriteOps = { 'sta': True, 'asl': True, 'dec': True, 'inc': True, 'lsr': True, 'rol': True, 'ror': True }
+
+
 #   ----------------------------------------------------------------
-#   Image construction
+#   Fixups (--one-pass)
+#
+#   In one-pass mode phase 0 is the only pass.  An operand that can't be
+#   evaluated yet is deposited as zero and recorded as a fixup, and the
+#   fixups are patched into the image at the end.  If a fixup's value
+#   would have changed the size of its instruction (an ABS that could
+#   have been ZP) the image is made the usual way, with phase 1.
 #   ----------------------------------------------------------------
 
+FIXUP_BYTE = 0          # instruction operand byte
+FIXUP_WORD = 1          # instruction operand word
+FIXUP_REL = 2           # branch offset
+FIXUP_DB = 3            # db value
+FIXUP_DW = 4            # dw value
+
+gFixupKind = {
+    IMMED: FIXUP_BYTE,
+    ABS: FIXUP_WORD,
+    ZP: FIXUP_BYTE,
+    ABSX: FIXUP_WORD,
+    ABSY: FIXUP_WORD,
+    IND: FIXUP_WORD,
+    REL: FIXUP_REL,
+    ZPX: FIXUP_BYTE,
+    ZPY: FIXUP_BYTE,
+    INDX: FIXUP_BYTE,
+    INDY: FIXUP_BYTE
+    }
+
+
+class Fixup( object ):
 
-gMemory = [None] * 65536
-gThisLine = []
+    __slots__ = ( 'm_addr', 'm_kind', 'm_expr', 'm_lineLoc', 'm_record', 'm_resizes' )
 
+    def __init__( self, addr, kind, expr, lineLoc, record, resizes ):
+        self.m_addr = addr
+        self.m_kind = kind
+        self.m_expr = expr
+        self.m_lineLoc = lineLoc
+        self.m_record = record
+        self.m_resizes = resizes
 
-def clearLineBytes():
-    global gThisLine
-    gThisLine = []
 
+#
+#   A line of input, parsed once in phase 0 and replayed in later phases
+#
+#       m_equate        SYMBOL of 'SYMBOL = expression' (m_expr is the expression)
+#       m_label         SYMBOL of 'SYMBOL:'
+#       m_op            instruction or psuedo-op name
+#       m_addrMode      instruction addressing mode (m_expr is the operand)
+#       m_args          psuedo-op argument, from its 'parse' function
+#       m_loc           location counter at the start of the line
+#       m_size          number of bytes the line deposited
+#       m_forward       (--optimize) operand was a forward reference
+#       m_long          (--optimize) instruction has to use its ABS form
+#
+class LineRecord( object ):
+
+    __slots__ = ( 'm_file', 'm_line', 'm_text', 'm_equate', 'm_label', 'm_op', 'm_addrMode', 'm_expr', 'm_args',
+        'm_loc', 'm_size', 'm_forward', 'm_long' )
 
-def depositByte( byte ):
-    global gLoc, gThisLine
+    def __init__( self, file, line, text ):
+        self.m_file = file
+        self.m_line = line
+        self.m_text = text
+        self.m_equate = None
+        self.m_label = None
+        self.m_op = None
+        self.m_addrMode = None
+        self.m_expr = None
+        self.m_args = None
+        self.m_loc = 0
+        self.m_size = 0
+        self.m_forward = False
+        self.m_long = False
 
-    if byte == None:
-        byte = 0
 
-    #xxx print "DEP ", gLoc, byte
-    gMemory[gLoc] = byte & 0xff
-    gThisLine.append( byte & 0xff )
-    gLoc += 1
-    if gLoc >= 0x10000:
-        gLoc = 0
+def location( rec ):
+    if rec == None:
+        return "(unknown)"
+    return str.format( "{0}({1})", rec.m_file, rec.m_line )
 
 
-def depositWord( word ):
+#
+#   The assembler's state where the input moves into an included file or
+#   back out of one (see Assembler.reassemble).  Only what the records since
+#   the previous boundary changed is kept, so that the boundaries of a big
+#   project cost about what its records do; the state at a boundary is the
+#   boundaries up to it applied in order.
+#
+#       m_index         records before the boundary
+#       m_position      where reading starts again (FileInput.position)
+#       m_loc           location counter
+#       m_scope         scope for local labels
+#       m_symbols       { name: Symbol } phase 0 defined since the previous boundary
+#       m_memory        [ ( address, bytes )... ] phase 1 wrote since then
+#       m_overlaps      ( phase 1's overlap list, its length, a copy of its last entry )
+#       m_wraps         ( phase 1's wrap list, its length )
+#       m_shadowed      the overwritten bytes so far
+#       m_redefined     { name: Symbol } phase 1 defined again (equates) since then
+#
+#   (m_memory is None until phase 1 has got as far as the boundary.  The
+#   overlap and wrap lists are only ever appended to, apart from the last
+#   overlap growing, and clearMemory makes new ones.)
+#
+class Boundary( object ):
 
-    if word == None:
-        word = 0
+    __slots__ = ( 'm_index', 'm_position', 'm_loc', 'm_scope', 'm_symbols', 'm_memory', 'm_overlaps', 'm_wraps',
+        'm_shadowed', 'm_redefined' )
 
-    depositByte( word )
-    depositByte( word >> 8 )
+    def __init__( self, index, position, loc, scope, symbols ):
+        self.m_index = index
+        self.m_position = position
+        self.m_loc = loc
+        self.m_scope = scope
+        self.m_symbols = symbols
+        self.m_memory = None
+        self.m_overlaps = None
+        self.m_wraps = None
+        self.m_shadowed = None
+        self.m_redefined = None
 
 
 #   ----------------------------------------------------------------
-#   Assembly
+#   The cyclic collector
+#
+#   The records are long-lived; an assembly turns the collector off so
+#   it doesn't keep rescanning them while they're being built.  The
+#   collector is the whole process's, and Assemblers can run at once,
+#   so it is off while any of them wants it off, and back on (if it was
+#   on to begin with) when the last is done.
 #   ----------------------------------------------------------------
 
-def depositImpliedArg( expr, value ):
-    pass
+gCollectorLock = threading.Lock()
+gCollectorPauses = 0                    # assemblies that have the collector off
+gCollectorWasOn = False
 
-def depositByteArg( expr, value ):
-    depositByte( value )
 
-def depositAbsArg( expr, value ):
-    depositWord( value )
+def pauseCollector():
+    global gCollectorPauses, gCollectorWasOn
+    with gCollectorLock:
+        if gCollectorPauses == 0:
+            gCollectorWasOn = gc.isenabled()
+            gc.disable()
+        gCollectorPauses += 1
 
-def depositRelArg( expr, value ):
-    global gLoc
 
-    if value != None:
-        fromLoc = gLoc + 1
-        delta = value - fromLoc
+def resumeCollector():
+    global gCollectorPauses
+    with gCollectorLock:
+        gCollectorPauses -= 1
+        if gCollectorPauses == 0 and gCollectorWasOn:
+            gc.enable()
 
-        if delta < -128 or delta > 127:
-            raise Exception( str.format( "relative reference out of range ({0} bytes)", delta ) )
-        depositByte( delta )
 
-    else:
+#   ----------------------------------------------------------------
+#   The assembler
+#
+#   Everything an assembly changes (the location counter, the image,
+#   the symbols, the records...) is in an Assembler, so one can be used
+#   over and over, and several can be used at once (from threads, say):
+#
+#       asm = Assembler()
+#       if asm.assembleString( "        lda #1\n" ):
+#           asm.m_memory[0:2]   ==> [ 0xa9, 0x01 ]
+#       asm.m_messages          ==> errors and warnings, as kasm prints them
+#
+#   The options (--one-pass, --optimize, --passes, --no-cache, -I) are
+#   given when it's made; an 'incremental' Assembler can reassemble a
+#   file after some of its sources change (see reassemble).
+#   ----------------------------------------------------------------
 
-        depositByte( 0 )
-    
+class Assembler( object ):
+
+    def __init__( self, onePass=False, optimize=False, passLimit=16, useCache=True, incremental=False,
+            searchPath=() ):
+        self.m_onePass = onePass
+        self.m_optimize = optimize
+        self.m_passLimit = passLimit
+        self.m_useCache = useCache          # tokenized sources come from sourcecache
+        self.m_incremental = incremental
+        self.m_searchPath = tuple( searchPath )     # where includes are looked for (see fileinput.resolve)
+
+        self.m_symbols = symbols.SymbolTable()
+        self.m_input = None
+        self.m_loc = 0
+        self.m_lineLoc = 0                  # location counter at the start of the current line; the value of '*'
+        self.m_memory = image.Image()
+        self.m_thisLine = []
+        self.m_lineUnlisted = 0             # bytes deposited on this line but not in m_thisLine
+        self.m_records = []
+        self.m_record = None
+        self.m_reading = False
+        self.m_binaries = {}                # incbin filename ==> mmap (or '' for an empty file)
+        self.m_overlaps = []                # [ [ record, first address, last address, earlier record ]... ]
+        self.m_wraps = []                   # [ record... ]
+        self.m_checkOverlaps = False        # (only the pass that makes the final image notes overlaps)
+        self.m_sizing = False               # sizes can still change (--optimize's phase 0): don't range check branches
+        self.m_writers = None               # address ==> the record that last deposited it (see writerOf)
+        self.m_shadowed = {}                # record ==> { address: byte it deposited that a later line overwrote }
+        self.m_fixups = None                # [ Fixup... ] while making a one-pass image
+        self.m_pendingEquates = None        # [ LineRecord... ] of equates not yet defined
+        self.m_messages = []                # "Error: ..." and "Warning: ..." lines
+
+        self.m_filename = None              # the file assembleFile was given
+        self.m_boundaries = None            # [ Boundary... ] (incremental, two passes)
+        self.m_readValues = None            # { name: value } of the symbols phase 0 defined
+        self.m_readFrom = 0                 # records reassemble kept from the last assembly,
+        self.m_replayFrom = 0               # and how many of those phase 1 didn't redo
+
+        self.m_fixupCount = 0
+        self.m_resizeCount = 0
+        self.m_sizingPasses = 0
+        self.m_bytesSaved = 0
+        self.m_cyclesSaved = 0
 
-gDepositDispatch = {
-    IMPLIED: depositImpliedArg,
-    IMMED: depositByteArg,
-    ABS: depositAbsArg,
-    ZP: depositByteArg,
-    ABSX: depositAbsArg,
-    ABSY: depositAbsArg,
-    IND: depositAbsArg,
-    REL: depositRelArg,
-    ZPX: depositByteArg,
-    ZPY: depositByteArg,
-    INDX: depositByteArg,
-    INDY: depositByteArg
-    }
+
+    #
+    #   An expression's value on the current line, or None
+    #
+    def value( self, expr ):
+        return expr.eval( self.m_symbols, self.m_lineLoc )
 
 
-def assembleInstruction( op, tokenizer, phaseNumber ):
-    addrMode, expr = parseAddressingMode( tokenizer )
+    #   ----------------------------------------------------------------
+    #   Pseudo op handlers (see gPsuedoOps)
+    #   ----------------------------------------------------------------
+
+    def fn_org( self, expr, phaseNumber ):
+        org = self.value( expr )
+        if org == None:
+            raise Exception( "Undefined expression" )
+        self.m_loc = org
+
+
+    def evalItem( self, item ):
+        if isinstance( item, eval.Expression ):
+            return self.value( item )
+        else:
+            return item
 
-    value = None
-    if expr != None:
-        value = expr.eval()
-        
-    if phaseNumber > 0 and value == None and addrMode != IMPLIED:
-        raise Exception( "Undefined expression" )
 
     #
-    #   Translate UNDECIDED into various forms of REL / ZP / ABS
+    #   db and dw build the line's bytes and deposit them in one go
     #
-    if not addrMode in gOps[op]:
+    def fn_db( self, items, phaseNumber ):
+        data = bytearray()
 
-        if addrMode == UNDECIDED:
+        for item in items:
 
-            if REL in gOps[op]:
-                addrMode = REL
-            elif ZP in gOps[op] and value != None and value < 0x100:
-                addrMode = ZP
-            else:
-                addrMode = ABS
+            if isinstance( item, str ):
 
-        elif addrMode == UNDECIDED_X:
+                data += item
 
-            if ZPX in gOps[op] and value != None and value < 0x100:
-                addrMode = ZPX
             else:
-                addrMode = ABSX
 
-        elif addrMode == UNDECIDED_Y:
+                value = self.evalItem( item )
+                if value == None and phaseNumber == 0:
+                    self.addFixup( FIXUP_DB, item, addr=self.m_loc + len( data ) )
+                elif phaseNumber > 0 or self.m_fixups != None:
+                    checkByte( value )
 
-            if ZPY in gOps[op] and value != None and value < 0x100:
-                addrMode = ZPY
-            else:
-                addrMode = ABSY
+                if value == None:
+                    value = 0
+                data.append( value & 0xff )
 
-    if addrMode in gOps[op]:
+        self.depositBytes( data )
 
-        depositByte( gOps[op][addrMode] )
-        gDepositDispatch[addrMode]( expr, value )
 
-    else:
+    def fn_dw( self, items, phaseNumber ):
+        data = bytearray()
 
-        raise Exception( "Bad addressing mode for instruction" )
+        for item in items:
 
+            if isinstance( item, str ):
 
-def generateListingLine( line ):
-    global gListingFile, gPriorFile
+                for c in item:
+                    data.append( ord( c ) )
+                    data.append( 0 )
 
-    if gInput.file() != gPriorFile:
-        gListingFile.write( str.format( "File {0}\n", gInput.file() ) )
-        gPriorFile = gInput.file()
+            else:
 
-    prefix = str.format( "{0:5}: ", gInput.line() )
-    baseAddr = gLoc - len( gThisLine )
+                value = self.evalItem( item )
+                if value == None and phaseNumber == 0:
+                    self.addFixup( FIXUP_DW, item, addr=self.m_loc + len( data ) )
 
-    if len( gThisLine ) > 0:
-        i = 0
-        while i < len( gThisLine ):
-            n = len( gThisLine ) - i
-            if n > 8:
-                n = 8
+                if value == None:
+                    value = 0
+                data.append( value & 0xff )
+                data.append( ( value >> 8 ) & 0xff )
 
-            s, ascii = dump( gThisLine, i, i + n )
+        self.depositBytes( data )
 
-            if i == 0:
-                gListingFile.write( str.format( "{0} {1:04X}  {2:30} {3}", prefix, baseAddr + i, s, line ) )
-            else:
-                gListingFile.write( str.format( "{0} {1:04X}  {2:10}\n", prefix, baseAddr + i, s ) )
 
-            i += n
+    #
+    #   Without a fill value, ds just moves the location counter
+    #
+    def fn_ds( self, args, phaseNumber ):
+        count, fill = args
+        value = self.value( count )
+        if value == None:
+            raise Exception( "Undefined expression" )
+
+        if fill == None:
+            self.m_loc += value
+            return
 
-    else:
+        fillValue = self.value( fill )
+        if fillValue == None:
+            raise Exception( "Undefined expression" )
+        checkByte( fillValue )
+        if value < 0:
+            raise Exception( "Negative ds count" )
 
-        gListingFile.write( str.format( "{0} {1:30} {2}", prefix, "", line ) )
+        self.depositBytes( bytearray( [ fillValue & 0xff ] ) * value )
 
 
-#
-#   Handle a line of assembly input
-#
-#   Phase 0:    just intern stuff
-#   Phase 1:    emit stuff (expressions required to be defined)
-#
-def assembleLine( line, phaseNumber=0 ):
-    global gLoc
-    
-    clearLineBytes()
-    tokenizer = tok.Tokenizer( line )
+    def fn_include( self, filename, phaseNumber ):
+
+        #   the included lines are recorded as phase 0 reads them,
+        #   so later passes have nothing to do here
+        if self.m_reading:
+            self.m_input.include( filename )
+
 
     #
-    #   Set '*' psuedo-symbol at the start of each line
+    #   (each pass opens it; reading the source counts as the lookup)
     #
-    symbols.set( '*', gLoc )
+    def openBinary( self, name ):
+        filename = fileinput.resolve( name, self.m_record.m_file, self.m_searchPath, self.m_reading )
+        if filename == None:
+            raise Exception( str.format( "Can't open {0}", name ) )
+        if filename in self.m_binaries:
+            return self.m_binaries[filename]
+
+        try:
+            with open( filename, 'rb' ) as file:
+                if os.fstat( file.fileno() ).st_size > 0:
+                    contents = mmap.mmap( file.fileno(), 0, access=mmap.ACCESS_READ )
+                else:
+                    contents = ''
+        except:
+            raise Exception( str.format( "Can't open {0}", filename ) )
+
+        self.m_binaries[filename] = contents
+        return contents
+
+
+    def closeBinaries( self ):
+        for contents in self.m_binaries.values():
+            if contents != '':
+                contents.close()
+        self.m_binaries = {}
+
+
+    def fn_incbin( self, args, phaseNumber ):
+        filename, offsetExpr, lengthExpr = args
+        contents = self.openBinary( filename )
+
+        offset = 0
+        if offsetExpr != None:
+            offset = self.value( offsetExpr )
+            if offset == None:
+                raise Exception( "Undefined expression" )
+
+        length = len( contents ) - offset
+        if lengthExpr != None:
+            length = self.value( lengthExpr )
+            if length == None:
+                raise Exception( "Undefined expression" )
+
+        if offset < 0 or length < 0 or offset + length > len( contents ):
+            raise Exception( str.format( "incbin range is outside {0} ({1} bytes)", filename, len( contents ) ) )
+
+        self.depositBytes( contents[offset:offset + length], gPsuedoOps['incbin']['listed'] )
+
+
+    #   ----------------------------------------------------------------
+    #   Image construction
+    #   ----------------------------------------------------------------
 
     #
-    #   SYMBOL = VALUE
+    #   (overlaps and wraps are about the image being built, so they go too)
     #
-    if tokenizer.curTok() == tok.SYMBOL and tokenizer.peek(1) == '=':
-        sym = tokenizer.curValue()
-        tokenizer.advance( 2 )
-        expr = eval.Expression( tokenizer )
-        if not tokenizer.atEnd():
-            raise Exception( "Bad expression (extra gunk)" )
+    def clearMemory( self ):
+        self.m_memory = image.Image()
+        self.m_overlaps = []
+        self.m_wraps = []
+        self.m_writers = None
+        self.m_shadowed = {}
+
+
+    def depositByte( self, byte ):
+        if byte == None:
+            byte = 0
+
+        #xxx print "DEP ", self.m_loc, byte
+        loc = self.m_loc
+        memory = self.m_memory
+        if memory.m_written[loc] and self.m_checkOverlaps:
+            self.noteOverlap( loc, 1 )
+        if self.m_writers != None:
+            self.m_writers[loc] = self.m_record
+        memory.write( loc, byte & 0xff )
+        self.m_thisLine.append( byte & 0xff )
+        loc += 1
+        if loc >= 0x10000:
+            loc = 0
+            self.noteWrap()
+        self.m_loc = loc
 
-        value = expr.eval()
 
-        if phaseNumber > 0 and value == None:
-            raise Exception( str.format( "Undefined expression" ) )
-        
-        symbols.set( sym, expr.eval() )
+    #
+    #   Deposit a bytearray (or string) with one copy into the image,
+    #   wrapping at the top of memory the way depositByte does.  Only the
+    #   first 'listed' bytes are kept for the listing, if that's given.
+    #
+    def depositBytes( self, data, listed=None ):
+        if self.m_loc < 0 or self.m_loc > 0xffff:
+            raise Exception( "location counter out of range" )
 
-        if gListingFile != None and phaseNumber > 0:
-            generateListingLine( line )
+        if listed == None or len( data ) <= listed:
+            self.m_thisLine.extend( bytearray( data ) )
+        else:
+            self.m_thisLine.extend( bytearray( data[:listed] ) )
+            self.m_lineUnlisted += len( data ) - listed
+
+        written = self.m_memory.m_written
+        while len( data ) > 0:
+            loc = self.m_loc
+            n = min( len( data ), 0x10000 - loc )
+            first = -1
+            if self.m_checkOverlaps:
+                first = written.find( '\x01', loc, loc + n )
+            while first >= 0:
+                last = written.find( '\x00', first, loc + n )
+                if last < 0:
+                    last = loc + n
+                self.noteOverlap( first, last - first )
+                first = written.find( '\x01', last, loc + n )
+
+            if self.m_writers != None:
+                self.m_writers[loc:loc + n] = [ self.m_record ] * n
+            self.m_memory.writeBlock( loc, data[:n] )
+            data = data[n:]
+            self.m_loc += n
+            if self.m_loc >= 0x10000:
+                self.m_loc = 0
+                self.noteWrap()
+
+
+    def depositWord( self, word ):
+
+        if word == None:
+            word = 0
+
+        self.depositByte( word )
+        self.depositByte( word >> 8 )
+
+
+    #   ----------------------------------------------------------------
+    #   Overlaps and wraps
+    #
+    #   Writing a byte that is already in the image, or running the
+    #   location counter past $FFFF, is reported (as a warning) once the
+    #   file is assembled, with the line that did it and, for an overlap,
+    #   the line that wrote the byte first.  The bytes an overwritten line
+    #   deposited are kept (m_shadowed) for its line in the listing.
+    #
+    #   Only the pass that makes the final image (phase 1, or phase 0 of a
+    #   one-pass assembly) looks for them.  Who wrote each address isn't
+    #   kept until the first overlap: then m_writers is made from the
+    #   records so far, and the deposits after that keep it up to date.
+    #   ----------------------------------------------------------------
 
-        return
-        
     #
-    #   handle SYMBOL: at start of line
-    #   NOTE: could enforce leadingWhitespace, but we have a ':'
-    #   instead of that.
+    #   The last record to have deposited 'addr'
     #
-    if tokenizer.curTok() == tok.SYMBOL and tokenizer.peek(1) == ':':
-        sym = tokenizer.curValue()
-        tokenizer.advance( 2 )
+    def writerOf( self, addr ):
+        if self.m_writers == None:
+            writers = [ None ] * image.SIZE
+            for rec in self.m_records:
+                if rec is self.m_record:
+                    break
+                loc = rec.m_loc
+                size = min( rec.m_size, image.SIZE )
+                end = min( loc + size, image.SIZE )
+                writers[loc:end] = [ rec ] * ( end - loc )
+                writers[0:loc + size - end] = [ rec ] * ( loc + size - end )
+            self.m_writers = writers
+
+        return self.m_writers[addr]
+
+
+    def noteOverlap( self, addr, n ):
+        data = self.m_memory.m_data
+        for a in xrange( addr, addr + n ):
+            writer = self.writerOf( a )
+            if writer != None:
+                self.m_shadowed.setdefault( writer, {} )[a] = data[a]
+
+        if len( self.m_overlaps ) > 0:
+            last = self.m_overlaps[-1]
+            if last[0] is self.m_record and last[2] + 1 == addr and self.writerOf( addr ) is last[3]:
+                last[2] = addr + n - 1
+                return
+
+        self.m_overlaps.append( [ self.m_record, addr, addr + n - 1, self.writerOf( addr ) ] )
+
+
+    def noteWrap( self ):
+        self.m_wraps.append( self.m_record )
+
+
+    def warnings( self ):
+        result = []
+        for rec, first, last, writer in self.m_overlaps:
+            if first == last:
+                where = str.format( "${0:04X}", first )
+            else:
+                where = str.format( "${0:04X}-${1:04X}", first, last )
+            result.append( str.format( "Warning: {0}: overwrites {1}, written by {2}", location( rec ), where, location( writer ) ) )
+
+        for rec in self.m_wraps:
+            result.append( str.format( "Warning: {0}: location counter wraps from $FFFF to $0000", location( rec ) ) )
+
+        return result
 
-        if phaseNumber == 0:
-            symbols.set( sym, gLoc )
-            
-        else:
-            #
-            #   check that the symbol has the same value in
-            #   subsequent phases
-            #
-            symbols.setScope( sym )
-            if symbols.get( sym ) != gLoc:
-                raise Exception( str.format( "Symbol phase error (expected {0}, have {1})", symbols.get(sym), gLoc ) )
 
     #
-    #   handle ops
+    #   --map: each contiguous region of the image, the label it starts at
+    #   (or the nearest one below it) and the lines that wrote it
     #
-    if tokenizer.curTok() == tok.SYMBOL:
+    def printMap( self ):
+        table = self.m_symbols.m_symbols
+        index = symbols.AddressIndex( dict( ( rec.m_label, table[rec.m_label] ) for rec in self.m_records
+            if rec.m_label in table ) )
+        spans = self.m_memory.spans()
+        starts = [ start for start, end in spans ]
+        writers = [ [] for span in spans ]
+
+        for rec in self.m_records:
+            if rec.m_size > 0:
+                i = bisect.bisect_right( starts, rec.m_loc ) - 1
+                if i >= 0:
+                    writers[i].append( rec )
+
+                #   (a line that wrapped wrote the start of memory, too)
+                if rec.m_loc + rec.m_size > 0x10000 and starts[0] == 0:
+                    writers[0].append( rec )
+
+        print "Map:"
+        for ( start, end ), recs in zip( spans, writers ):
+            sources = []
+            for rec in recs:
+                if len( sources ) > 0 and sources[-1][0] == rec.m_file:
+                    sources[-1][2] = rec.m_line
+                else:
+                    sources.append( [ rec.m_file, rec.m_line, rec.m_line ] )
+
+            names = []
+            for file, first, last in sources:
+                if first == last:
+                    names.append( str.format( "{0}({1})", file, first ) )
+                else:
+                    names.append( str.format( "{0}({1}-{2})", file, first, last ) )
+
+            label = ''
+            nearest = index.lookup( start )
+            if nearest != None:
+                name, offset = nearest
+                label = name
+                if offset > 0:
+                    label = str.format( "{0}+{1}", name, offset )
+
+            print str.format( "    ${0:04X}-${1:04X} {2:6} bytes   {3:16} {4}", start, end - 1, end - start, label,
+                ", ".join( names ) )
+
+
+    #   ----------------------------------------------------------------
+    #   Instructions (see gDepositDispatch)
+    #   ----------------------------------------------------------------
+
+    def depositImpliedArg( self, expr, value ):
+        pass
+
+    def depositByteArg( self, expr, value ):
+        self.depositByte( value )
+
+    def depositAbsArg( self, expr, value ):
+        self.depositWord( value )
+
+    def depositRelArg( self, expr, value ):
+        if value != None and not self.m_sizing:
+            self.depositByte( relativeOffset( value, self.m_loc ) )
 
-        op = tokenizer.curValue().lower()
-        tokenizer.advance()
-        
-        if op in gPsuedoOps:
-            gPsuedoOps[op]( tokenizer, phaseNumber )
-        elif op in gOps:
-            assembleInstruction( op, tokenizer, phaseNumber )
         else:
-            raise Exception( str.format( 'Unknown op: {0}', op ) )
 
-    if gListingFile != None and phaseNumber > 0:
-        generateListingLine( line )
+            self.depositByte( 0 )
 
 
-def assembleFile( filename ):
-    global gInput, gPriorFile, gLoc
-    
-    symbols.clear()
-    gPriorFile = None
-    gotError = False
-    
-    for phase in range(0,2):
+    def assembleInstruction( self, rec, phaseNumber ):
+        op = rec.m_op
+        addrMode = rec.m_addrMode
+        expr = rec.m_expr
 
-        if gotError:
-            break
-            
-        try:
-            gInput = fileinput.FileInput( filename )
-        except:
-            print "Error: {0}", sys.exc_value
-            return
+        value = None
+        if expr != None:
+            value = expr.eval( self.m_symbols, self.m_lineLoc )
 
-        gLoc = 0
+        if phaseNumber > 0 and value == None and addrMode != IMPLIED:
+            raise Exception( "Undefined expression" )
 
-        try:
-            while True:
-                line = gInput.nextLine()
-                if not line:
-                    break
-                assembleLine( line, phase )
-        except:
-            err = str.format("Error: {0}({1}): {2}",
-                gInput.file(),
-                gInput.line(),
-                sys.exc_value )
-            print err
-            gotError = True
-            # traceback.print_exc()
+        #
+        #   Translate UNDECIDED into various forms of REL / ZP / ABS
+        #
+        if not addrMode in gOps[op]:
 
-    return not gotError
+            if addrMode == UNDECIDED:
 
+                if REL in gOps[op]:
+                    addrMode = REL
+                elif ZP in gOps[op] and self.isShort( rec, value ):
+                    addrMode = ZP
+                else:
+                    addrMode = ABS
 
-def dump(ar, start, end ):
-    s = ''
-    ascii = ''
-    j = 0
+            elif addrMode == UNDECIDED_X:
+
+                if ZPX in gOps[op] and self.isShort( rec, value ):
+                    addrMode = ZPX
+                else:
+                    addrMode = ABSX
 
-    for i in range( start, end ):
-        v = 0
-        if ar[i] != None:
-            v = ar[i]
+            elif addrMode == UNDECIDED_Y:
 
-        if j > 0:
-            s += ' '
+                if ZPY in gOps[op] and self.isShort( rec, value ):
+                    addrMode = ZPY
+                else:
+                    addrMode = ABSY
 
-        if j == 8:
-            s += ' '
+            if self.m_optimize and phaseNumber > 0:
+                self.countSaving( rec, addrMode )
 
-        s += str.format('{0:02X}', v)
+        if addrMode in gOps[op]:
+
+            self.depositByte( gOps[op][addrMode] )
+
+            if value == None and expr != None:
+                #   (an operand we can't see yet might be zero page after all)
+                resizes = addrMode in gZeroPageForm and gZeroPageForm[addrMode] in gOps[op]
+                self.addFixup( gFixupKind[addrMode], expr, resizes )
+
+            gDepositDispatch[addrMode]( self, expr, value )
 
-        if v >= ord(' ') and v <= 0x7f:
-            ascii += chr( v )
         else:
-            ascii += '.'
 
-        j = j + 1
+            raise Exception( "Bad addressing mode for instruction" )
 
-    return s, ascii
 
-def dumpMem():
-    global gMemory
+    #   ----------------------------------------------------------------
+    #   Size optimization (--optimize)
+    #
+    #   Normally an operand that isn't defined yet in phase 0 gets the ABS
+    #   form of its instruction.  With --optimize it gets the zero page form,
+    #   and the recorded lines are replayed ("sizing passes") until nothing
+    #   moves.  An instruction whose operand turns out to be >= 0x100 is
+    #   marked long and stays long, so sizes only grow and the passes settle.
+    #   ----------------------------------------------------------------
+
+    #
+    #   Pick the zero page form of an instruction (that has one) for 'value'?
+    #
+    def isShort( self, rec, value ):
+        if not self.m_optimize:
+            return value != None and value < 0x100
+
+        if rec.m_long:
+            return False
+
+        if value == None:
+            if self.m_reading:
+                rec.m_forward = True
+            return True
 
-    def probe( start, end ):
-        for i in range(start, end):
-            if gMemory[i] != None:
-                return True
+        if value < 0x100:
+            return True
+
+        rec.m_long = True
         return False
 
-    i = 0
-    while i < 0x10000:
-        if probe(i, i + 16):
-            s, ascii = dump(gMemory, i, i+16)
-            print str.format('{0:04X}  {1}  {2}', i, s, ascii )
-        i += 0x10
 
+    #
+    #   Count what a zero page form of a forward reference saved
+    #
+    def countSaving( self, rec, addrMode ):
+        if rec.m_forward and addrMode in ( ZP, ZPX, ZPY ):
+            self.m_bytesSaved += 1
+            if addrMode == ZP or rec.m_op in gIndexedWriteOps:
+                self.m_cyclesSaved += 1
 
-def makeKim1Record( ar, start, end ):
-    record = str.format( ';{0:02X}{1:02X}{2:02X}',
-        end - start,
-        (start >> 8) & 0xff,
-        start & 0xff )
-    sum = 0
 
-    for i in range( start, end ):
-        v = 0
-        if ar[i] != None:
-            v = ar[i]
-        record += str.format( '{0:02X}', v )
-        sum += v
+    #
+    #   Replay the records with phase 0 rules; returns the number of lines
+    #   that moved or changed size
+    #
+    def sizingPass( self ):
+        self.m_loc = 0
+        self.clearMemory()
+        changes = 0
+        for rec in self.m_records:
+            self.m_record = rec
+            loc = rec.m_loc
+            size = rec.m_size
+            self.assembleRecord( rec, 0 )
+            if rec.m_loc != loc or rec.m_size != size:
+                changes += 1
 
-    record += str.format( '{0:02X}{1:02X}\r\n', (sum >> 8) & 0xff, sum & 0xff )
-    return record
+        return changes
 
 
-def dumpKim1Records( filename, startAddress=0 ):
-    global gMemory
+    def optimizeSizes( self ):
+        while True:
+            if self.m_sizingPasses >= self.m_passLimit:
+                raise Exception( str.format( "Sizes still changing after {0} passes", self.m_sizingPasses ) )
 
-    def probe( start, end ):
-        if end > 0x10000:
-            end = 0x10000
-            
-        for i in range(start, end):
-            if gMemory[i] != None:
-                return True
-        return False
+            self.m_sizingPasses += 1
+            if self.sizingPass() == 0:
+                break
 
-    outputFile = open( filename, 'wb' )
 
-    recordCount = 0
-    i = 0
-    while i < 0x10000:
-        if probe( i, i + 16 ):
-            outputFile.write( makeKim1Record( gMemory, i, i + 16 ) )
-            recordCount += 1
-        i += 16
+    #   ----------------------------------------------------------------
+    #   Fixups (--one-pass)
+    #   ----------------------------------------------------------------
 
-    outputFile.write( str.format( ';00{0:02X}{1:02X}{0:02X}{1:02X}\r\n',
-        (recordCount >> 8) & 0xff,
-        recordCount & 0xff )
-        )
+    #
+    #   Record a fixup for an operand about to be deposited at m_loc
+    #
+    def addFixup( self, kind, expr, resizes=False, addr=None ):
+        if addr == None:
+            addr = self.m_loc
+        if self.m_fixups != None:
+            self.m_fixups.append( Fixup( addr, kind, expr, self.m_lineLoc, self.m_record, resizes ) )
 
-    outputFile.close()
 
+    #
+    #   (a byte a later line has written over is patched where the listing
+    #   finds it, and stays overwritten in the image)
+    #
+    def patchByte( self, addr, value ):
+        addr &= 0xffff
+        shadowed = self.m_shadowed.get( self.m_record )
+        if shadowed != None and addr in shadowed:
+            shadowed[addr] = value & 0xff
+        else:
+            self.m_memory.write( addr, value & 0xff )
 
-gCommands = {
-    # 'foo': { 'handler': function, 'count': numberOfArguments }
-    }
 
+    def patchWord( self, addr, value ):
+        self.patchByte( addr, value )
+        self.patchByte( addr + 1, value >> 8 )
 
-def main( argv ):
-    global gCommands
-    global gListingFile
-    
-    argno = 1
-    while argno < len( argv ):
 
-        arg = argv[argno].lower()
+    def applyFixup( self, fixup, value ):
+        kind = fixup.m_kind
 
-        if arg in gCommands:
-            count = 0
-            if 'count' in gCommands[arg]:
-                count = gCommands[arg]['count']
-                if argno + count >= len( argv ):
-                    raise Exception( str.format( "Not enough arguments for {0}", arg ) )
+        if kind == FIXUP_DW:
+            if value == None:
+                value = 0
+            self.patchWord( fixup.m_addr, value )
 
-                args = argv[argno + 1 : argno + count + 1]
-                argno += count + 1
-                gCommands[arg]['handler'](*args)
+        elif kind == FIXUP_DB:
+            checkByte( value )
+            self.patchByte( fixup.m_addr, value )
+
+        elif value == None:
+            raise Exception( "Undefined expression" )
+
+        elif kind == FIXUP_BYTE:
+            self.patchByte( fixup.m_addr, value )
+
+        elif kind == FIXUP_WORD:
+            self.patchWord( fixup.m_addr, value )
+
+        else:
+            self.patchByte( fixup.m_addr, relativeOffset( value, fixup.m_addr ) )
+
+
+    #
+    #   Define the equates that had forward references, then patch the
+    #   fixups.  Returns False if an instruction would change size.
+    #
+    def applyFixups( self ):
+        pending = self.m_pendingEquates
+        progress = True
+        while progress:
+            progress = False
+            for rec in pending[:]:
+                value = rec.m_expr.eval( self.m_symbols, rec.m_loc )
+                if value != None:
+                    self.m_symbols.define( rec.m_equate, value, rec.m_file, rec.m_line, 0 )
+                    pending.remove( rec )
+                    progress = True
+
+        values = []
+        for fixup in self.m_fixups:
+            value = fixup.m_expr.eval( self.m_symbols, fixup.m_lineLoc )
+            if fixup.m_resizes and value != None and value < 0x100:
+                self.m_resizeCount += 1
+            values.append( value )
+
+        if self.m_resizeCount > 0:
+            return False
+
+        for fixup, value in zip( self.m_fixups, values ):
+            self.m_record = fixup.m_record
+            self.applyFixup( fixup, value )
+            self.m_fixupCount += 1
+
+        for rec in pending:
+            self.m_record = rec
+            raise Exception( "Undefined expression" )
+
+        return True
+
+
+    #   ----------------------------------------------------------------
+    #   Listing (-l)
+    #
+    #   Rendered once assembly is done, from the records and the image,
+    #   and written in one go.  Nothing is done for it while assembling,
+    #   beyond keeping the bytes of lines that others wrote over.
+    #   ----------------------------------------------------------------
+
+    #
+    #   The recorded lines, with their bytes from the image (or the ones
+    #   they deposited, where a later line wrote over them)
+    #
+    def renderListing( self ):
+        out = []
+        priorFile = None
+
+        for rec in self.m_records:
+            if rec.m_file != priorFile:
+                out.append( str.format( "File {0}\n", rec.m_file ) )
+                priorFile = rec.m_file
+
+            n = rec.m_size
+            if rec.m_op in gPsuedoOps and 'listed' in gPsuedoOps[rec.m_op]:
+                n = min( n, gPsuedoOps[rec.m_op]['listed'] )
+
+            lineBytes = imageBytes( self.m_memory, rec.m_loc, n )
+            shadowed = self.m_shadowed.get( rec )
+            if shadowed != None:
+                for addr, byte in shadowed.iteritems():
+                    i = ( addr - rec.m_loc ) & 0xffff
+                    if i < n:
+                        lineBytes[i] = byte
+
+            listLine( out, rec, lineBytes )
+
+        return ''.join( out )
+
+
+    #   ----------------------------------------------------------------
+    #   Lines
+    #   ----------------------------------------------------------------
+
+    def parseLine( self, rec, lexed=None ):
+        tokenizer = tok.Tokenizer( rec.m_text, lexed )
+        table = self.m_symbols
+
+        #
+        #   SYMBOL = VALUE
+        #
+        if tokenizer.curTok() == tok.SYMBOL and tokenizer.peek(1) == '=':
+            sym = tokenizer.curValue()
+            tokenizer.advance( 2 )
+            rec.m_expr = eval.internExpression( tokenizer, table.m_scope )
+            if not tokenizer.atEnd():
+                raise Exception( "Bad expression (extra gunk)" )
+
+            rec.m_equate = table.qualify( sym )
+            table.setScope( sym )
+            return
+
+        #
+        #   handle SYMBOL: at start of line
+        #   NOTE: could enforce leadingWhitespace, but we have a ':'
+        #   instead of that.
+        #
+        #   Symbols are qualified (and scopes opened) here, once, so the
+        #   names in the record and its expressions are final.
+        #
+        if tokenizer.curTok() == tok.SYMBOL and tokenizer.peek(1) == ':':
+            sym = tokenizer.curValue()
+            tokenizer.advance( 2 )
+
+            table.setScope( sym )
+            rec.m_label = table.qualify( sym )
+
+        #
+        #   handle ops
+        #
+        if tokenizer.curTok() == tok.SYMBOL:
+
+            op = tokenizer.curValue().lower()
+            tokenizer.advance()
+
+            if op in gPsuedoOps:
+                rec.m_args = gPsuedoOps[op]['parse']( tokenizer, table.m_scope )
+            elif op in gOps:
+                rec.m_addrMode, rec.m_expr = parseAddressingMode( tokenizer, table.m_scope )
             else:
-                argno += 1
-                gCommands[arg]['handler']()
-                
-        elif arg.startswith( '-' ):
-            
-            raise Exception( str.format( "Unknown option {0}", arg ) )
+                raise Exception( str.format( 'Unknown op: {0}', op ) )
+
+            rec.m_op = op
+
+
+    #
+    #   Handle a line of assembly input
+    #
+    #   Phase 0:    just intern stuff
+    #   Phase 1:    emit stuff (expressions required to be defined)
+    #
+    def assembleRecord( self, rec, phaseNumber=0 ):
+        self.m_thisLine = []
+        self.m_lineUnlisted = 0
+        loc = self.m_loc
+        self.m_lineLoc = loc
+        table = self.m_symbols
+
+        if rec.m_equate != None:
+
+            value = rec.m_expr.eval( table, loc )
+
+            if phaseNumber > 0 and value == None:
+                raise Exception( str.format( "Undefined expression" ) )
+
+            #   (a symbol whose value isn't known yet stays undefined)
+            if value != None:
+                table.define( rec.m_equate, value, rec.m_file, rec.m_line, phaseNumber )
+            elif self.m_pendingEquates != None:
+                self.m_pendingEquates.append( rec )
 
         else:
-            
-            argno += 1
 
-            match = re.match( ".*\.(.*)", arg )
-            if not match:
-                arg += ".asm"
+            sym = rec.m_label
+            if sym != None:
 
-            match = re.match( "(.*\.).*", arg )
-            if not match:
-                raise Exception( "internal error flogging filenames" )
+                if phaseNumber == 0:
+                    table.define( sym, loc, rec.m_file, rec.m_line, phaseNumber )
 
-            baseFile = match.group(1)
-            listingFile = baseFile + "lst"
-            outputFile = baseFile + "dat"
+                else:
+                    #
+                    #   check that the symbol has the same value in
+                    #   subsequent phases
+                    #
+                    value = table.find( sym ).m_value
+                    if value != loc:
+                        raise Exception( str.format( "Symbol phase error (expected {0}, have {1})", value, loc ) )
 
-            gListingFile = open( listingFile, "w" )
+            op = rec.m_op
+            if op in gPsuedoOps:
+                gPsuedoOps[op]['handler']( self, rec.m_args, phaseNumber )
+            elif op != None:
+                self.assembleInstruction( rec, phaseNumber )
 
-            if assembleFile( arg ):
-                dumpKim1Records( outputFile )
+        rec.m_loc = self.m_lineLoc
+        rec.m_size = len( self.m_thisLine ) + self.m_lineUnlisted
 
 
-if __name__ == '__main__':
-    try:
-        main( sys.argv )
-    except:
-        err = str.format( "Error: {0}", sys.exc_value )
-        print err
+    #
+    #   Phase 0: read and parse the input, recording each line
+    #
+    def readSource( self ):
+        input = self.m_input
+        records = self.m_records
+        parseLine = self.parseLine
+        assembleRecord = self.assembleRecord
+        boundaries = self.m_boundaries
+        inputFile = None
+        depth = 0
+
+        self.m_reading = True
+        try:
+            while True:
+                line = input.nextLine()
+                if not line:
+                    break
+
+                rec = LineRecord( input.file(), input.line(), line )
+                if boundaries != None and ( rec.m_file != inputFile or input.depth() != depth ):
+                    inputFile = rec.m_file
+                    depth = input.depth()
+                    previous = boundaries[-1].m_index if boundaries else 0
+                    if not boundaries or previous != len( records ):
+                        boundaries.append( Boundary( len( records ), input.position(), self.m_loc,
+                            self.m_symbols.m_scope, self.definedBy( previous, len( records ), 0 ) ) )
+
+                self.m_record = rec
+                parseLine( rec, input.lexed() )
+                records.append( rec )
+                assembleRecord( rec, 0 )
+        finally:
+            self.m_reading = False
+
+
+    #
+    #   Later phases: walk the recorded lines (from record 'start') without
+    #   touching the source
+    #
+    def replaySource( self, phaseNumber, start=0 ):
+        assembleRecord = self.assembleRecord
+        records = self.m_records
+
+        boundaries = []
+        if self.m_boundaries != None:
+            boundaries = [ boundary for boundary in self.m_boundaries if boundary.m_index > start ]
+
+        for boundary in boundaries + [ None ]:
+            if boundary != None:
+                end = boundary.m_index
+            else:
+                end = len( records )
+
+            for rec in records[start:end]:
+                self.m_record = rec
+                assembleRecord( rec, phaseNumber )
+
+            if boundary != None:
+                overlaps = self.m_overlaps
+                boundary.m_memory = self.writtenBy( start, end )
+                boundary.m_overlaps = ( overlaps, len( overlaps ), list( overlaps[-1] ) if overlaps else None )
+                boundary.m_wraps = ( self.m_wraps, len( self.m_wraps ) )
+                boundary.m_shadowed = dict( ( rec, dict( shadowed ) ) for rec, shadowed in self.m_shadowed.iteritems() )
+                boundary.m_redefined = self.definedBy( start, end, 1 )
+                start = end
+
+
+    #
+    #   { name: Symbol } of the labels and equates records[start:end] defined
+    #   (in phase 0) or defined again (in phase 1)
+    #
+    def definedBy( self, start, end, phaseNumber ):
+        table = self.m_symbols.m_symbols
+        result = {}
+        for rec in self.m_records[start:end]:
+            for name in ( rec.m_label, rec.m_equate ):
+                if name == None:
+                    continue
+                sym = table.get( name )
+                if sym != None and ( phaseNumber == 0 or sym.m_phase > 0 ):
+                    result[name] = sym
+        return result
+
+
+    #
+    #   The bytes records[start:end] deposited, as [ ( address, bytes )... ]
+    #   with neighbouring records' bytes run together
+    #
+    def writtenBy( self, start, end ):
+        ranges = []
+        for rec in self.m_records[start:end]:
+            loc = rec.m_loc
+            size = min( rec.m_size, image.SIZE )
+            while size > 0:
+                n = min( size, image.SIZE - loc )
+                if ranges and ranges[-1][1] == loc:
+                    ranges[-1][1] = loc + n
+                else:
+                    ranges.append( [ loc, loc + n ] )
+                size -= n
+                loc = 0
+
+        data = self.m_memory.m_data
+        return [ ( first, str( data[first:last] ) ) for first, last in ranges ]
+
+
+    #   ----------------------------------------------------------------
+    #   Assembling a file or a string
+    #
+    #   Both return True if there were no errors; the errors and warnings
+    #   are in m_messages, the image in m_memory and the symbols in
+    #   m_symbols.
+    #   ----------------------------------------------------------------
+
+    def reset( self ):
+        self.m_symbols.clear()
+        self.m_input = None
+        self.m_loc = 0
+        self.m_records = []
+        self.m_record = None
+        self.m_fixups = None
+        self.m_pendingEquates = None
+        self.m_messages = []
+        self.m_boundaries = None
+        self.m_readValues = None
+        self.m_readFrom = 0
+        self.m_replayFrom = 0
+        self.m_fixupCount = 0
+        self.m_resizeCount = 0
+        self.m_sizingPasses = 0
+        self.m_bytesSaved = 0
+        self.m_cyclesSaved = 0
+        self.clearMemory()
+
+        if self.m_incremental and not self.m_onePass and not self.m_optimize:
+            self.m_boundaries = []
+
+
+    def lexer( self ):
+        if self.m_useCache:
+            return sourcecache.lexFile
+        else:
+            return None
+
+
+    def assembleFile( self, filename ):
+        self.reset()
+        self.m_filename = filename
+
+        try:
+            input = fileinput.FileInput( filename, self.lexer(), self.m_searchPath )
+        except:
+            self.m_messages.append( str.format( "Error: {0}", sys.exc_info()[1] ) )
+            return False
+
+        return self.assemble( input, filename )
+
+
+    #
+    #   'text' is read as a file called 'filename' (its includes are
+    #   found the usual way; it doesn't go through the source cache)
+    #
+    def assembleString( self, text, filename='(string)' ):
+        self.reset()
+
+        input = fileinput.FileInput( None, self.lexer(), self.m_searchPath )
+        input.pushLines( filename, text.splitlines( True ) )
+
+        return self.assemble( input, filename )
+
+
+    #
+    #   (a reassembly gives the Boundary that reading starts again at)
+    #
+    def assemble( self, input, filename, resume=None ):
+        self.m_input = input
+        gotError = False
+
+        #   (see pauseCollector)
+        pauseCollector()
+        try:
+            for phase in range(0,2):
+
+                if gotError:
+                    break
+
+                if phase == 0 and resume != None:
+                    self.m_loc = resume.m_loc
+                else:
+                    self.m_loc = 0
+                self.clearMemory()
+                self.m_checkOverlaps = phase == 1 or ( self.m_onePass and not self.m_optimize )
+                self.m_sizing = phase == 0 and self.m_optimize
+
+                try:
+                    if phase == 0:
+
+                        if self.m_onePass and not self.m_optimize:
+                            self.m_fixups = []
+                            self.m_pendingEquates = []
+
+                        self.readSource()
+
+                        if self.m_optimize:
+                            self.optimizeSizes()
+
+                        if self.m_fixups != None:
+                            done = self.applyFixups()
+                            self.m_fixups = None
+                            self.m_pendingEquates = None
+
+                            if done:
+                                break
+
+                            #   a forward reference turned out to be zero page, so
+                            #   the lines after it move: lay them out again, with
+                            #   the symbols now known, before phase 1
+                            self.m_sizing = True
+                            self.m_checkOverlaps = False
+                            self.optimizeSizes()
+
+                    else:
+                        start = 0
+                        if self.m_boundaries != None:
+                            start = self.replayStart( resume )
+                        self.m_replayFrom = start
+                        self.replaySource( phase, start )
+                except:
+                    if self.m_record != None:
+                        err = str.format("Error: {0}({1}): {2}",
+                            self.m_record.m_file,
+                            self.m_record.m_line,
+                            sys.exc_info()[1] )
+                    else:
+                        err = str.format("Error: {0}: {1}", filename, sys.exc_info()[1] )
+                    self.m_messages.append( err )
+                    gotError = True
+                    self.m_fixups = None
+                    self.m_pendingEquates = None
+                    self.m_boundaries = None
+                    self.m_readValues = None
+                    # traceback.print_exc()
+        finally:
+            self.closeBinaries()
+            self.m_input = None
+            resumeCollector()
+
+        self.m_messages.extend( self.warnings() )
+
+        return not gotError
+
+
+    #   ----------------------------------------------------------------
+    #   Reassembly (--watch)
+    #
+    #   An incremental two-pass Assembler notes its state at each include
+    #   boundary, where the input moves into an included file or back out
+    #   of one.  When some of the files change, phase 0 reads again from
+    #   the last boundary before the first line they affect, keeping the
+    #   records before it.  If the symbols come out of phase 0 with the
+    #   values they had, the image up to the boundary is kept too and
+    #   phase 1 assembles only the rest; otherwise phase 1 starts over.
+    #   One-pass and optimized assemblies are always redone in full.
+    #   ----------------------------------------------------------------
+
+    #
+    #   The file an include or incbin line read (or the name it gave, if
+    #   there's no such file), or None
+    #
+    def includedPath( self, rec ):
+        name = includedFile( rec )
+        if name == None:
+            return None
+
+        filename = fileinput.resolve( name, rec.m_file, self.m_searchPath, counted=False )
+        if filename == None:
+            return name
+        return filename
+
+
+    #
+    #   file ==> [ files it includes or incbins, in order ]
+    #
+    def includeGraph( self ):
+        graph = {}
+        for rec in self.m_records:
+            name = self.includedPath( rec )
+            if name != None:
+                names = graph.setdefault( rec.m_file, [] )
+                if not name in names:
+                    names.append( name )
+        return graph
+
+
+    #
+    #   Every file the last assembly read: the one it was given, then the
+    #   ones included or incbined, in the order they were read
+    #
+    def dependencies( self ):
+        result = []
+        if self.m_filename != None:
+            result.append( self.m_filename )
+        for rec in self.m_records:
+            name = self.includedPath( rec )
+            if name != None and not name in result:
+                result.append( name )
+        return result
+
+
+    #
+    #   The first record that files in 'changed' could make different, or None
+    #
+    def firstAffected( self, changed ):
+        changed = set( changed )
+        for index, rec in enumerate( self.m_records ):
+            if rec.m_file in changed:
+                return index
+
+            op = rec.m_op
+            if op == 'include' or op == 'incbin':
+                if self.includedPath( rec ) in changed:
+                    if op == 'include':
+                        return index + 1
+                    return index
+
+        return None
+
+
+    #
+    #   Phase 0 is done: phase 1 can start at 'resume' if the symbols have
+    #   the values they had last time (so the records before it deposit
+    #   what they did), and otherwise starts at the beginning
+    #
+    def replayStart( self, resume ):
+        readValues = self.m_readValues
+        self.m_readValues = dict( ( name, sym.m_value ) for name, sym in self.m_symbols.m_symbols.iteritems() )
+
+        if resume == None or self.m_readValues != readValues:
+            return 0
+
+        memory = image.Image()
+        redefined = {}
+        for boundary in self.m_boundaries:
+            if boundary.m_memory != None:
+                for addr, data in boundary.m_memory:
+                    memory.writeBlock( addr, data )
+                redefined.update( boundary.m_redefined )
+            if boundary is resume:
+                break
+
+        overlaps, count, last = resume.m_overlaps
+        wraps, wrapCount = resume.m_wraps
+        self.m_memory = memory
+        self.m_overlaps = overlaps[:count - 1] + [ list( last ) ] if count > 0 else []
+        self.m_wraps = wraps[:wrapCount]
+        self.m_shadowed = dict( ( rec, dict( shadowed ) ) for rec, shadowed in resume.m_shadowed.iteritems() )
+        self.m_symbols.m_symbols.update( redefined )
+        self.m_loc = resume.m_loc
+        return resume.m_index
+
+
+    #
+    #   Assemble the last file again, now that the files in 'changed' have
+    #   changed; returns True if there were no errors, as assembleFile does
+    #
+    def reassemble( self, changed ):
+        if self.m_filename == None:
+            raise Exception( "Nothing to reassemble" )
+
+        resume = None
+        if self.m_boundaries != None and self.m_readValues != None:
+            first = self.firstAffected( changed )
+            if first != None:
+                for boundary in self.m_boundaries:
+                    if boundary.m_index > first:
+                        break
+                    resume = boundary
+
+        if resume == None or resume.m_index == 0 or resume.m_memory is None:
+            return self.assembleFile( self.m_filename )
+
+        #   (reading again adds the boundaries after 'resume')
+        self.m_boundaries = self.m_boundaries[:self.m_boundaries.index( resume ) + 1]
+        self.m_records = self.m_records[:resume.m_index]
+        symbols = {}
+        for boundary in self.m_boundaries:
+            symbols.update( boundary.m_symbols )
+        self.m_symbols.m_symbols = symbols
+        self.m_symbols.m_scope = resume.m_scope
+        self.m_record = None
+        self.m_messages = []
+        self.m_readFrom = resume.m_index
+        self.m_replayFrom = 0
+
+        #   (with the collector off, as assemble has it: the records are still here)
+        pauseCollector()
+        input = fileinput.FileInput( None, self.lexer(), self.m_searchPath )
+        try:
+            input.resume( resume.m_position )
+        except:
+            self.m_messages.append( str.format( "Error: {0}", sys.exc_info()[1] ) )
+            self.m_boundaries = None
+            return False
+        finally:
+            resumeCollector()
+
+        return self.assemble( input, self.m_filename, resume )
+
+
+#
+#   The file an include or incbin line names, or None
+#
+def includedFile( rec ):
+    if rec.m_op == 'include':
+        return rec.m_args
+    elif rec.m_op == 'incbin':
+        return rec.m_args[0]
+    else:
+        return None
+
+
+#
+#   Instruction operands, by addressing mode
+#
+gDepositDispatch = {
+    IMPLIED: Assembler.depositImpliedArg,
+    IMMED: Assembler.depositByteArg,
+    ABS: Assembler.depositAbsArg,
+    ZP: Assembler.depositByteArg,
+    ABSX: Assembler.depositAbsArg,
+    ABSY: Assembler.depositAbsArg,
+    IND: Assembler.depositAbsArg,
+    REL: Assembler.depositRelArg,
+    ZPX: Assembler.depositByteArg,
+    ZPY: Assembler.depositByteArg,
+    INDX: Assembler.depositByteArg,
+    INDY: Assembler.depositByteArg
+    }
+
+
+#
+#   'listed', if present, is how many of a line's bytes the listing shows
+#
+gPsuedoOps = {
+    'org':      { 'parse': parse_expr, 'handler': Assembler.fn_org },
+    'db':       { 'parse': parse_data, 'handler': Assembler.fn_db },
+    'dw':       { 'parse': parse_data, 'handler': Assembler.fn_dw },
+    'ds':       { 'parse': parse_ds, 'handler': Assembler.fn_ds },
+    'include':  { 'parse': parse_include, 'handler': Assembler.fn_include },
+    'incbin':   { 'parse': parse_incbin, 'handler': Assembler.fn_incbin, 'listed': 8 }
+}
+
+
+#   ----------------------------------------------------------------
+#   Listing lines
+#   ----------------------------------------------------------------
+
+gHexBytes = [ str.format( '{0:02X}', v ) for v in range( 256 ) ]
+
+
+#
+#   The 'n' bytes at 'addr' in 'memory' (wrapping at the top of memory)
+#
+def imageBytes( memory, addr, n ):
+    data = memory.m_data[addr:addr + n]
+    if len( data ) < n:
+        data += memory.m_data[:n - len( data )]
+    return data
+
+
+def listLine( out, rec, lineBytes ):
+    prefix = str.format( "{0:5}: ", rec.m_line )
+    baseAddr = rec.m_loc
+
+    if len( lineBytes ) > 0:
+        i = 0
+        while i < len( lineBytes ):
+            n = len( lineBytes ) - i
+            if n > 8:
+                n = 8
+
+            s = ' '.join( [ gHexBytes[v] for v in lineBytes[i:i + n] ] )
+
+            if i == 0:
+                out.append( str.format( "{0} {1:04X}  {2:30} {3}", prefix, baseAddr + i, s, rec.m_text ) )
+            else:
+                out.append( str.format( "{0} {1:04X}  {2:10}\n", prefix, baseAddr + i, s ) )
+
+            i += n
+
+        if rec.m_size > len( lineBytes ):
+            out.append( str.format( "{0} {1:04X}  ... {2} more bytes\n", prefix, baseAddr + i, rec.m_size - i ) )
+
+    else:
+
+        out.append( str.format( "{0} {1:30} {2}", prefix, "", rec.m_text ) )
+
+
+#
+#   bytes (None reads as zero) ==> 'XX XX ... XX  XX ...', ascii
+#
+def dump(ar, start, end ):
+    values = [ v or 0 for v in ar[start:end] ]
+    hexes = [ gHexBytes[v] for v in values ]
+
+    s = ' '.join( hexes[:8] )
+    if len( hexes ) > 8:
+        s += '  ' + ' '.join( hexes[8:] )
+
+    ascii = ''.join( [ chr( v ) if v >= ord(' ') and v <= 0x7f else '.' for v in values ] )
+
+    return s, ascii
+
+def dumpMem( memory ):
+    for i in memory.windows( 16 ):
+        s, ascii = dump( memory.m_data, i, i + 16 )
+        print str.format('{0:04X}  {1}  {2}', i, s, ascii )
+
+
+#
+#   (unwritten bytes are zero in the image's data)
+#
+def makeKim1Record( image, start, end ):
+    data = image.m_data[start:end]
+    checksum = sum( data )
+
+    return str.format( ';{0:02X}{1:04X}{2}{3:04X}\r\n',
+        end - start,
+        start,
+        binascii.hexlify( data ).upper(),
+        checksum & 0xffff )
+
+
+KIM1_MAX_RECORD = 24
+gRecordLength = 16
+
+
+#
+#   One record for each 'recordLength'-aligned window of the image that
+#   has something in it, then the record count
+#
+def dumpKim1Records( image, filename, startAddress=0, recordLength=None ):
+    if recordLength == None:
+        recordLength = gRecordLength
+
+    records = []
+    for i in image.windows( recordLength ):
+        records.append( makeKim1Record( image, i, min( i + recordLength, 0x10000 ) ) )
+
+    recordCount = len( records )
+    records.append( str.format( ';00{0:02X}{1:02X}{0:02X}{1:02X}\r\n',
+        (recordCount >> 8) & 0xff,
+        recordCount & 0xff )
+        )
+
+    with open( filename, 'wb' ) as outputFile:
+        outputFile.write( ''.join( records ) )
+
+
+def writeKim1( image, filename ):
+    dumpKim1Records( image, filename )
+
+
+#
+#   --format name ==> { 'writer': function( image, filename ), 'extension': output file extension }
+#
+gFormats = {
+    'kim1': { 'writer': writeKim1, 'extension': 'dat' },
+    'ihex': { 'writer': formats.writeIntelHex, 'extension': 'hex' },
+    'srec': { 'writer': formats.writeSRecords, 'extension': 's19' },
+    'bin':  { 'writer': formats.writeBinary, 'extension': 'bin' },
+    'prg':  { 'writer': formats.writePrg, 'extension': 'prg' },
+    'xex':  { 'writer': formats.writeXex, 'extension': 'xex' }
+    }
+
+gFormat = 'kim1'
+
+
+#   ----------------------------------------------------------------
+#   Tests (python kasm.py -test, from this directory)
+#   ----------------------------------------------------------------
+
+gTestRecords = [
+    ';100200000202020302010203FE7468697320690350',
+    ';10021073206120746573740AD2040000FFFF0005B2',
+    ';1002208000807400680069007300200069007303B4',
+    ';10023000200075006E00690063006F006400650307',
+    ';100240003F00204802EAEAA97B8640690190FC065D',
+    ';10025060AA458085808A000000000000000000035E',
+    ';0000060006'
+    ]
+
+
+#
+#   (with a scratch source cache, not the user's)
+#
+def test():
+    with scratchProject():
+        testAssembler()
+
+    print "kasm tests passed"
+
+
+def testAssembler():
+    asm = Assembler()
+    assert asm.assembleFile( 'test.asm' )
+    memory = asm.m_memory
+
+    #   dw *, dw *, dw * + 0xffff
+    assert memory[0x200:0x206] == [ 0x00, 0x02, 0x02, 0x02, 0x03, 0x02 ]
+    assert not asm.m_symbols.isDefined( '*' )
+
+    fd, filename = tempfile.mkstemp( suffix='.dat' )
+    os.close( fd )
+    dumpKim1Records( memory, filename )
+    with open( filename, 'rb' ) as file:
+        assert file.read().split( '\r\n' )[:-1] == gTestRecords
+    assert kim1.loadKim1( filename ).m_data == memory.m_data
+
+    #   longer records: fewer of them, holding the same bytes
+    dumpKim1Records( memory, filename, recordLength=KIM1_MAX_RECORD )
+    with open( filename, 'rb' ) as file:
+        records = file.read().split( '\r\n' )[:-2]
+    os.remove( filename )
+
+    assert len( records ) < len( gTestRecords ) - 1
+    for record in records:
+        data = bytearray( binascii.unhexlify( record[7:-4] ) )
+        start = int( record[3:7], 16 )
+        assert int( record[1:3], 16 ) == len( data ) and start % KIM1_MAX_RECORD == 0
+        assert data == memory.m_data[start:start + len( data )]
+        assert int( record[-4:], 16 ) == sum( data )
+
+    testOnePass( memory )
+    testOptimize()
+    testSourceCache()
+    testJobs()
+    testData()
+    testOverlaps()
+    testIncbin()
+    testReentrant()
+    testReassemble()
+    testBoundaries()
+    testDependencies()
+    testSearchPath()
+    testProjects()
+
+
+#
+#   A cold and a warm cache give the same image as no cache at all
+#
+def testSourceCache():
+    with scratchProject():
+        sourcecache.clearStats()
+
+        #   (fileinput is cleared before each assembly: files it has already
+        #   read don't get as far as the source cache)
+        fileinput.clear()
+
+        asm = Assembler( useCache=False )
+        assert asm.assembleFile( 'test.asm' )
+        expected = asm.m_memory
+
+        asm = Assembler()
+        assert asm.assembleFile( 'test.asm' )
+        assert asm.m_memory == expected
+        assert sourcecache.gHits == 0 and sourcecache.gMisses == 2       # test.asm, test.inc
+
+        fileinput.clear()
+        assert asm.assembleFile( 'test.asm' )
+        assert asm.m_memory == expected
+        assert sourcecache.gHits == 2 and sourcecache.gMisses == 2
+
+        #   a new process would find them on the disk
+        fileinput.clear()
+        sourcecache.gRecent.clear()
+        assert asm.assembleFile( 'test.asm' )
+        assert asm.m_memory == expected
+        assert sourcecache.gHits == 4 and sourcecache.gMemoryHits == 2 and sourcecache.gMisses == 2
+
+        #   and this one has them already
+        fileinput.clearStats()
+        assert asm.assembleFile( 'test.asm' )
+        assert asm.m_memory == expected
+        assert sourcecache.gHits == 4 and fileinput.gFileHits == 2 and fileinput.gFileMisses == 0
+
+    sourcecache.clearStats()
+
+
+#
+#   Results come back in command line order, on a pool or not
+#
+def testJobs():
+    files = {
+        'good.asm': "        org $300\n        lda #1\n",
+        'bad.asm': "        lda nowhere\n"
+        }
+
+    with scratchProject( files ) as directory:
+        good = os.path.join( directory, 'good.asm' )
+        bad = os.path.join( directory, 'bad.asm' )
+        jobs = [ ( good, currentOptions() ), ( bad, currentOptions() ), ( good, currentOptions() ) ]
+        stdout = sys.stdout
+        try:
+            for workers in [ 1, 2 ]:
+                sys.stdout = StringIO.StringIO()
+                assert runJobs( jobs, workers ) == 1
+                assert sys.stdout.getvalue() == str.format( "Error: {0}(1): Undefined expression\n", bad )
+                sys.stdout = stdout
+
+                with open( os.path.join( directory, 'good.dat' ), 'rb' ) as file:
+                    assert file.read().startswith( ';100300A901' )
+        finally:
+            sys.stdout = stdout
+
+
+def testData():
+    text = ( "        org $300\n"
+        "        db 'ab', 1, later & $ff, -1\n"
+        "        dw 'c', later\n"
+        "        ds 3, $ee\n"
+        "        ds 2\n"
+        "later:  db 0\n"
+        "        org $fffe\n"
+        "        db 1, 2, 3\n" )
+
+    expected = [ 0x61, 0x62, 0x01, 0x0e, 0xff, 0x63, 0x00, 0x0e, 0x03, 0xee, 0xee, 0xee, None, None, 0x00 ]
+    for onePass in [ False, True ]:
+        asm = Assembler( onePass=onePass )
+        assert asm.assembleString( text )
+        assert asm.m_messages == [ "Warning: (string)(8): location counter wraps from $FFFF to $0000" ]
+        assert asm.m_memory[0x300:0x30f] == expected
+        assert asm.m_memory[0xfffe:0x10000] == [ 1, 2 ] and asm.m_memory[0] == 3
+
+    assert not asm.assembleString( "        ds 2, 256\n" )
+    assert asm.m_messages[0].startswith( "Error:" )
+    assert not asm.assembleString( "        ds -1, 0\n" )
+    assert asm.m_messages[0].startswith( "Error:" )
+
+
+def testOverlaps():
+    text = ( "        org $300\n"
+        "start:  lda #1\n"
+        "        db 'abc'\n"
+        "        org $301\n"
+        "next:   nop\n"
+        "        db 1, 2, 3\n"
+        "        org $400\n"
+        "        rts\n" )
+
+    asm = Assembler()
+    assert asm.assembleString( text )
+    assert asm.m_messages == [ "Warning: (string)(5): overwrites $0301, written by (string)(2)",
+        "Warning: (string)(6): overwrites $0302-$0304, written by (string)(3)" ]
+
+    #   the listing shows what each line deposited, not what's left of it
+    listing = asm.renderListing().split( '\n' )
+    assert listing[2].startswith( "    2:  0300  A9 01 " ) and listing[3].startswith( "    3:  0302  61 62 63 " )
+    assert listing[5].startswith( "    5:  0301  EA " ) and listing[6].startswith( "    6:  0302  01 02 03 " )
+
+    ok, output = quietly( asm.printMap )
+    lines = output.split( '\n' )
+    assert lines[1] == "    $0300-$0304      5 bytes   start            (string)(2-6)"
+    assert lines[2] == "    $0400-$0400      1 bytes   next+255         (string)(8)"
+
+    #   writers noted after the first overlap, a wrap, and a one-pass image
+    text += ( "        org $fffe\n"
+        "        dw $1234, $5678\n"
+        "        org $400\n"
+        "        ds 2, 0\n"
+        "        org $0\n"
+        "        nop\n" )
+    for onePass in [ False, True ]:
+        asm = Assembler( onePass=onePass )
+        assert asm.assembleString( text )
+        assert asm.m_messages[2:] == [ "Warning: (string)(12): overwrites $0400, written by (string)(8)",
+            "Warning: (string)(14): overwrites $0000, written by (string)(10)",
+            "Warning: (string)(10): location counter wraps from $FFFF to $0000" ]
+        assert asm.renderListing().split( '\n' )[10].startswith( "   10:  FFFE  34 12 78 56 " )
+
+    #   a one-pass fixup to an overwritten operand goes to its line, not the image
+    for onePass in [ False, True ]:
+        asm = Assembler( onePass=onePass )
+        assert asm.assembleString( "        org $300\n"
+            "        lda fwd\n"
+            "        org $301\n"
+            "        db 5\n"
+            "fwd = $1234\n" )
+        assert asm.m_memory[0x300:0x304] == [ 0xad, 0x05, 0x12, None ]
+        assert asm.renderListing().split( '\n' )[2].startswith( "    2:  0300  AD 34 12 " )
+
+
+def quietly( fn, *args ):
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+        result = fn( *args )
+        return result, sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+
+
+#
+#   'with scratchProject( files ) as directory:' makes a directory holding
+#   'files' ({ name, relative to it: contents }) and a source cache of
+#   its own, and removes them when the block is done
+#
+@contextlib.contextmanager
+def scratchProject( files={} ):
+    directory = tempfile.mkdtemp()
+    cache = sourcecache.gDirectory
+    sourcecache.gDirectory = os.path.join( directory, '.cache' )
+    sourcecache.clear()
+    try:
+        for name, text in files.iteritems():
+            writeFile( os.path.join( directory, name ), text )
+        yield directory
+    finally:
+        sourcecache.clear()
+        sourcecache.gDirectory = cache
+        shutil.rmtree( directory )
+
+
+def writeFile( filename, text ):
+    if not os.path.isdir( os.path.dirname( filename ) ):
+        os.makedirs( os.path.dirname( filename ) )
+    with open( filename, 'wb' ) as file:
+        file.write( text )
+
+
+def testIncbin():
+    with scratchProject( { 'data.bin': ''.join( chr( i ) for i in range( 32 ) ) } ) as directory:
+        binary = os.path.join( directory, 'data.bin' )
+        text = str.format( "size = 12\n"
+            "        org $400\n"
+            "        incbin \"{0}\", 4, size\n"
+            "        incbin \"{0}\", 30\n", binary )
+
+        for onePass in [ False, True ]:
+            asm = Assembler( onePass=onePass )
+            fileinput.clearStats()
+            assert asm.assembleString( text )
+            assert asm.dependencies() == [ binary ]
+            assert fileinput.gPathHits + fileinput.gPathMisses == 2       # (the lookups reading the source made)
+            assert asm.m_memory[0x400:0x40f] == range( 4, 16 ) + [ 30, 31, None ]
+
+            listing = asm.renderListing().split( '\n' )
+            assert listing[3].startswith( "    3:  0400  04 05 06 07 08 09 0A 0B" )
+            assert listing[4] == "    3:  0408  ... 4 more bytes"
+            assert listing[5].startswith( "    4:  040C  1E 1F " )
+
+        assert not asm.assembleString( str.format( "        incbin \"{0}\", 30, 3\n", binary ) )
+        assert not asm.assembleString( "        incbin \"no such file\"\n" )
+
+
+def testOptimize():
+    asm = Assembler( optimize=True )
+
+    #   forward references to zero page, and one that isn't
+    assert asm.assembleString( "        org $300\n"
+        "loop:   lda counter\n"
+        "        sta out,x\n"
+        "        lda far\n"
+        "        bne loop\n"
+        "counter = $20\n"
+        "out = $40\n"
+        "far = $1234\n" )
+    assert asm.m_memory[0x300:0x30a] == [ 0xa5, 0x20, 0x95, 0x40, 0xad, 0x34, 0x12, 0xd0, 0xf7, None ]
+    assert asm.m_bytesSaved == 2 and asm.m_cyclesSaved == 2
+
+    #   'later' moves past $ff once 'far' has grown
+    assert asm.assembleString( "        org $fc\n"
+        "        lda later\n"
+        "        lda far\n"
+        "later:  rts\n"
+        "far = $1234\n" )
+    assert asm.m_memory[0xfc:0x104] == [ 0xad, 0x02, 0x01, 0xad, 0x34, 0x12, 0x60, None ]
+
+    #   branches are only range checked once the sizes have settled
+    assert asm.assembleString( "        org $300\n" + "        lda v0\n" * 200 + "        bne target\n"
+        "target: rts\n"
+        "v0 = $1234\n" )
+    assert asm.m_memory[0x558:0x55b] == [ 0xd0, 0x00, 0x60 ]
+    assert asm.assembleString( "        org $300\n"
+        "back:   nop\n" + "        lda zp\n" * 50 + "        bne back\n"
+        "zp = $12\n" )
+    assert asm.m_memory[0x365:0x367] == [ 0xd0, 0x99 ]
+    assert not asm.assembleString( "        org $300\n"
+        "back:   nop\n" + "        lda v0\n" * 50 + "        bne back\n"
+        "v0 = $1234\n" )
+    assert asm.m_messages == [ "Error: (string)(53): relative reference out of range (-153 bytes)" ]
+
+
+def testOnePass( expected ):
+    asm = Assembler( onePass=True )
+    assert asm.assembleFile( 'test.asm' )
+    assert asm.m_memory == expected and asm.m_fixupCount == 2 and asm.m_resizeCount == 0
+
+    #   a forward reference to zero page changes the instruction's size
+    assert asm.assembleString( "        org $300\n        lda fwd\n        rts\nfwd = $20\n" )
+    assert asm.m_memory[0x300:0x303] == [ 0xa5, 0x20, 0x60 ] and asm.m_resizeCount == 1
+
+    #   and the lines after it move
+    assert asm.assembleString( "        org $300\n"
+        "start:  lda zpv\n"
+        "after:  jmp after\n"
+        "        bne start\n"
+        "zpv = $10\n" )
+    assert asm.m_memory[0x300:0x308] == [ 0xa5, 0x10, 0x4c, 0x02, 0x03, 0xd0, 0xf9, None ]
+    assert asm.m_symbols.get( 'after' ) == 0x302 and asm.m_resizeCount == 1
+
+
+#
+#   Assemblers don't share anything: several at once, in threads, make
+#   what each makes on its own, and one can be used again after an error
+#
+def testReentrant():
+    texts = []
+    for i in range( 1, 9 ):
+        texts.append( str.format( "        org ${0:X}00\n"
+            "start:  ldx #{0}\n"
+            ".loop:  dex\n"
+            "        bne .loop\n"
+            "        jmp start\n", i ) )
+
+    asm = Assembler()
+    assert not asm.assembleString( "        lda nowhere\n" )
+    assert asm.m_messages == [ "Error: (string)(1): Undefined expression" ]
+
+    expected = []
+    for text in texts:
+        assert asm.assembleString( text ) and asm.m_messages == []
+        expected.append( asm.m_memory.copy() )
+
+    results = [ None ] * len( texts )
+
+    #   (and each one that fails reports its own error)
+    def run( i ):
+        asm = Assembler()
+        bad = "        nop\n" * i + str.format( "        bogus{0}\n", i )
+        message = str.format( "Error: (string)({0}): Unknown op: bogus{1}", i + 1, i )
+        for n in range( 20 ):
+            if not asm.assembleString( texts[i] ) or asm.m_memory != expected[i]:
+                return
+            if asm.m_symbols.get( 'start' ) != ( i + 1 ) * 0x100:
+                return
+            if asm.assembleString( bad ) or asm.m_messages != [ message ]:
+                return
+        results[i] = True
+
+    #   (switching threads as often as possible)
+    interval = sys.getcheckinterval()
+    sys.setcheckinterval( 1 )
+    try:
+        threads = [ threading.Thread( target=run, args=( i, ) ) for i in range( len( texts ) ) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setcheckinterval( interval )
+    assert results == [ True ] * len( texts )
+
+    #   the collector is back on once the last assembly is done, not the first
+    assert gc.isenabled() and gCollectorPauses == 0
+    pauseCollector()
+    assert asm.assembleString( texts[0] ) and not gc.isenabled()
+    resumeCollector()
+    assert gc.isenabled()
+
+
+#
+#   Reassembling after a change makes what assembling from scratch does
+#
+def testReassemble():
+    files = {
+        'main.asm': "        org $300\n"
+            "early = later + 1\n"
+            "start:  jsr sub\n"
+            "        lda #early\n"
+            "        include \"a.inc\"\n"
+            "        jmp start\n"
+            "        include \"b.inc\"\n"
+            "later:  incbin \"data.bin\"\n",
+        'a.inc': "sub:    ldx #1\n        rts\n",
+        'b.inc': "        lda #1\n        rts\n",
+        'data.bin': "\x01\x02"
+        }
+
+    with scratchProject( files ) as directory:
+        main, a, b, binary = [ os.path.join( directory, name ) for name in [ 'main.asm', 'a.inc', 'b.inc', 'data.bin' ] ]
+
+        def check( changed ):
+            ok = asm.reassemble( changed )
+            fresh = Assembler()
+            assert fresh.assembleFile( main ) == ok
+            assert asm.m_messages == fresh.m_messages
+            if ok:
+                assert asm.m_memory == fresh.m_memory
+                assert asm.m_symbols.m_symbols.keys() == fresh.m_symbols.m_symbols.keys()
+                for name, sym in fresh.m_symbols.m_symbols.iteritems():
+                    assert asm.m_symbols.get( name ) == sym.m_value
+            return ok
+
+        asm = Assembler( incremental=True )
+        assert asm.assembleFile( main )
+        assert asm.dependencies() == [ main, a, b, binary ]
+        assert asm.includeGraph() == { main: [ a, b, binary ] }
+
+        #   same sizes: b.inc and what follows it are read again, and only they are assembled again
+        writeFile( b, "        lda #2\n        rts\n" )
+        assert check( [ b ] )
+        assert asm.m_readFrom == 9 and asm.m_replayFrom == 9
+
+        #   'later' moves, so phase 1 starts over
+        writeFile( b, "        lda #2\n        nop\n        rts\n" )
+        assert check( [ b ] )
+        assert asm.m_readFrom == 9 and asm.m_replayFrom == 0
+
+        writeFile( a, "sub:    ldx #2\n        rts\n" )
+        assert check( [ a ] )
+        assert asm.m_readFrom == 5 and asm.m_replayFrom == 5
+
+        writeFile( binary, "\x03\x04\x05" )
+        assert check( [ binary ] )
+
+        #   an error, then the fix (which assembles everything)
+        writeFile( a, "sub:    ldx nowhere\n        rts\n" )
+        assert not check( [ a ] )
+        writeFile( a, "sub:    ldx #3\n        rts\n" )
+        assert check( [ a ] )
+        assert asm.m_readFrom == 0
+
+        writeFile( main, "        org $400\n        rts\n" )
+        assert check( [ main ] )
+        assert asm.m_readFrom == 0 and asm.dependencies() == [ main ]
+
+
+#
+#   The boundaries keep what each include changed, not copies of the whole
+#   state: a project with twice the includes keeps twice as much
+#
+def testBoundaries():
+    with scratchProject() as directory:
+
+        def kept( count ):
+            main = os.path.join( directory, str.format( "main{0}.asm", count ) )
+            text = "        org $1000\n"
+            for i in range( count ):
+                name = str.format( "part{0}.inc", i )
+                writeFile( os.path.join( directory, name ),
+                    str.format( "part{0}:  lda #{0}\n        sta $d020\nsize{0} = * - part{0}\n", i ) )
+                text += str.format( "        include \"{0}\"\n", name )
+            writeFile( main, text + "        rts\n" )
+
+            asm = Assembler( incremental=True )
+            assert asm.assembleFile( main )
+            boundaries = asm.m_boundaries
+            assert len( boundaries ) == 2 * count + 1
+            symbols = sum( len( boundary.m_symbols ) + len( boundary.m_redefined or {} ) for boundary in boundaries )
+            written = sum( len( data ) for boundary in boundaries for addr, data in boundary.m_memory or [] )
+            assert written == 5 * count
+            return symbols + written
+
+        assert kept( 40 ) == 2 * kept( 20 )
+
+        #   overlapping includes, changed after the overlap: the warnings
+        #   come back as a fresh assembly has them
+        main = os.path.join( directory, 'main.asm' )
+        b = os.path.join( directory, 'b.inc' )
+        writeFile( main, "        org $300\n        include \"a.inc\"\n        org $301\n"
+            "        include \"b.inc\"\n        nop\n" )
+        writeFile( os.path.join( directory, 'a.inc' ), "        lda #1\n        org $301\n        lda #2\n" )
+        writeFile( b, "        ldx #1\n" )
+        asm = Assembler( incremental=True )
+        assert asm.assembleFile( main )
+        writeFile( b, "        ldx #3\n" )
+        assert asm.reassemble( [ b ] ) and asm.m_replayFrom > 0
+        fresh = Assembler()
+        assert fresh.assembleFile( main )
+        assert asm.m_memory == fresh.m_memory and asm.m_messages == fresh.m_messages
+        assert asm.warnings() == fresh.warnings() and len( fresh.warnings() ) == 2
+
+
+#
+#   -M: every file the build read, nested includes and incbins too
+#
+def testDependencies():
+    files = {
+        'main.asm': "        org $300\n        include \"a.inc\"\n        incbin \"data.bin\"\n",
+        'a.inc': "        include \"b c.inc\"\n        nop\n",
+        'b c.inc': "        rts\n",
+        'data.bin': "\x01"
+        }
+
+    with scratchProject( files ) as directory:
+        main, a, b, binary = [ os.path.join( directory, name ) for name in [ 'main.asm', 'a.inc', 'b c.inc', 'data.bin' ] ]
+        depFile = os.path.join( directory, 'main.d' )
+
+        options = currentOptions()
+        try:
+            cmd_depFile( depFile )
+            ok, output = runJob( ( main, currentOptions() ) )
+            assert ok and output == ""
+            with open( depFile ) as file:
+                assert file.read() == str.format( "{0}dat: {1} \\\n  {2} \\\n  {3} \\\n  {4}\n",
+                    main[:-3], main, a, b.replace( ' ', '\\ ' ), binary )
+        finally:
+            setOptions( options )
+
+
+#
+#   Includes and incbins are found next to the file that names them,
+#   then on the search path
+#
+def testSearchPath():
+    files = {
+        'src/main.asm': "        org $300\n        include \"defs.inc\"\n        include \"io.inc\"\n",
+        'src/defs.inc': "        db 1\n",
+        'lib/io.inc': "        db 2\n        incbin \"font.bin\"\n",
+        'lib/font.bin': "\x03"
+        }
+
+    with scratchProject( files ) as directory:
+        src = os.path.join( directory, 'src' )
+        lib = os.path.join( directory, 'lib' )
+        main = os.path.join( src, 'main.asm' )
+
+        asm = Assembler()
+        assert not asm.assembleFile( main )
+        assert asm.m_messages == [ str.format( "Error: {0}(3): Can't open io.inc", main ) ]
+
+        asm = Assembler( searchPath=[ lib ] )
+        assert asm.assembleFile( main )
+        assert asm.m_memory[0x300:0x304] == [ 1, 2, 3, None ]
+        assert asm.dependencies() == [ main, os.path.join( src, 'defs.inc' ), os.path.join( lib, 'io.inc' ),
+            os.path.join( lib, 'font.bin' ) ]
+
+
+#
+#   Two projects assembled in one process (as kasmd does, moving to
+#   each one's directory) with the same include names get their own
+#   files, even ones the same size and age as the other project's
+#
+def testProjects():
+    files = {
+        'a/main.asm': "        org $300\n        include \"defs.inc\"\n",
+        'a/lib/defs.inc': "        db 1\n",
+        'b/main.asm': "        org $300\n        include \"defs.inc\"\n",
+        'b/defs.inc': "        db 3\n",
+        'b/lib/defs.inc': "        db $16\n"
+        }
+
+    with scratchProject( files ) as directory:
+        a = os.path.join( directory, 'a' )
+        b = os.path.join( directory, 'b' )
+        for name in files:
+            os.utime( os.path.join( directory, name ), ( 1000000000, 1000000000 ) )
+
+        def build( project ):
+            os.chdir( project )
+            asm = Assembler( searchPath=[ 'lib' ] )
+            assert asm.assembleFile( 'main.asm' )
+            return asm.m_memory[0x300]
+
+        cwd = os.getcwd()
+        try:
+            assert build( a ) == 1
+            assert build( b ) == 3
+
+            #   replaced by a file that looks the same from its size and time
+            writeFile( os.path.join( b, 'new.inc' ), "        db 4\n" )
+            os.utime( os.path.join( b, 'new.inc' ), ( 1000000000, 1000000000 ) )
+            os.rename( os.path.join( b, 'new.inc' ), os.path.join( b, 'defs.inc' ) )
+            assert build( b ) == 4
+            assert build( a ) == 1
+        finally:
+            os.chdir( cwd )
+
+
+#   ----------------------------------------------------------------
+#   Statistics
+#   ----------------------------------------------------------------
+
+gShowStats = False
+
+
+def printStats( asm ):
+    print str.format( "Expression cache: {0} hits, {1} misses, {2} entries (limit {3})",
+        eval.gCacheHits,
+        eval.gCacheMisses,
+        len( eval.gCache ),
+        eval.gCacheLimit )
+
+    print str.format( "Files: {0} read, {1} unchanged since they were last read; include paths: {2} remembered, {3} searched",
+        fileinput.gFileMisses,
+        fileinput.gFileHits,
+        fileinput.gPathHits,
+        fileinput.gPathMisses )
+
+    if asm.m_useCache:
+        print str.format( "Source cache: {0} hits ({1} in memory), {2} misses ({3})",
+            sourcecache.gHits,
+            sourcecache.gMemoryHits,
+            sourcecache.gMisses,
+            sourcecache.gDirectory )
+
+    if asm.m_onePass and not asm.m_optimize:
+        print str.format( "Fixups: {0} applied, {1} lines re-sized (needed a second pass)",
+            asm.m_fixupCount,
+            asm.m_resizeCount )
+
+    if asm.m_optimize:
+        print str.format( "Optimize: {0} sizing passes, saved {1} bytes and {2} cycles",
+            asm.m_sizingPasses,
+            asm.m_bytesSaved,
+            asm.m_cyclesSaved )
+
+
+def cmd_stats():
+    global gShowStats
+    gShowStats = True
+
+
+def cmd_noCache():
+    global gUseCache
+    gUseCache = False
+
+
+def cmd_onePass():
+    global gOnePass
+    gOnePass = True
+
+
+def cmd_optimize():
+    global gOptimize
+    gOptimize = True
+
+
+def cmd_passes( count ):
+    global gPassLimit
+    gPassLimit = int( count )
+
+
+#   ----------------------------------------------------------------
+#   Building files, one after another or (-j N) on a process pool
+#
+#   A job is a top-level file and the options that were in effect for
+#   it on the command line.  Each job gets an Assembler of its own; the
+#   output a job would have printed is collected and printed in command
+#   line order.
+#
+#   The options are module globals only until a job starts.
+#   ----------------------------------------------------------------
+
+gJobs = 1
+gUseCache = True            # tokenized sources come from sourcecache
+gOnePass = False
+gOptimize = False
+gPassLimit = 16
+gListing = False
+gShowMap = False
+gSymbolFormat = None        # --symbols: a name in symbols.gFormats
+gDepFile = None             # -M: where to write the dependencies
+gSearchPath = ()            # -I directories, in order
+
+
+def currentOptions():
+    return ( gShowStats, gUseCache, gOnePass, gOptimize, gPassLimit, gRecordLength, gFormat, gListing, gShowMap,
+        gSymbolFormat, gDepFile, gSearchPath )
+
+
+def setOptions( options ):
+    global gShowStats, gUseCache, gOnePass, gOptimize, gPassLimit, gRecordLength, gFormat, gListing, gShowMap
+    global gSymbolFormat, gDepFile, gSearchPath
+    ( gShowStats, gUseCache, gOnePass, gOptimize, gPassLimit, gRecordLength, gFormat, gListing, gShowMap,
+        gSymbolFormat, gDepFile, gSearchPath ) = options
+
+
+#
+#   A filename from the command line ==> the file to assemble
+#
+def sourceFile( filename ):
+    match = re.match( ".*\.(.*)", filename )
+    if not match:
+        filename += ".asm"
+    return filename
+
+
+#
+#   Assemble 'filename', writing its listing and Kim-1 output next to it
+#
+def buildFile( filename ):
+    filename = sourceFile( filename )
+    asm = Assembler( gOnePass, gOptimize, gPassLimit, gUseCache, searchPath=gSearchPath )
+    return writeOutputs( asm, filename, asm.assembleFile( filename ) )
+
+
+#
+#   Report an assembly of 'filename' ('ok' if it had no errors) and write
+#   what the options ask for; returns False if that failed
+#
+def writeOutputs( asm, filename, ok ):
+    match = re.match( "(.*\.).*", filename )
+    if not match:
+        raise Exception( "internal error flogging filenames" )
+
+    baseFile = match.group(1)
+    listingFile = baseFile + "lst"
+    outputFile = baseFile + gFormats[gFormat]['extension']
+
+    for message in asm.m_messages:
+        print message
+
+    if ok and gListing:
+        with open( listingFile, 'w' ) as file:
+            file.write( asm.renderListing() )
+
+    if ok:
+        try:
+            gFormats[gFormat]['writer']( asm.m_memory, outputFile )
+        except:
+            print str.format( "Error: {0}: {1}", outputFile, sys.exc_value )
+            ok = False
+
+    if ok and gSymbolFormat != None:
+        asm.m_symbols.writeSymbols( baseFile + symbols.gFormats[gSymbolFormat]['extension'], gSymbolFormat )
+
+    if ok and gDepFile != None:
+        with open( gDepFile, 'w' ) as file:
+            file.write( makeDependencies( outputFile, asm.dependencies() ) )
+
+    if ok and gShowMap:
+        asm.printMap()
+
+    if gShowStats:
+        printStats( asm )
+
+    return ok
+
+
+#
+#   -M: a make rule for 'target', with no commands (make and ninja read
+#   these as .d files)
+#
+#       rom.dat: rom.asm \
+#         io.inc \
+#         font.bin
+#
+def makeDependencies( target, dependencies ):
+    def escape( name ):
+        return re.sub( r'([ #])', r'\\\1', name ).replace( '$', '$$' )
+
+    names = [ escape( name ) for name in dependencies ]
+    return str.format( "{0}: {1}\n", escape( target ), ' \\\n  '.join( names ) )
+
+
+#
+#   ( filename, options ) ==> ( ok, output )
+#
+def runJob( job ):
+    filename, options = job
+    setOptions( options )
+
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+        try:
+            ok = buildFile( filename )
+        except:
+            print str.format( "Error: {0}", sys.exc_value )
+            ok = False
+        output = sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+
+    return ok, output
+
+
+#
+#   Build the jobs, in order; returns the number that failed
+#
+def runJobs( jobs, workers=1 ):
+    failures = 0
+    pool = None
+    options = currentOptions()
+
+    try:
+        if workers > 1 and len( jobs ) > 1:
+            pool = multiprocessing.Pool( min( workers, len( jobs ) ) )
+            results = pool.imap( runJob, jobs, 1 )
+        else:
+            results = ( runJob( job ) for job in jobs )
+
+        for ok, output in results:
+            sys.stdout.write( output )
+            if not ok:
+                failures += 1
+    finally:
+        if pool != None:
+            pool.close()
+            pool.join()
+        setOptions( options )
+
+    return failures
+
+
+#   ----------------------------------------------------------------
+#   --watch: build the files, then build each one again whenever a file
+#   it reads changes.  The files' modification times are polled; the
+#   reassembly is incremental (see Assembler.reassemble), and how long
+#   it took is reported.
+#   ----------------------------------------------------------------
+
+gWatch = False
+gWatchInterval = 0.25       # seconds between looks at the files
+
+
+#
+#   filename ==> something that changes when the file does (None if it's missing)
+#
+def fileStamp( filename ):
+    try:
+        stat = os.stat( filename )
+        return stat.st_mtime, stat.st_size
+    except:
+        return None
+
+
+def rebuildSummary( asm, seconds ):
+    lines = len( asm.m_records )
+    if asm.m_readFrom == 0:
+        how = str.format( "all {0} lines", lines )
+    elif asm.m_replayFrom > 0:
+        how = str.format( "read {0} of {1} lines again, symbols unchanged", lines - asm.m_readFrom, lines )
+    else:
+        how = str.format( "read {0} of {1} lines again, symbols moved", lines - asm.m_readFrom, lines )
+
+    return str.format( "reassembled in {0:.1f} ms ({1})", seconds * 1000, how )
+
+
+def watch( jobs ):
+    builds = []
+    for filename, options in jobs:
+        setOptions( options )
+        filename = sourceFile( filename )
+        asm = Assembler( gOnePass, gOptimize, gPassLimit, gUseCache, incremental=True, searchPath=gSearchPath )
+        try:
+            writeOutputs( asm, filename, asm.assembleFile( filename ) )
+        except:
+            print str.format( "Error: {0}", sys.exc_value )
+        builds.append( ( filename, options, asm, dict( ( name, fileStamp( name ) ) for name in asm.dependencies() ) ) )
+
+    print "Watching for changes (Ctrl-C to stop)"
+    sys.stdout.flush()
+
+    try:
+        while True:
+            time.sleep( gWatchInterval )
+
+            for filename, options, asm, stamps in builds:
+                changed = [ name for name in stamps if fileStamp( name ) != stamps[name] ]
+                if len( changed ) == 0:
+                    continue
+
+                #   (an edit made while this runs is noticed next time)
+                for name in changed:
+                    stamps[name] = fileStamp( name )
+
+                setOptions( options )
+                start = time.time()
+                try:
+                    ok = asm.reassemble( changed )
+                    seconds = time.time() - start
+                    writeOutputs( asm, filename, ok )
+                    print str.format( "{0}: {1}", filename, rebuildSummary( asm, seconds ) )
+                except:
+                    print str.format( "Error: {0}", sys.exc_value )
+
+                for name in asm.dependencies():
+                    if not name in stamps:
+                        stamps[name] = fileStamp( name )
+                sys.stdout.flush()
+
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+
+def cmd_recordLength( count ):
+    global gRecordLength
+
+    count = int( count )
+    if count < 1 or count > KIM1_MAX_RECORD:
+        raise Exception( str.format( "Record length must be 1 to {0}", KIM1_MAX_RECORD ) )
+    gRecordLength = count
+
+
+def cmd_format( name ):
+    global gFormat
+
+    name = name.lower()
+    if not name in gFormats:
+        raise Exception( str.format( "Unknown format {0} (one of {1})", name, ", ".join( sorted( gFormats ) ) ) )
+    gFormat = name
+
+
+def cmd_listing():
+    global gListing
+    gListing = True
+
+
+def cmd_map():
+    global gShowMap
+    gShowMap = True
+
+
+def cmd_symbols( name ):
+    global gSymbolFormat
+
+    name = name.lower()
+    if not name in symbols.gFormats:
+        raise Exception( str.format( "Unknown symbol format {0} (one of {1})", name, ", ".join( sorted( symbols.gFormats ) ) ) )
+    gSymbolFormat = name
+
+
+def cmd_depFile( filename ):
+    global gDepFile
+    gDepFile = filename
+
+
+def cmd_include( directory ):
+    global gSearchPath
+    gSearchPath = gSearchPath + ( directory, )
+
+
+def cmd_jobs( count ):
+    global gJobs
+    gJobs = int( count )
+
+
+def cmd_watch():
+    global gWatch
+    gWatch = True
+
+
+gCommands = {
+    # 'foo': { 'handler': function, 'count': numberOfArguments }
+    '--stats': { 'handler': cmd_stats },
+    '--no-cache': { 'handler': cmd_noCache },
+    '--one-pass': { 'handler': cmd_onePass },
+    '--optimize': { 'handler': cmd_optimize },
+    '--passes': { 'handler': cmd_passes, 'count': 1 },
+    '-j': { 'handler': cmd_jobs, 'count': 1 },
+    '--watch': { 'handler': cmd_watch },
+    '-l': { 'handler': cmd_listing },
+    '--map': { 'handler': cmd_map },
+    '--symbols': { 'handler': cmd_symbols, 'count': 1 },
+    '-m': { 'handler': cmd_depFile, 'count': 1 },
+    '-i': { 'handler': cmd_include, 'count': 1 },
+    '--record-length': { 'handler': cmd_recordLength, 'count': 1 },
+    '--format': { 'handler': cmd_format, 'count': 1 },
+    '-test': { 'handler': test }
+    }
+
+
+#
+#   Returns the number of files that failed to assemble
+#
+def main( argv ):
+    global gCommands
+
+    jobs = []
+    argno = 1
+    while argno < len( argv ):
+
+        arg = argv[argno].lower()
+
+        if arg in gCommands:
+            count = 0
+            if 'count' in gCommands[arg]:
+                count = gCommands[arg]['count']
+                if argno + count >= len( argv ):
+                    raise Exception( str.format( "Not enough arguments for {0}", arg ) )
+
+                args = argv[argno + 1 : argno + count + 1]
+                argno += count + 1
+                gCommands[arg]['handler'](*args)
+            else:
+                argno += 1
+                gCommands[arg]['handler']()
+                
+        elif arg.startswith( '-' ):
+            
+            raise Exception( str.format( "Unknown option {0}", arg ) )
+
+        else:
+            
+            #   (options are case-blind; filenames are used as given)
+            argno += 1
+            jobs.append( ( argv[argno - 1], currentOptions() ) )
+
+    if gWatch:
+        return watch( jobs )
+
+    return runJobs( jobs, gJobs )
+
+
+#
+#   The command line ==> exit status
+#
+def run( argv ):
+    try:
+        if main( argv ) > 0:
+            return 1
+    except SystemExit:
+        raise
+    except:
+        err = str.format( "Error: {0}", sys.exc_value )
+        print err
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit( run( sys.argv ) )
@@ -0,0 +1,88 @@
+#
+#   kasm.py's command line, handed to a running kasmd
+#
+#   python kasmc.py [kasm options] inputfile...
+#
+#   Prints what 'python kasm.py ...' would have, and exits the same way.
+#   Only this small module is loaded, so a build doesn't pay for starting
+#   kasm itself; if there is no kasmd listening, kasm is run here as usual
+#   (and so is --watch, which keeps running).
+#
+#   The socket is gSocketPath, or $KASMD_SOCKET if that's set.  (It has
+#   a directory of its own: the source cache's is sourcecache's to clear.)
+#
+
+import sys
+import os
+import json
+import socket
+
+
+gSocketPath = os.environ.get( 'KASMD_SOCKET',
+    os.path.join( os.path.expanduser( '~' ), '.cache', 'kasm-daemon', 'kasmd.sock' ) )
+
+
+#
+#   Strings go over the wire as bytes, each byte a latin-1 character
+#
+def encode( message ):
+    return json.dumps( message, encoding='latin-1' ) + '\n'
+
+
+def decode( line ):
+    def toBytes( value ):
+        if isinstance( value, unicode ):
+            return value.encode( 'latin-1' )
+        elif isinstance( value, list ):
+            return [ toBytes( v ) for v in value ]
+        elif isinstance( value, dict ):
+            return dict( ( toBytes( k ), toBytes( v ) ) for k, v in value.iteritems() )
+        else:
+            return value
+
+    return toBytes( json.loads( line ) )
+
+
+#
+#   request ==> reply; raises socket.error if nothing is listening
+#
+def call( request, path=None ):
+    if path == None:
+        path = gSocketPath
+
+    connection = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+    try:
+        connection.connect( path )
+        connection.sendall( encode( request ) )
+        reply = connection.makefile( 'rb' ).readline()
+    finally:
+        connection.close()
+
+    if not reply:
+        raise Exception( "kasmd closed the connection" )
+    reply = decode( reply )
+    if 'error' in reply:
+        raise Exception( reply['error'] )
+    return reply
+
+
+def main( argv ):
+    if not '--watch' in [ arg.lower() for arg in argv[1:] ]:
+        try:
+            reply = call( { 'argv': argv[1:], 'cwd': os.getcwd() } )
+        except socket.error:
+            reply = None
+        except:
+            print str.format( "Error: {0}", sys.exc_value )
+            return 1
+
+        if reply != None:
+            sys.stdout.write( reply['output'] )
+            return reply['status']
+
+    import kasm
+    return kasm.run( argv )
+
+
+if __name__ == '__main__':
+    sys.exit( main( sys.argv ) )
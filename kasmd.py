@@ -0,0 +1,273 @@
+#
+#   kasm daemon: one long-running assembler process, so that a build
+#   doesn't start Python and load kasm every time
+#
+#   python kasmd.py [socket]        serve on a Unix socket (kasmc.gSocketPath)
+#   python kasmd.py --stdio         serve on stdin and stdout
+#   python kasmd.py -test           run the tests
+#
+#   Requests and replies are JSON objects, one to a line (strings are
+#   bytes, as latin-1; see kasmc.encode):
+#
+#       { "argv": [ "-l", "rom.asm" ], "cwd": "/src" }
+#           what 'python kasm.py -l rom.asm' does in /src (this is what
+#           kasmc.py sends)
+#           ==> { "status": 0, "output": "what it would have printed" }
+#
+#       { "source": "        lda #1\n", "filename": "snippet.asm" }
+#       { "file": "rom.asm" }
+#           assemble, without writing anything; these can also have
+#           "cwd", "onePass", "optimize", "passes" and "listing": true
+#           ==> { "ok": true, "messages": [ "Warning: ..."... ],
+#                 "image": [ [ start address, "hex bytes" ]... ],
+#                 "symbols": { "name": value... }, "listing": "..." }
+#
+#       a request that can't be handled ==> { "error": "why" }
+#
+#   Requests are handled one at a time.  The expression cache and the
+#   tokenized source files (sourcecache, which keeps recent ones in
+#   memory) stay warm from one request to the next.
+#
+
+import sys
+import os
+import socket
+import signal
+import binascii
+import StringIO
+import SocketServer
+
+import kasm
+import kasmc
+
+
+#
+#   kasm.py's command line, with its output collected; the options it
+#   sets don't outlast the request
+#
+def runCommand( argv, cwd=None ):
+    if '--watch' in [ arg.lower() for arg in argv ]:
+        raise Exception( "kasmd doesn't --watch (run kasm.py --watch)" )
+
+    options = kasm.currentOptions()
+    jobs = kasm.gJobs
+    directory = os.getcwd()
+
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+        if cwd:
+            os.chdir( cwd )
+        status = kasm.run( [ 'kasm.py' ] + argv )
+        output = sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+        os.chdir( directory )
+        kasm.setOptions( options )
+        kasm.gJobs = jobs
+
+    return { 'status': status, 'output': output }
+
+
+#
+#   Assemble a file or some source, and return what came of it
+#
+def assemble( request ):
+    asm = kasm.Assembler( request.get( 'onePass', False ),
+        request.get( 'optimize', False ),
+        request.get( 'passes', kasm.gPassLimit ) )
+
+    directory = os.getcwd()
+    try:
+        if request.get( 'cwd' ):
+            os.chdir( request['cwd'] )
+
+        if 'source' in request:
+            ok = asm.assembleString( request['source'], request.get( 'filename', '(string)' ) )
+        else:
+            ok = asm.assembleFile( request['file'] )
+    finally:
+        os.chdir( directory )
+
+    memory = asm.m_memory
+    reply = {
+        'ok': ok,
+        'messages': asm.m_messages,
+        'image': [ [ start, binascii.hexlify( memory.m_data[start:end] ) ] for start, end in memory.spans() ],
+        'symbols': dict( ( name, sym.m_value ) for name, sym in asm.m_symbols.m_symbols.iteritems() )
+        }
+
+    if request.get( 'listing' ) and ok:
+        reply['listing'] = asm.renderListing()
+
+    return reply
+
+
+def handle( request ):
+    if 'argv' in request:
+        return runCommand( request['argv'], request.get( 'cwd' ) )
+    elif 'source' in request or 'file' in request:
+        return assemble( request )
+    else:
+        raise Exception( "Unknown request" )
+
+
+#
+#   A line of JSON ==> a line of JSON
+#
+def reply( line ):
+    try:
+        response = handle( kasmc.decode( line ) )
+    except:
+        response = { 'error': str( sys.exc_value ) }
+    return kasmc.encode( response )
+
+
+#
+#   Answer the requests in 'input' until it ends
+#
+def serve( input, output ):
+    while True:
+        line = input.readline()
+        if not line:
+            break
+        if line.strip():
+            output.write( reply( line ) )
+            output.flush()
+
+
+class Handler( SocketServer.StreamRequestHandler ):
+
+    def handle( self ):
+        serve( self.rfile, self.wfile )
+
+
+def listen( path ):
+    directory = os.path.dirname( path )
+    if directory and not os.path.isdir( directory ):
+        os.makedirs( directory )
+
+    #   a socket left behind by a kasmd that's gone is removed
+    if os.path.exists( path ):
+        try:
+            kasmc.call( {}, path )
+        except socket.error:
+            os.remove( path )
+        except:
+            raise Exception( str.format( "kasmd is already running on {0}", path ) )
+
+    return SocketServer.UnixStreamServer( path, Handler )
+
+
+def main( argv ):
+    if len( argv ) > 1 and argv[1] == '--stdio':
+        serve( sys.stdin, sys.stdout )
+        return 0
+
+    path = kasmc.gSocketPath
+    if len( argv ) > 1:
+        path = argv[1]
+
+    #   SIGTERM stops the server between requests (an exception raised in
+    #   the middle of one would just be reported as its error)
+    stopping = []
+
+    def stop( signalNumber, frame ):
+        stopping.append( signalNumber )
+
+    server = listen( path )
+    server.timeout = 0.5
+    signal.signal( signal.SIGTERM, stop )
+    try:
+        while not stopping:
+            server.handle_request()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove( path )
+
+    return 0
+
+
+#
+#   (with a scratch source cache, not the user's)
+#
+def test():
+    with kasm.scratchProject():
+        testDaemon()
+
+
+def testDaemon():
+    import threading
+
+    def ask( request ):
+        output = StringIO.StringIO()
+        serve( StringIO.StringIO( kasmc.encode( request ) ), output )
+        return kasmc.decode( output.getvalue() )
+
+    answer = ask( { 'source': "        org $300\nstart:  lda #1\n        jmp start\n", 'listing': True } )
+    assert answer['ok'] and answer['messages'] == []
+    assert answer['image'] == [ [ 0x300, 'a9014c0003' ] ]
+    assert answer['symbols'] == { 'start': 0x300 }
+    assert answer['listing'].split( '\n' )[2].startswith( "    2:  0300  A9 01" )
+
+    answer = ask( { 'source': "        lda nowhere\n", 'filename': 'snippet.asm' } )
+    assert not answer['ok'] and answer['messages'] == [ "Error: snippet.asm(1): Undefined expression" ]
+
+    answer = ask( { 'file': 'test.asm', 'onePass': True } )
+    assert answer['ok'] and answer['image'][0][0] == 0x200
+
+    assert 'error' in ask( { 'what': 1 } )
+
+    #   the command line, over a socket
+    with kasm.scratchProject( { 'a.asm': "        org $300\n        rts\n" } ) as directory:
+        path = os.path.join( directory, 'kasmd.sock' )
+
+        server = listen( path )
+        thread = threading.Thread( target=server.serve_forever )
+        thread.start()
+        try:
+            answer = kasmc.call( { 'argv': [ '--format', 'bin', 'a.asm', 'nothere.asm' ], 'cwd': directory }, path )
+            assert answer['status'] == 1 and answer['output'] == "Error: Can't open nothere.asm\n"
+            assert open( os.path.join( directory, 'a.bin' ), 'rb' ).read() == '\x60'
+            assert kasm.gFormat == 'kim1'
+
+            answer = kasmc.call( { 'argv': [ '--bogus' ], 'cwd': directory }, path )
+            assert answer['status'] == 1 and answer['output'] == "Error: Unknown option --bogus\n"
+
+            #   kasmc reports an error reply in a line, and runs --watch itself
+            def refuse( argv, cwd=None ):
+                raise Exception( "no thanks" )
+
+            socketPath = kasmc.gSocketPath
+            command = runCommand
+            run = kasm.run
+            ran = []
+            stdout = sys.stdout
+            try:
+                kasmc.gSocketPath = path
+                globals()['runCommand'] = refuse
+                sys.stdout = StringIO.StringIO()
+                assert kasmc.main( [ 'kasmc.py', 'a.asm' ] ) == 1
+                assert sys.stdout.getvalue() == "Error: no thanks\n"
+
+                kasm.run = lambda argv: ran.append( argv ) or 0
+                assert kasmc.main( [ 'kasmc.py', '--WATCH', 'a.asm' ] ) == 0
+                assert ran == [ [ 'kasmc.py', '--WATCH', 'a.asm' ] ]
+            finally:
+                sys.stdout = stdout
+                kasmc.gSocketPath = socketPath
+                globals()['runCommand'] = command
+                kasm.run = run
+        finally:
+            server.shutdown()
+            thread.join()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    if len( sys.argv ) > 1 and sys.argv[1] == '-test':
+        test()
+    else:
+        sys.exit( main( sys.argv ) )
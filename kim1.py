@@ -0,0 +1,172 @@
+#
+#   Read Kim-1 records (as written by kasm's dumpKim1Records) back
+#   into an image
+#
+#   python kim1.py a.dat b.dat      report where two files' images differ
+#   python kim1.py                  run the tests
+#
+#   Records are
+#
+#       ;LLAAAADD...DDCCCC          LL bytes at AAAA; CCCC is the sum of the bytes
+#       ;00NNNNNNNN                 last record: the number of data records, twice
+#
+
+import sys
+import binascii
+
+import image
+
+
+gOnes = '\x01' * 256
+
+
+#
+#   text of a .dat file ==> image.Image; raises on a bad record, with
+#   the line it's on
+#
+#   All of the hex is decoded with one call, then the records are
+#   walked in the decoded bytes; each record costs a few slice
+#   operations.
+#
+def parseKim1( text, filename='(records)' ):
+
+    #   (the line the 'record'th record, from 1, starts on)
+    def bad( record, why ):
+        pos = -1
+        for i in xrange( record ):
+            found = text.find( ';', pos + 1 )
+            if found < 0:
+                break
+            pos = found
+        line = text.count( '\n', 0, max( pos, 0 ) ) + 1
+        raise Exception( str.format( "{0}({1}): {2}", filename, line, why ) )
+
+    #   ';' starts each record; whitespace (the line breaks) doesn't matter
+    records = ''.join( text.split() ).split( ';' )
+    if records[0] != '':
+        bad( 1, "record doesn't start with ';'" )
+    del records[0]
+
+    lengths = map( len, records )
+    for i in xrange( len( records ) ):
+        if lengths[i] < 10 or lengths[i] % 2 != 0:
+            bad( i + 1, "wrong record length" )
+
+    try:
+        raw = bytearray( binascii.unhexlify( ''.join( records ) ) )
+    except:
+        for i in xrange( len( records ) ):
+            try:
+                binascii.unhexlify( records[i] )
+            except:
+                bad( i + 1, "bad hex digits" )
+
+    result = image.Image()
+    data = result.m_data
+    written = result.m_written
+
+    pos = 0
+    for i in xrange( len( records ) ):
+        n = raw[pos]
+        if lengths[i] != n * 2 + 10:
+            bad( i + 1, "wrong record length" )
+
+        if n == 0:
+            if raw[pos + 1:pos + 3] != raw[pos + 3:pos + 5] or ( raw[pos + 1] << 8 | raw[pos + 2] ) != i:
+                bad( i + 1, str.format( "record count doesn't match ({0} records)", i ) )
+            if i != len( records ) - 1:
+                bad( i + 2, "record after the last record" )
+            return result
+
+        addr = raw[pos + 1] << 8 | raw[pos + 2]
+        end = pos + 3 + n
+        block = raw[pos + 3:end]
+        if ( sum( block ) & 0xffff ) != ( raw[end] << 8 | raw[end + 1] ):
+            bad( i + 1, "bad checksum" )
+        if addr + n > image.SIZE:
+            bad( i + 1, "record runs past $FFFF" )
+
+        data[addr:addr + n] = block
+        written[addr:addr + n] = gOnes[:n]
+        pos = end + 2
+
+    raise Exception( str.format( "{0}: no record count at the end", filename ) )
+
+
+def loadKim1( filename ):
+    with open( filename, 'rb' ) as file:
+        return parseKim1( file.read(), filename )
+
+
+def main( argv ):
+    a = loadKim1( argv[1] )
+    b = loadKim1( argv[2] )
+
+    ranges = image.differences( a, b )
+    for start, end in ranges:
+        print str.format( "{0:04X}-{1:04X}  {2} bytes differ", start, end - 1, end - start )
+
+    if len( ranges ) > 0:
+        return 1
+    return 0
+
+
+def test():
+    memory = image.Image()
+    memory.writeBlock( 0x200, 'hello' )
+    memory.writeBlock( 0xfff0, bytearray( range( 16 ) ) )
+
+    text = ';10020068656C6C6F00000000000000000000000214\r\n'
+    text += ';10FFF0000102030405060708090A0B0C0D0E0F0078\r\n'
+    text += ';0000020002\r\n'
+
+    loaded = parseKim1( text )
+    assert loaded.m_data == memory.m_data
+
+    #   the records are whole windows, so the padding comes back as written
+    assert image.differences( loaded, memory ) == [ ( 0x205, 0x210 ) ]
+    assert image.differences( loaded, parseKim1( text ) ) == []
+
+    for bad in [
+        text.replace( '0214', '0215' ),                 # checksum
+        text.replace( ';0000020002', ';0000010001' ),   # count
+        text.replace( ';0000020002\r\n', '' ),        # no count
+        text.replace( ';10FFF0', ';11FFF0' ),           # length
+        text.replace( ';100200', '100200' ),            # no ';'
+        text.replace( '68656C', '68G56C' ) ]:           # hex
+        try:
+            parseKim1( bad )
+            assert False
+        except AssertionError:
+            raise
+        except:
+            pass
+
+    #   errors give the file and the line
+    for bad, message in [
+        ( ';', "test.dat(1): wrong record length" ),
+        ( text.replace( ';0000020002', ';00000200' ), "test.dat(3): wrong record length" ),
+        ( text.replace( '0078', '007' ), "test.dat(2): wrong record length" ),
+        ( text.replace( '0078', '007G' ), "test.dat(2): bad hex digits" ),
+        ( text.replace( '0078', '0079' ), "test.dat(2): bad checksum" ),
+        ( '\n' + text.replace( '\r\n;0000', '\r\n\r\n;0000' ).replace( ';0000020002', ';0000030003' ),
+            "test.dat(5): record count doesn't match (2 records)" ) ]:
+        try:
+            parseKim1( bad, 'test.dat' )
+            assert False
+        except AssertionError:
+            raise
+        except:
+            assert str( sys.exc_value ) == message
+
+
+if __name__ == '__main__':
+    if len( sys.argv ) > 2:
+        try:
+            status = main( sys.argv )
+        except:
+            print str.format( "Error: {0}", sys.exc_value )
+            status = 2
+        sys.exit( status )
+    else:
+        test()
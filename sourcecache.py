@@ -0,0 +1,243 @@
+#
+#   On-disk cache of tokenized source files
+#
+#   A file's lines are tokenized once and stored under a hash of the
+#   file's contents (and of gVersion), so an unchanged include isn't
+#   lexed again, in any phase or any later run.
+#
+#   The cached form is what tok.tokenize returns for each line, or None
+#   for a line that didn't tokenize (it is tokenized again when it is
+#   parsed, so the error is reported against the right line).  Parsed
+#   expressions are closures and can't be stored; the expression cache
+#   in eval.py rebuilds those.
+#
+#   Entries are evicted least recently used first (by modification
+#   time, which a hit refreshes) once the directory is over gSizeLimit.
+#
+#   The last gMemoryLimit files looked up are kept in memory as well, so
+#   a process that assembles over and over (kasmd) doesn't go back to the
+#   disk for a header it has already seen.  The tokens are never
+#   changed once they're made, so the lists are shared.
+#
+
+import os
+import hashlib
+import marshal
+import tempfile
+import collections
+import threading
+
+import tok
+
+
+gVersion = 'kasm-lex-1'             # change this when tok.tokenize's output changes
+gDirectory = os.path.join( os.path.expanduser( '~' ), '.cache', 'kasm' )
+gSizeLimit = 32 * 1024 * 1024
+gMemoryLimit = 256
+gRecent = collections.OrderedDict()     # key ==> lexed lines, least recently used first
+gLock = threading.Lock()                # for gRecent and the counts
+gHits = 0
+gMemoryHits = 0                         # (hits that didn't need the disk)
+gMisses = 0
+
+
+def clearStats():
+    global gHits, gMemoryHits, gMisses
+    gHits = 0
+    gMemoryHits = 0
+    gMisses = 0
+
+
+def key( lines ):
+    h = hashlib.sha1( gVersion )
+    for line in lines:
+        h.update( line )
+    return h.hexdigest()
+
+
+def lexLines( lines ):
+    lexed = []
+    for line in lines:
+        try:
+            lexed.append( tok.tokenize( line ) )
+        except:
+            lexed.append( None )
+    return lexed
+
+
+#
+#   [line...] ==> [lexed line...], from the cache if possible
+#
+def lexFile( lines ):
+    global gHits, gMemoryHits, gMisses
+
+    name = key( lines )
+    with gLock:
+        lexed = gRecent.pop( name, None )
+        if lexed != None:
+            gRecent[name] = lexed
+            gHits += 1
+            gMemoryHits += 1
+            return lexed
+
+    path = os.path.join( gDirectory, name )
+
+    try:
+        with open( path, 'rb' ) as file:
+            lexed = marshal.load( file )
+        if len( lexed ) == len( lines ):
+            os.utime( path, None )
+            with gLock:
+                gHits += 1
+            remember( name, lexed )
+            return lexed
+    except:
+        pass
+
+    with gLock:
+        gMisses += 1
+    lexed = lexLines( lines )
+    store( path, lexed )
+    remember( name, lexed )
+    return lexed
+
+
+def remember( name, lexed ):
+    with gLock:
+        gRecent[name] = lexed
+        while len( gRecent ) > gMemoryLimit:
+            gRecent.popitem( last=False )
+
+
+#
+#   Write an entry (atomically, so a concurrent run never reads half of
+#   one); a cache that can't be written is just a cache that misses
+#
+def store( path, lexed ):
+    try:
+        if not os.path.isdir( gDirectory ):
+            os.makedirs( gDirectory )
+
+        fd, tempPath = tempfile.mkstemp( dir=gDirectory, prefix='.tmp' )
+        with os.fdopen( fd, 'wb' ) as file:
+            marshal.dump( lexed, file )
+        os.rename( tempPath, path )
+
+        evict()
+    except:
+        pass
+
+
+#
+#   Only names that are keys are entries; anything else in the directory
+#   (a temporary file being written, or something that isn't the cache's)
+#   is left alone
+#
+def isKey( name ):
+    return len( name ) == 40 and name.strip( '0123456789abcdef' ) == ''
+
+
+def entries():
+    result = []
+    for name in os.listdir( gDirectory ):
+        if not isKey( name ):
+            continue
+        path = os.path.join( gDirectory, name )
+        st = os.stat( path )
+        result.append( ( st.st_mtime, st.st_size, path ) )
+    return result
+
+
+def evict():
+    cached = entries()
+    total = sum( size for mtime, size, path in cached )
+    if total <= gSizeLimit:
+        return
+
+    for mtime, size, path in sorted( cached ):
+        if total <= gSizeLimit:
+            break
+        try:
+            os.remove( path )
+            total -= size
+        except:
+            pass
+
+
+def clear():
+    with gLock:
+        gRecent.clear()
+
+    if os.path.isdir( gDirectory ):
+        for mtime, size, path in entries():
+            os.remove( path )
+
+
+def test():
+    global gDirectory, gSizeLimit
+
+    directory = gDirectory
+    limit = gSizeLimit
+    gDirectory = tempfile.mkdtemp()
+
+    try:
+        clearStats()
+        lines = [ "foo:    lda     #$12    ; comment\n", "        db 'oops\n", "bar = foo + 1\n" ]
+        lexed = lexFile( lines )
+        assert lexed[0] == tok.tokenize( lines[0] )
+        assert lexed[1] == None
+        assert gHits == 0 and gMisses == 1
+
+        again = lexFile( lines )
+        assert again == lexed
+        assert gHits == 1 and gMemoryHits == 1 and gMisses == 1
+
+        #   from the disk, once it's gone from memory
+        gRecent.clear()
+        assert lexFile( lines ) == lexed
+        assert gHits == 2 and gMemoryHits == 1 and gMisses == 1
+
+        #   a changed file is a different entry
+        lexFile( lines[:2] )
+        assert gMisses == 2 and len( entries() ) == 2
+
+        #   over the limit, the least recently used entry goes first
+        clear()
+        lexFile( lines )
+        lexFile( [ "x = 1\n" ] )
+        os.utime( os.path.join( gDirectory, key( lines ) ), ( 0, 0 ) )
+        gSizeLimit = os.stat( os.path.join( gDirectory, key( [ "x = 1\n" ] ) ) ).st_size
+        evict()
+        assert not os.path.exists( os.path.join( gDirectory, key( lines ) ) )
+        assert os.path.exists( os.path.join( gDirectory, key( [ "x = 1\n" ] ) ) )
+
+        clear()
+        assert len( entries() ) == 0
+
+        #   what isn't an entry (a socket, say) is never evicted or cleared
+        import socket
+        listener = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+        path = os.path.join( gDirectory, 'kasmd.sock' )
+        listener.bind( path )
+        listener.listen( 1 )
+        try:
+            lexFile( lines )
+            gSizeLimit = 0
+            evict()
+            assert len( entries() ) == 0 and os.path.exists( path )
+            lexFile( lines )
+            clear()
+            assert os.path.exists( path )
+        finally:
+            listener.close()
+            os.remove( path )
+    finally:
+        gSizeLimit = limit
+        clear()
+        os.rmdir( gDirectory )
+        gDirectory = directory
+        clearStats()
+
+
+if __name__ == '__main__':
+    test()
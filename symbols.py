@@ -3,71 +3,211 @@
 #   ----------------------------------------------------------------
 
 #
-#   { '<name>':   { '<name>': value, '.subname': value ... } ... }
+#   SymbolTable.m_symbols is { '<name>': Symbol, '<name>.subname': Symbol ... }
 #
-gSymbol = {}
-gSymbolState = {}
-gScope = None
+#   Local labels ('.subname') are qualified with the label that opened
+#   their scope when they are parsed, so every lookup is a single
+#   dictionary access.  'set', 'get', 'isDefined' and 'setScope' still
+#   take unqualified labels and qualify them with the current scope.
+#
+#   Each assembly has a table of its own (see kasm.Assembler), so there
+#   is no symbol state in the module.
+#
+import bisect
+import json
 
-gLoc = 0
 
+class Symbol( object ):
 
-def clear():
-    global gSymbol, gScope
-    gSymbol = {}
-    gSymbolState = {}
-    gScope = None
-    gLoc = 0
+    __slots__ = ( 'm_value', 'm_file', 'm_line', 'm_phase' )
 
+    def __init__( self, value, file=None, line=None, phase=0 ):
+        self.m_value = value
+        self.m_file = file
+        self.m_line = line
+        self.m_phase = phase
 
-def set( label, value ):
-    global gSymbol, gScope
-    scope = None
 
-    if label.startswith( '.' ):
-        scope = gScope
+#
+#   label ==> name in the symbol table, for a label seen in 'scope'
+#
+def qualify( label, scope ):
+    if label.startswith( '.' ) and scope != None:
+        return scope + label
     else:
-        gScope = label
-        scope = label
+        return label
 
-    if not scope in gSymbol:
-        gSymbol[scope] = {}
-        gSymbolState[scope] = {}
 
-    gSymbol[scope][label] = value
-    gSymbolState[scope][label] = True
+class SymbolTable( object ):
 
+    __slots__ = ( 'm_symbols', 'm_scope' )
 
-def setScope( label ):
-    global gScope
-    if not label.startswith( '.' ):
-        gScope = label
+    def __init__( self ):
+        self.clear()
 
+    def clear( self ):
+        self.m_symbols = {}
+        self.m_scope = None
 
-def isDefined( label ):
-    global gSymbol, gScope
+    #
+    #   label ==> name in the symbol table
+    #
+    def qualify( self, label ):
+        return qualify( label, self.m_scope )
 
-    if label.startswith( '.' ):
-        return gScope and gScope in gSymbol and label in gSymbol[gScope]
-    else:
-        return label in gSymbol and label in gSymbol[label]
+    #
+    #   Define an already-qualified name
+    #
+    def define( self, name, value, file=None, line=None, phase=0 ):
+        self.m_symbols[name] = Symbol( value, file, line, phase )
 
+    #
+    #   already-qualified name ==> Symbol, or None
+    #
+    def find( self, name ):
+        return self.m_symbols.get( name )
 
-def get( label ):
-    global gSymbol, gScope
+    def set( self, label, value ):
+        self.setScope( label )
+        self.define( self.qualify( label ), value )
 
-    if label.startswith( '.' ):
-        #xxx mark referenced
-        return gSymbol[gScope][label]
-    else:
+    def setScope( self, label ):
+        if not label.startswith( '.' ):
+            self.m_scope = label
+
+    def isDefined( self, label ):
+        return self.qualify( label ) in self.m_symbols
+
+    def get( self, label ):
         #xxx mark referenced
-        return gSymbol[label][label]
+        return self.m_symbols[self.qualify( label )].m_value
 
+    def dumpSymbols( self ):
+        for name in sorted( self.m_symbols ):
+            print str.format( "{0:20} {1}", name, self.m_symbols[name].m_value )
 
-def dumpSymbols():
-    for scope in gSymbol:
-        print str.format("{0:20} {1}", scope, gSymbol[scope][scope] )
-        for localSymbol in gSymbol[scope]:
-            if localSymbol != scope:
-                print str.format("    {0:20} {1}", localSymbol, gSymbol[scope][localSymbol] )
+    def writeSymbols( self, filename, formatName ):
+        gFormats[formatName]['writer']( filename, self.m_symbols )
 
+
+#
+#   Symbols in address order, for address ==> nearest symbol at or below
+#   it.  Where several symbols have the same value the first by name is
+#   used.  'table' is a SymbolTable's m_symbols.
+#
+class AddressIndex( object ):
+
+    def __init__( self, table ):
+        self.m_entries = sorted( ( sym.m_value, name ) for name, sym in table.iteritems() )    # every ( value, name )
+        self.m_addresses = []
+        self.m_names = []
+        for value, name in self.m_entries:
+            if len( self.m_addresses ) == 0 or self.m_addresses[-1] != value:
+                self.m_addresses.append( value )
+                self.m_names.append( name )
+
+    #
+    #   addr ==> ( name, offset from it ), or None if nothing is at or below addr
+    #
+    def lookup( self, addr ):
+        i = bisect.bisect_right( self.m_addresses, addr ) - 1
+        if i < 0:
+            return None
+        return self.m_names[i], addr - self.m_addresses[i]
+
+
+#   ----------------------------------------------------------------
+#   Symbol files (--symbols format)
+#   ----------------------------------------------------------------
+
+def formatValue( value ):
+    if value >= 0:
+        return str.format( "${0:04X}", value )
+    else:
+        return str( value )
+
+
+#   name = $1234, by name
+def writePlain( filename, table ):
+    lines = []
+    for name in sorted( table ):
+        lines.append( str.format( "{0} = {1}\n", name, formatValue( table[name].m_value ) ) )
+    with open( filename, 'w' ) as file:
+        file.write( ''.join( lines ) )
+
+
+#   VICE monitor labels (al C:1234 .name), by address; only values that are addresses
+def writeVice( filename, table ):
+    lines = []
+    for value, name in AddressIndex( table ).m_entries:
+        if value >= 0 and value <= 0xffff:
+            lines.append( str.format( "al C:{0:04X} .{1}\n", value, name ) )
+    with open( filename, 'w' ) as file:
+        file.write( ''.join( lines ) )
+
+
+#   { "name": value, ... }, by name
+def writeJson( filename, table ):
+    values = dict( ( name, sym.m_value ) for name, sym in table.iteritems() )
+    with open( filename, 'w' ) as file:
+        json.dump( values, file, indent=1, separators=( ',', ': ' ), sort_keys=True )
+        file.write( '\n' )
+
+
+gFormats = {
+    'plain': { 'writer': writePlain, 'extension': 'sym' },
+    'vice': { 'writer': writeVice, 'extension': 'vs' },
+    'json': { 'writer': writeJson, 'extension': 'json' }
+    }
+
+
+def test():
+    table = SymbolTable()
+    table.set( 'func', 1 )
+    table.set( '.loop', 2 )
+    table.set( 'mumble', 3 )
+    table.set( '.loop', 4 )
+    assert table.get( '.loop' ) == 4
+    assert table.find( 'func.loop' ).m_value == 2
+    assert table.find( 'mumble.loop' ).m_value == 4
+
+    table.setScope( 'func' )
+    assert table.get( '.loop' ) == 2
+    assert table.isDefined( 'mumble' ) and not table.isDefined( '.nope' )
+    assert table.qualify( 'mumble' ) == 'mumble'
+    assert qualify( '.loop', 'other' ) == 'other.loop' and qualify( '.loop', None ) == '.loop'
+
+    #   tables don't share anything
+    assert not SymbolTable().isDefined( 'func' )
+
+    index = AddressIndex( table.m_symbols )
+    assert index.lookup( 0 ) == None
+    assert index.lookup( 1 ) == ( 'func', 0 )
+    assert index.lookup( 2 ) == ( 'func.loop', 0 )
+    assert index.lookup( 3 ) == ( 'mumble', 0 )
+    assert index.lookup( 1000 ) == ( 'mumble.loop', 996 )
+
+    table.define( 'alias', 3 )
+    table.define( 'negative', -1 )
+    assert AddressIndex( table.m_symbols ).lookup( 3 ) == ( 'alias', 0 )
+    assert AddressIndex( table.m_symbols ).lookup( 0 ) == ( 'negative', 1 )
+
+    import tempfile
+    import os
+    fd, filename = tempfile.mkstemp()
+    os.close( fd )
+    try:
+        table.writeSymbols( filename, 'plain' )
+        assert open( filename ).read().split( '\n' )[:3] == [ 'alias = $0003', 'func = $0001', 'func.loop = $0002' ]
+        table.writeSymbols( filename, 'vice' )
+        assert open( filename ).read().split( '\n' )[:2] == [ 'al C:0001 .func', 'al C:0002 .func.loop' ]
+        table.writeSymbols( filename, 'json' )
+        assert json.load( open( filename ) )['mumble.loop'] == 4
+    finally:
+        os.remove( filename )
+
+    table.dumpSymbols()
+
+
+if __name__ == '__main__':
+    test()
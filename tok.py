@@ -3,6 +3,7 @@
 #
 
 import sys
+import re
 
 
 EOF = 0
@@ -105,7 +106,7 @@ def parseNumber( s, i ):
     elif s[i] == '$':
         base = 16
         i = i + 1
-    elif s.startswith( '0b' ) or s.startswith( '0B' ):
+    elif s.startswith( '0b', i ) or s.startswith( '0B', i ):
         base = 2
         i = i + 2
 
@@ -160,7 +161,11 @@ def parseString( s, i, endQuote ):
 #
 #   string ==> ( leadingWhitespaceBool, [token...], [tokenValue...] )
 #
-def tokenize( s ):
+#   The original character-at-a-time scanner.  'tokenize' (below) does
+#   the same job with a single compiled pattern; this is kept as the
+#   reference it is tested against.
+#
+def referenceTokenize( s ):
 
     leadingWhitespace = len(s) > 0 and isSpace( s[0] )
     tokens = []
@@ -219,10 +224,129 @@ def tokenize( s ):
     return leadingWhitespace, tokens, tokenValues
 
 
+#
+#   One pattern for every kind of token.  Leading whitespace is skipped,
+#   and exactly one group matches; its index says what the token is.
+#   The last two groups catch the end of the line and bad characters.
+#
+gTokenPattern = re.compile( r'''[ \t\n]*(?:
+    ( [a-zA-Z_.] [a-zA-Z_0-9]* )                        # 1 symbol
+  | ( >> | >= | << | <= | == | != | [-!#%&()*+,./:=>?@\[\]^_{|}<~] )
+                                                        # 2 operator
+  | ( 0[xX][0-9a-fA-F]+ )                               # 3 0x hex number
+  | ( \$[0-9a-fA-F]+ )                                  # 4 $ hex number
+  | ( 0[bB][01]+ )                                      # 5 binary number
+  | ( 0[xX](?=[\s\S]) | 0[bB] | \$ )                    # 6 no digits
+  | ( [0-9]+ )                                          # 7 decimal number
+  | ' ( (?:[^'\\]|\\[\s\S])* ) '                        # 8 'string'
+  | " ( (?:[^"\\]|\\[\s\S])* ) "                        # 9 "string"
+  | ( ['"] )                                            # 10 bad string
+  | ( ; | \Z )                                          # 11 end
+  | ( [\s\S] )                                          # 12 bad character
+    )''', re.VERBOSE )
+
+gStringBodyPattern = re.compile( r'(?:[^\\]|\\[\s\S])*' )
+gEscapePattern = re.compile( r'\\([\s\S])' )
+gEscapes = { 'n': '\n', 't': '\t', 'r': '\r' }
+
+SYMBOL_GROUP = 1
+OPERATOR_GROUP = 2
+HEX_GROUP = 3
+DOLLAR_GROUP = 4
+BINARY_GROUP = 5
+NO_DIGITS_GROUP = 6
+DECIMAL_GROUP = 7
+STRING1_GROUP = 8
+STRING2_GROUP = 9
+BAD_STRING_GROUP = 10
+END_GROUP = 11
+
+
+def unescape( m ):
+    c = m.group( 1 )
+    return gEscapes.get( c, c )
+
+
+#
+#   A quote that didn't make a string; there is no closing quote, so
+#   the body runs to the end of the line, unless it ends in a lone '\'
+#
+def badString( s, i ):
+    if gStringBodyPattern.match( s, i + 1 ).end() < len( s ):
+        raise Exception( "Bad escape at end of string" )
+    else:
+        raise Exception( "Unterminated string" )
+
+
+#
+#   string ==> ( leadingWhitespaceBool, [token...], [tokenValue...] )
+#
+def tokenize( s ):
+
+    leadingWhitespace = s[:1] == ' ' or s[:1] == '\t'
+    tokens = []
+    tokenValues = []
+
+    match = gTokenPattern.match
+    i = 0
+    while True:
+        m = match( s, i )
+        group = m.lastindex
+        text = m.group( group )
+        i = m.end()
+
+        if group == SYMBOL_GROUP:
+            tokens.append( SYMBOL )
+            tokenValues.append( text )
+
+        elif group == OPERATOR_GROUP:
+            tokens.append( text )
+            tokenValues.append( None )
+
+        elif group == DECIMAL_GROUP:
+            tokens.append( NUMBER )
+            tokenValues.append( int( text ) )
+
+        elif group == HEX_GROUP:
+            tokens.append( NUMBER )
+            tokenValues.append( int( text[2:], 16 ) )
+
+        elif group == DOLLAR_GROUP:
+            tokens.append( NUMBER )
+            tokenValues.append( int( text[1:], 16 ) )
+
+        elif group == BINARY_GROUP:
+            tokens.append( NUMBER )
+            tokenValues.append( int( text[2:], 2 ) )
+
+        elif group == STRING1_GROUP or group == STRING2_GROUP:
+            if '\\' in text:
+                text = gEscapePattern.sub( unescape, text )
+            tokens.append( STRING )
+            tokenValues.append( text )
+
+        elif group == END_GROUP:
+            break
+
+        elif group == NO_DIGITS_GROUP:
+            raise Exception( str.format( "Vaucous number, need actual value digits" ) )
+
+        elif group == BAD_STRING_GROUP:
+            badString( s, m.start( group ) )
+
+        else:
+            raise Exception( str.format( 'Unexpected character: {0}', text ) )
+
+    return leadingWhitespace, tokens, tokenValues
+
+
 class Tokenizer:
 
-    def __init__( self, string ):
-        self.m_leadingWhitespace, self.m_tokens, self.m_tokenValues = tokenize( string )
+    # 'lexed' is what tokenize( string ) returned earlier, if that's known
+    def __init__( self, string, lexed=None ):
+        if lexed == None:
+            lexed = tokenize( string )
+        self.m_leadingWhitespace, self.m_tokens, self.m_tokenValues = lexed
         self.m_tokenIndex = 0
 
     def leadingWhitespace( self ):
@@ -237,6 +361,34 @@ class Tokenizer:
         else:
             raise Exception( "unexpected end of line" )
 
+    def position( self ):
+        return self.m_tokenIndex
+
+    # the remaining tokens and their values, as a hashable key
+    def rest( self ):
+        i = self.m_tokenIndex
+        return tuple( self.m_tokens[i:] ), tuple( self.m_tokenValues[i:] )
+
+    # like 'rest', but only up to the first ',' outside parentheses (an
+    # expression never goes past one, so this is all it can depend on)
+    def operand( self ):
+        tokens = self.m_tokens
+        i = self.m_tokenIndex
+        end = i
+        depth = 0
+        while True:
+            try:
+                comma = tokens.index( ',', end )
+            except ValueError:
+                comma = len( tokens )
+                break
+            segment = tokens[end:comma]
+            depth += segment.count( '(' ) - segment.count( ')' )
+            if depth <= 0:
+                break
+            end = comma + 1
+        return tuple( tokens[i:comma] ), tuple( self.m_tokenValues[i:comma] )
+
     def peek( self, i ):
         if self.m_tokenIndex + i < len( self.m_tokens ):
             return self.m_tokens[self.m_tokenIndex + i]
@@ -357,6 +509,8 @@ def test():
     brokenString( '\'foo' )
     brokenString( '\'foo\\' )
 
+    testDifferential()
+
     print tokenize( 'this is a test' )
     print tokenize( 'label: adc a, #42' )
     print tokenize( 'label: db "a string"' )
@@ -365,6 +519,44 @@ def test():
     print tokenize( '1 << 8' )
 
 
+#
+#   'tokenize' must agree with 'referenceTokenize', errors included
+#
+def testDifferential():
+
+    def outcome( fn, s ):
+        try:
+            return fn( s )
+        except Exception, e:
+            return str( e )
+
+    lines = [
+        '', ' ', '\t', '\n', '  \t\n', 'nop', '\tnop\n', 'label: adc a, #42',
+        'label: lda #0x42  ; get froggles', 'label: lda #$42', 'lda #$ff;x',
+        'this is a test', ' foo ; comment ', '1 << 8', '>>= <<> <= == != !x',
+        'a.b', 'a_b .c _x', '.loop: bcc .loop', '123abc', '0x1g', '007',
+        '0b101', 'lda #0b101', 'lda #0B0', '0b', '0b2', 'lda #0x', 'lda #0x\n',
+        '0x ', '$', 'x $ 1', '$g', '0XDEADBEEF', '0xffffffffffff',
+        'db "a string"', "db 'it''s'", "'\\''", '"\\"\\\\"', "'\\n\\t\\r\\q'",
+        "'abc", "'abc\\", "'ab\\'c", '"abc', '"ab\'c', "'\"'", '"\'"',
+        "'; not a comment'", "db 'a', \"b\", 'c'", "x\r\n", '\x80', 'a`b',
+        '(ptr),y', '(zp,x)', '* + 0xffff', '- ! # % & ( ) * + , - . / : = > ? @ [ ] ^ { | } < ~',
+        ]
+
+    for filename in [ 'test.asm', 'test.inc' ]:
+        try:
+            with open( filename ) as file:
+                lines.extend( file.readlines() )
+        except IOError:
+            pass
+
+    for s in lines:
+        want = outcome( referenceTokenize, s )
+        have = outcome( tokenize, s )
+        if want != have:
+            raise Exception( str.format( "tokenize mismatch on {0!r}: {1!r} vs {2!r}", s, have, want ) )
+
+
 def testTokenizer():
     def printTokens( tokenizer ):
         while not tokenizer.atEnd():